@@ -0,0 +1,6 @@
+import sys
+
+from harness import main
+
+
+sys.exit(main())
@@ -0,0 +1,152 @@
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+
+BENCHMARKS = []
+
+# results of the reference run, machine specific and not committed
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def benchmark(name):
+    """Registers benchmark setup function.
+
+    Setup function returns a callable performing one operation,
+    the callable is timed.
+    """
+    def decorator(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return decorator
+
+
+def _number(op, min_time):
+    # number of calls taking at least min_time seconds
+    number = 1
+    while True:
+        elapsed = timeit.timeit(op, number=number)
+        if elapsed >= min_time or number >= 10 ** 7:
+            return number
+        number *= 10 if elapsed < min_time / 10 else 2
+
+
+def run(names=None, repeat=5, min_time=0.1, out=None):
+    """Runs benchmarks with names containing one of `names`.
+
+    Each benchmark is timed `repeat` times, the best time per operation
+    is reported in seconds.
+    """
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        op = setup()
+        number = _number(op, min_time)
+        times = timeit.repeat(op, number=number, repeat=repeat)
+        results[name] = {
+            'per_op': min(times) / number,
+            'number': number,
+            'repeat': repeat,
+        }
+        if out is not None:
+            out.write('{0:<45} {1:>12.3f} us\n'.format(name, results[name]['per_op'] * 1e6))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Returns list of (name, baseline per_op, per_op, ratio) of benchmarks
+    slower than the baseline by more than `tolerance`."""
+    regressions = []
+    for name, res in sorted(results['results'].iteritems()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = res['per_op'] / base['per_op']
+        if ratio > 1 + tolerance:
+            regressions.append((name, base['per_op'], res['per_op'], ratio))
+    return regressions
+
+
+def merge(baseline, results):
+    """Returns baseline updated with the results, benchmarks that weren't
+    run keep their baseline times."""
+    merged = dict(results)
+    merged['results'] = dict(baseline.get('results', {}), **results['results'])
+    return merged
+
+
+def report(results, baseline, out, tolerance=0.2):
+    """Writes comparison of the results with the baseline."""
+    for name, res in sorted(results['results'].iteritems()):
+        base = baseline['results'].get(name)
+        if base is None:
+            out.write('{0:<45} {1:>12} -> {2:>9.3f} us\n'.format(
+                name, 'new', res['per_op'] * 1e6))
+            continue
+        ratio = res['per_op'] / base['per_op']
+        out.write('{0:<45} {1:>9.3f} us -> {2:>9.3f} us {3:>+7.0%}{4}\n'.format(
+            name, base['per_op'] * 1e6, res['per_op'] * 1e6, ratio - 1,
+            ' REGRESSION' if ratio > 1 + tolerance else ''))
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Runs mongolian benchmarks.')
+    parser.add_argument('names', nargs='*', help='run benchmarks containing these names')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='minimal duration of a single repeat in seconds')
+    parser.add_argument('--output', help='write results as json to the file')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store results in the baseline file')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare results with the baseline file')
+    parser.add_argument('--baseline-file', default=DEFAULT_BASELINE,
+                        help='baseline file, {0} by default'.format(DEFAULT_BASELINE))
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown relative to the baseline')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare or args.save_baseline:
+        if os.path.exists(args.baseline_file):
+            baseline = load(args.baseline_file)
+        elif args.compare:
+            parser.error('No baseline at {0}, run with --save-baseline first'.format(
+                args.baseline_file))
+
+    import suite  # registers benchmarks
+
+    results = run(args.names, repeat=args.repeat, min_time=args.min_time,
+                  out=None if args.compare else sys.stdout)
+    if args.output:
+        save(results, args.output)
+    if args.save_baseline:
+        save(merge(baseline or {}, results), args.baseline_file)
+    if args.compare:
+        report(results, baseline, sys.stdout, args.tolerance)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
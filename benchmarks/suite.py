@@ -0,0 +1,297 @@
+"""Benchmarks of ORM hot paths, run with `python -m benchmarks`."""
+import operator
+
+import bson
+import pymongo
+
+from mongolian import MongoObject, pool
+from mongolian.codec import GenericCodec
+from mongolian.condition import Renderer, SimpleCondition
+from mongolian.datatypes import Array, Bool, Float, Int, String
+from mongolian.testing import MemoryCollection
+
+from harness import benchmark
+
+
+class Narrow(MongoObject):
+    id = String()
+    n = Int()
+    tags = Array(String)
+
+    collection = MemoryCollection('narrow')
+
+
+WIDE_FIELDS = 50
+
+wide_attrs = {'id': String(), 'collection': MemoryCollection('wide')}
+for i in xrange(WIDE_FIELDS):
+    wide_attrs['i{0}'.format(i)] = Int()
+    wide_attrs['s{0}'.format(i)] = String()
+Wide = type('Wide', (MongoObject,), wide_attrs)
+
+
+class Job(MongoObject):
+    id = String()
+    status = String()
+    created = Int()
+    progress = Float()
+    active = Bool()
+    hosts = Array(String)
+
+
+def narrow_doc():
+    return {'id': 'a', 'n': 1, 'tags': ['x', 'y', 'z']}
+
+
+def wide_doc():
+    doc = {'id': 'a'}
+    for i in xrange(WIDE_FIELDS):
+        doc['i{0}'.format(i)] = i
+        doc['s{0}'.format(i)] = str(i)
+    return doc
+
+
+def loaded(cls, doc):
+    obj = cls()
+    obj.load(doc)
+    return obj
+
+
+@benchmark('descriptor.get')
+def descriptor_get():
+    obj = loaded(Narrow, narrow_doc())
+    return lambda: obj.n
+
+
+@benchmark('descriptor.set')
+def descriptor_set():
+    obj = loaded(Narrow, narrow_doc())
+
+    def op():
+        obj.n = 2
+    return op
+
+
+@benchmark('descriptor.raw')
+def descriptor_raw():
+    obj = loaded(Narrow, narrow_doc())
+    return lambda: obj.raw('n')
+
+
+@benchmark('accessor.compare')
+def accessor_compare():
+    return lambda: Job.created > 5
+
+
+@benchmark('array.append')
+def array_append():
+    obj = loaded(Narrow, narrow_doc())
+    tags = obj.tags
+
+    def op():
+        tags.append('w')
+        if len(tags) > 1000:
+            tags.clear()
+    return op
+
+
+@benchmark('array.extend')
+def array_extend():
+    obj = loaded(Narrow, narrow_doc())
+    values = [str(i) for i in xrange(100)]
+
+    def op():
+        obj.tags.clear()
+        obj.tags.extend(values)
+    return op
+
+
+@benchmark('array.set')
+def array_set():
+    obj = loaded(Narrow, narrow_doc())
+    values = [str(i) for i in xrange(100)]
+
+    def op():
+        obj.tags = values
+    return op
+
+
+def _dump(cls, doc, codec_type=None):
+    obj = loaded(cls, doc)
+    if codec_type is not None:
+        obj._codec = codec_type(cls)
+    return obj.dump
+
+
+def _load(cls, doc, codec_type=None):
+    obj = cls()
+    if codec_type is not None:
+        obj._codec = codec_type(cls)
+    return lambda: obj.load(doc)
+
+
+@benchmark('model.dump.narrow')
+def dump_narrow():
+    return _dump(Narrow, narrow_doc())
+
+
+@benchmark('model.dump.wide')
+def dump_wide():
+    return _dump(Wide, wide_doc())
+
+
+@benchmark('model.dump.wide.generic')
+def dump_wide_generic():
+    return _dump(Wide, wide_doc(), GenericCodec)
+
+
+@benchmark('model.load.narrow')
+def load_narrow():
+    return _load(Narrow, narrow_doc())
+
+
+@benchmark('model.load.wide')
+def load_wide():
+    return _load(Wide, wide_doc())
+
+
+@benchmark('model.load.wide.lazy')
+def load_wide_lazy():
+    obj = Wide()
+    doc = wide_doc()
+    return lambda: obj.load(doc, lazy=True)
+
+
+@benchmark('model.load.wide.trusted')
+def load_wide_trusted():
+    obj = Wide()
+    doc = wide_doc()
+    return lambda: obj.load(doc, trusted=True)
+
+
+@benchmark('model.load.wide.generic.trusted')
+def load_wide_generic_trusted():
+    obj = Wide()
+    obj._codec = GenericCodec(Wide)
+    doc = wide_doc()
+    return lambda: obj.load(doc, trusted=True)
+
+
+@benchmark('model.encode.narrow')
+def encode_narrow():
+    return loaded(Narrow, narrow_doc()).to_bson
+
+
+@benchmark('model.encode.narrow.dict')
+def encode_narrow_dict():
+    obj = loaded(Narrow, narrow_doc())
+    return lambda: bson.BSON.encode(obj.dump())
+
+
+def arrays_doc():
+    return {'id': 'a', 'n': 1, 'tags': ['tag{0}'.format(i) for i in xrange(200)]}
+
+
+@benchmark('model.encode.arrays')
+def encode_arrays():
+    return loaded(Narrow, arrays_doc()).to_bson
+
+
+@benchmark('model.encode.arrays.dict')
+def encode_arrays_dict():
+    obj = loaded(Narrow, arrays_doc())
+    return lambda: bson.BSON.encode(obj.dump())
+
+
+@benchmark('model.encode.wide')
+def encode_wide():
+    return loaded(Wide, wide_doc()).to_bson
+
+
+@benchmark('model.encode.wide.dict')
+def encode_wide_dict():
+    obj = loaded(Wide, wide_doc())
+    return lambda: bson.BSON.encode(obj.dump())
+
+
+@benchmark('model.decode.wide')
+def decode_wide():
+    obj = Wide()
+    data = bson.BSON.encode(wide_doc())
+    return lambda: obj.load(data)
+
+
+@benchmark('model.decode.wide.trusted')
+def decode_wide_trusted():
+    obj = Wide()
+    data = bson.BSON.encode(wide_doc())
+    return lambda: obj.load(data, trusted=True)
+
+
+@benchmark('model.validate.wide')
+def validate_wide():
+    docs = [wide_doc() for _ in xrange(10)]
+    return lambda: Wide.validate(docs)
+
+
+@benchmark('model.load.wide.generic')
+def load_wide_generic():
+    return _load(Wide, wide_doc(), GenericCodec)
+
+
+def job_condition():
+    return (((Job.status == 'new') | (Job.status == 'executing')) &
+            (Job.created > 1000) & (Job.created <= 2000) &
+            (Job.progress == 1.0).not_() &
+            SimpleCondition(Job.hosts, operator.contains, ['h1', 'h2']))
+
+
+@benchmark('renderer.render')
+def renderer_render():
+    cond = job_condition()
+    return lambda: Renderer.render(cond)
+
+
+@benchmark('renderer.render_cached')
+def renderer_render_cached():
+    cond = job_condition()
+    return lambda: Renderer.render_cached(cond)
+
+
+def _client():
+    return pymongo.MongoClient(_connect=False)
+
+
+@benchmark('pool.find.original')
+def pool_find_original():
+    collection = pymongo.collection.Collection(_client().db, 'items')
+    return lambda: collection.find({'id': 'a'})
+
+
+@benchmark('pool.find.wrapped')
+def pool_find_wrapped():
+    pool.request.context = None
+    collection = pool.Collection(_client().db, 'items')
+    return lambda: collection.find({'id': 'a'})
+
+
+def _send_message():
+    pass
+
+
+@benchmark('pool.log_request.disabled')
+def log_request_disabled():
+    wrapped = pool.log_request(_send_message)
+    pool.request.context = None
+    return wrapped
+
+
+@benchmark('pool.log_request.enabled')
+def log_request_enabled():
+    wrapped = pool.log_request(_send_message)
+    context = pool.RequestContext('find', 'db.items')
+
+    def op():
+        pool.request.context = context
+        wrapped()
+    return op
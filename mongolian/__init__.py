@@ -1,7 +1,18 @@
 import json
 import logging
 
+import bson
+from pymongo.errors import DuplicateKeyError
+
+import bsoncodec
+import cache
+import codec
 import datatypes
+import indexes
+from condition import Condition, Renderer
+from optimizer import optimize, ContradictionError
+from session import Session
+from versioning import ConflictError
 
 logger = logging.getLogger('mm.mongo')
 
@@ -11,17 +22,41 @@ class MongoMeta(type):
     def __init__(self, name, bases, attrs):
         super(MongoMeta, self).__init__(name, bases, attrs)
 
-        fields = set()
+        descriptors = {}
         for base in bases:
-            if getattr(base, '_FIELDS', None):
-                fields.update(base._FIELDS)
+            if getattr(base, '_DESCRIPTORS', None):
+                descriptors.update(base._DESCRIPTORS)
         for attr, t in attrs.iteritems():
             if isinstance(t, datatypes.DataType):
-                fields.add(attr)
+                descriptors[attr] = t
                 t.set_default_map_key(attr)
 
+        fields = set(descriptors)
         logger.debug('Fields for type {0}: {1}'.format(name, fields))
         self._FIELDS = tuple(fields)
+        self._DESCRIPTORS = descriptors
+        self._MAP_KEYS = dict((t._map_key, attr)
+                              for attr, t in descriptors.iteritems())
+        self._codec = self.CODEC(self)
+        self._bson_codec = bsoncodec.BSONCodec(self)
+
+        class_indexes = []
+        for base in bases:
+            class_indexes.extend(getattr(base, '_INDEXES', ()))
+        class_indexes.extend(attrs.get('INDEXES', ()))
+
+        version_field = getattr(self, 'VERSION_FIELD', None)
+        if version_field is not None and \
+                not isinstance(descriptors.get(version_field), datatypes.Int):
+            raise TypeError('Version field {0} of {1} is not an Int field'.format(
+                version_field, name))
+        if version_field is not None and not any(
+                index.fields == ['id'] and index.options.get('unique')
+                for index in class_indexes):
+            # concurrent inserts of a new versioned object are detected
+            # by the unique index
+            class_indexes.append(indexes.Index('id', unique=True))
+        self._INDEXES = tuple(class_indexes)
 
 
 class MongoObject(object):
@@ -30,13 +65,89 @@ class MongoObject(object):
 
     FIELDS = tuple()
 
+    # codec type used for dumping and loading objects,
+    # codec.GenericCodec processes fields through descriptors
+    CODEC = codec.CompiledCodec
+
+    # field accessors are created once per object and reused,
+    # disable to create a new accessor on every attribute access
+    CACHE_ACCESSORS = True
+
+    # cache.ObjectCache instance used by `get` to read objects
+    # through, updated on successful saves
+    CACHE = None
+
+    # list of indexes.Index declarations, created by ensure_indexes
+    INDEXES = ()
+
+    # indexes.IndexChecker instance checking queries of find and find_one
+    INDEX_CHECKER = None
+
+    # writebehind.WriteBehindQueue instance, if set save only queues
+    # the object to be written by the queue
+    WRITE_BEHIND = None
+
+    # name of Int field holding document version, if set saves only
+    # succeed if the document was not changed since it was loaded
+    # and raise versioning.ConflictError otherwise
+    VERSION_FIELD = None
+
     def __init__(self, *args, **kwargs):
         super(MongoObject, self).__init__(*args, **kwargs)
         self._dirty = False
+        self._dirty_fields = set()
+        self._full_dump = False
+        self._pending_ops = {}
+        self._version = None
+        self._bson_cache = {}
         self._data = {}
+        self._accessors = {} if self.CACHE_ACCESSORS else None
+
+    def make_dirty(self, map_key=None):
+        """Marks object as requiring save.
 
-    def make_dirty(self):
+        If map_key is given, only the corresponding document field
+        will be sent on the next save, otherwise the whole document is dumped.
+        """
         self._dirty = True
+        if map_key is None:
+            self._full_dump = True
+            self._pending_ops = {}
+            self._bson_cache.clear()
+        else:
+            self._dirty_fields.add(map_key)
+            self._pending_ops.pop(map_key, None)
+            self._bson_cache.pop(map_key, None)
+
+    def make_clean(self):
+        self._dirty = False
+        self._dirty_fields = set()
+        self._full_dump = False
+        self._pending_ops = {}
+
+    def queue_op(self, map_key, op, value):
+        """Queues atomic update operator ($inc, $push, $addToSet or $pull)
+        for the field, sent on the next save or update_fields.
+
+        Value is an increment for $inc and a list of items for array
+        operators. Fields changed otherwise, or with different operators,
+        are sent as a whole instead. Local value should be changed
+        by the caller.
+        """
+        self._dirty = True
+        self._bson_cache.pop(map_key, None)
+        if self._full_dump or map_key in self._dirty_fields:
+            return
+        pending = self._pending_ops.get(map_key)
+        if pending is None:
+            self._pending_ops[map_key] = (op, value)
+        elif pending[0] != op:
+            # mongodb rejects different operators on one field
+            self.make_dirty(map_key)
+        elif op == '$inc':
+            self._pending_ops[map_key] = (op, pending[1] + value)
+        else:
+            pending[1].extend(value)
 
     @classmethod
     def new(cls, **kwargs):
@@ -49,34 +160,409 @@ class MongoObject(object):
         obj.make_dirty()
         return obj
 
+    @classmethod
+    def query_spec(cls, condition, optimized=False):
+        """Renders query for the condition.
+
+        Optimized condition is simplified before rendering, raises
+        ContradictionError if it can not match any document.
+        """
+        if condition is None:
+            return {}
+        if isinstance(condition, (Condition, datatypes.DataAccessor)):
+            if optimized:
+                condition = optimize(condition)
+            return Renderer.render_cached(condition)
+        return condition
+
+    @classmethod
+    def field_names(cls, fields):
+        """Returns set of field names for field accessors or names."""
+        res = set()
+        for field in fields:
+            if isinstance(field, datatypes.DataAccessor):
+                field = cls._MAP_KEYS.get(field.field._map_key)
+            if field not in cls._DESCRIPTORS:
+                raise ValueError('Type {0} has no field {1}'.format(cls.__name__, field))
+            res.add(field)
+        return res
+
+    @classmethod
+    def projection(cls, fields=None):
+        if fields is None:
+            fields = cls._FIELDS
+        fields = dict.fromkeys(fields, True)
+        # _id is returned by mongo unless excluded explicitly
+        if '_id' not in fields:
+            fields['_id'] = False
+        return fields
+
+    @staticmethod
+    def sort_spec(sort):
+        if sort is None:
+            return None
+        res = []
+        for key, direction in sort:
+            if isinstance(key, datatypes.DataAccessor):
+                key = key.field._map_key
+            res.append((key, direction))
+        return res
+
+    @classmethod
+    def ensure_indexes(cls):
+        """Creates indexes declared for the class, returns their names."""
+        names = []
+        for index in cls._INDEXES:
+            names.append(cls.collection.create_index(index.keys, **index.options))
+        return names
+
+    @classmethod
+    def _check_query(cls, spec):
+        if cls.INDEX_CHECKER is not None:
+            cls.INDEX_CHECKER.check(cls, spec)
+
+    @classmethod
+    def _loaded_fields(cls, fields):
+        if fields is None:
+            return None
+        fields = cls.field_names(fields)
+        if 'id' in cls._DESCRIPTORS:
+            # required to save and fetch partially loaded objects
+            fields.add('id')
+        if cls.VERSION_FIELD is not None:
+            fields.add(cls.VERSION_FIELD)
+        return fields
+
+    @classmethod
+    def find(cls, condition=None, sort=None, limit=0, batch_size=None,
+             lazy=False, fields=None, fetch_unloaded=False, optimized=False,
+             trusted=False):
+        """Yields objects matching the condition.
+
+        Condition can be a Condition, a field accessor or a raw query dict,
+        sort is a list of (field accessor or name, direction) pairs.
+        Only the class's fields are fetched, documents are loaded
+        one by one as the cursor is iterated.
+
+        If `fields` are given, only these fields are fetched, `trusted`
+        documents are loaded without validation, see `load`.
+        Optimized condition is simplified before querying, the query is
+        not sent at all if condition can not match any document.
+        """
+        fields = cls._loaded_fields(fields)
+        try:
+            spec = cls.query_spec(condition, optimized=optimized)
+        except ContradictionError as e:
+            logger.debug('Query for type {0} skipped: {1}'.format(cls.__name__, e))
+            return
+        cls._check_query(spec)
+        cursor = cls.collection.find(spec,
+                                     fields=cls.projection(fields),
+                                     sort=cls.sort_spec(sort),
+                                     limit=limit)
+        if batch_size:
+            cursor.batch_size(batch_size)
+        for doc in cursor:
+            yield cls._from_doc(doc, lazy, fields, fetch_unloaded, trusted)
+
+    @classmethod
+    def _from_doc(cls, doc, lazy=False, fields=None, fetch_unloaded=False, trusted=False):
+        obj = cls()
+        obj.load(doc, lazy=lazy, fields=fields, fetch_unloaded=fetch_unloaded,
+                 trusted=trusted)
+        identity_map = cache.current_identity_map()
+        if identity_map is not None and fields is None:
+            # object loaded earlier in the scope takes precedence
+            obj = identity_map.add(obj)
+        return obj
+
+    @classmethod
+    def find_one(cls, condition=None, lazy=False, fields=None,
+                 fetch_unloaded=False, optimized=False, trusted=False):
+        fields = cls._loaded_fields(fields)
+        try:
+            spec = cls.query_spec(condition, optimized=optimized)
+        except ContradictionError as e:
+            logger.debug('Query for type {0} skipped: {1}'.format(cls.__name__, e))
+            return None
+        cls._check_query(spec)
+        doc = cls.collection.find_one(spec,
+                                      fields=cls.projection(fields))
+        if doc is None:
+            return None
+        return cls._from_doc(doc, lazy, fields, fetch_unloaded, trusted)
+
+    @classmethod
+    def validate(cls, docs):
+        """Checks that documents can be loaded, returns list of
+        (document index, field, error message) for invalid values."""
+        return cls._codec.validate(docs)
+
+    @classmethod
+    def get(cls, id_):
+        """Returns object by id or None if it does not exist.
+
+        Object is looked up in the active identity map, then in the class's
+        CACHE and only then fetched from the database.
+        """
+        identity_map = cache.current_identity_map()
+        if identity_map is not None:
+            obj = identity_map.get(cls, id_)
+            if obj is not None:
+                return obj
+
+        if cls.CACHE is not None:
+            doc = cls.CACHE.get(cls, id_)
+            if doc is not None:
+                # cached documents are dumps of loaded objects
+                return cls._from_doc(doc, trusted=True)
+
+        obj = cls.find_one({'id': id_})
+        if obj is not None and cls.CACHE is not None:
+            cls.CACHE.put(cls, id_, obj.dump())
+        return obj
+
+    def fetch_fields(self, fields):
+        return self.collection.find_one(self.spec(), fields=self.projection(fields))
+
+    @property
+    def partial(self):
+        return isinstance(self._data, codec.LazyData) and bool(self._data.unloaded)
+
     def save(self):
         if not self._dirty:
             logger.debug('Object with id {0} has no _dirty flag set'.format(self.id))
             return
 
-        res = self.collection.update({'id': self.id}, self.dump(), upsert=True)
+        update = self.dump_changes()
+        if not update:
+            logger.debug('Object with id {0} has no changed fields'.format(self.id))
+            self.make_clean()
+            return
+
+        if self.WRITE_BEHIND is not None:
+            self.WRITE_BEHIND.add(self, update)
+            return
+
+        self.write(update)
+        self.saved()
+
+    def write(self, update):
+        """Upserts the update document.
+
+        Versioned objects are only updated if the stored version is the
+        loaded one, the version is incremented with the update. New
+        versioned objects are inserted, an object with the same id saved
+        first is a conflict; this relies on the unique index on id
+        declared for versioned classes, see ensure_indexes.
+        """
+        if self.VERSION_FIELD is None:
+            res = self.collection.update(self.spec(), update, upsert=True)
+            self._check_result(res, update)
+            return
+
+        spec, update, version = self._versioned_update(update)
+        if self._version is None and not any(key.startswith('$') for key in update):
+            try:
+                self.collection.insert(dict(update, **self.spec()))
+                res = None
+            except DuplicateKeyError:
+                # documents saved before versioning was added have no version
+                res = self.collection.update(spec, update)
+        else:
+            res = self.collection.update(spec, update)
+        if res is not None:
+            self._check_result(res, update)
+            if not res.get('n'):
+                raise self._conflict()
+        self._data[self._DESCRIPTORS[self.VERSION_FIELD]._map_key] = version
+        self._version = version
+
+    def _check_result(self, res, update):
         if res['ok'] != 1:
-            logger.error('Unexpected mongo response: {0}, saving object {1}'.format(res, self.dump()))
+            logger.error('Unexpected mongo response: {0}, saving object {1}'.format(res, update))
             raise RuntimeError('Mongo operation result: {0}'.format(res['ok']))
-        self._dirty = False
+
+    def _versioned_update(self, update):
+        field = self.VERSION_FIELD
+        spec = self.spec()
+        spec[self._DESCRIPTORS[field]._map_key] = self._version
+        version = (self._version or 0) + 1
+        if not any(key.startswith('$') for key in update):
+            update = dict(update)
+            update[field] = version
+            return spec, update, version
+        update = dict((op, dict(fields)) for op, fields in update.iteritems())
+        for op in update.values():
+            op.pop(field, None)
+        if self._version is None:
+            update.setdefault('$set', {})[field] = version
+        else:
+            update.setdefault('$inc', {})[field] = 1
+        return spec, dict((op, fields) for op, fields in update.iteritems() if fields), version
+
+    def _conflict(self):
+        current = self.collection.find_one(self.spec(), fields=self.projection())
+        return ConflictError(self, self._version, current)
+
+    def update_fields(self):
+        """Immediately sends changed fields and queued atomic operators
+        of a saved object as a single update.
+
+        Returns whether the document was found, versioned objects raise
+        versioning.ConflictError instead.
+        """
+        if self._full_dump:
+            raise ValueError('Object with id {0} has to be saved as a whole'.format(
+                self.spec()['id']))
+        update = self.dump_changes()
+        if not update:
+            self.make_clean()
+            return True
+        if self.VERSION_FIELD is not None:
+            self.write(update)
+            self.saved()
+            return True
+        res = self.collection.update(self.spec(), update)
+        self._check_result(res, update)
+        if not res.get('n'):
+            return False
+        self.saved()
+        return True
+
+    def saved(self, clean=True):
+        """Marks object clean after it was successfully written.
+
+        Objects written by detached sessions are already marked clean
+        and could have been changed since.
+        """
+        if clean:
+            self.make_clean()
+        if self.CACHE is not None:
+            id_ = self.spec()['id']
+            if self.partial or self._dirty:
+                self.CACHE.invalidate(type(self), id_)
+            else:
+                self.CACHE.put(type(self), id_, self.dump())
+        identity_map = cache.current_identity_map()
+        if identity_map is not None:
+            identity_map.add(self)
+
+    @staticmethod
+    def save_many(objs, ordered=True, batch_size=Session.DEFAULT_BATCH_SIZE):
+        """Saves dirty objects using bulk writes.
+
+        Returns list of SaveResult objects, see Session.flush.
+        """
+        session = Session(ordered=ordered, batch_size=batch_size)
+        session.add_all(objs)
+        return session.flush()
+
+    def spec(self):
+        if 'id' in self._DESCRIPTORS:
+            return {'id': self.raw('id')}
+        return {'id': self.id}
+
+    def raw(self, field):
+        """Returns raw value of the field without creating an accessor."""
+        return self._DESCRIPTORS[field].dump(self)
+
+    @classmethod
+    def set_codec(cls, codec_type):
+        cls.CODEC = codec_type
+        cls._codec = codec_type(cls)
 
     def dump(self):
-        res = {}
-        for field in self._FIELDS:
-            try:
-                item = getattr(self, field)
-            except AttributeError:
-                logger.error('Failed to dump field {0}, job id {1}'.format(field, self.id))
-                raise
-            if isinstance(item, datatypes.DataType):
-                item = item.dump(self)
-            res[field] = item
-        return res
+        if isinstance(self._data, codec.LazyData) and self._data.pending:
+            return self._codec.dump_lazy(self)
+        return self._codec.dump(self)
 
-    def load(self, data):
-        for field in self._FIELDS:
-            try:
-                setattr(self, field, data.get(field, None))
-            except TypeError as e:
-                raise TypeError('Failed to load field {0}: {1}'.format(field, e))
-        self._dirty = False
+    def to_bson(self):
+        """Returns the document of the object encoded as bson.BSON.
+
+        Encoded arrays of scalars are kept until the field is changed,
+        see bsoncodec. Not used by save, pymongo 2.x can't insert
+        encoded documents.
+        """
+        return self._bson_codec.encode(self)
+
+    @classmethod
+    def from_bson(cls, data, trusted=False):
+        """Returns object loaded from BSON bytes, see `load`."""
+        return cls._from_doc(bson.BSON(data), trusted=trusted)
+
+    def dump_changes(self):
+        """Returns update document for the fields changed since last save.
+
+        Full document is returned for objects created with `new` or
+        explicitly marked dirty, otherwise changed fields are
+        sent using $set, fields set to None are removed using $unset
+        and queued atomic operators are added, see `queue_op`.
+        """
+        if self._full_dump:
+            if self.partial:
+                # fields that were not loaded are left intact
+                return {'$set': self.dump()}
+            return self.dump()
+
+        to_set, to_unset = {}, {}
+        for map_key in self._dirty_fields:
+            field = self._MAP_KEYS.get(map_key)
+            if field is None:
+                logger.error('Unknown changed field {0}, object id {1}'.format(map_key, self.id))
+                continue
+            value = self._DESCRIPTORS[field].dump(self)
+            if value is None:
+                to_unset[field] = ''
+            else:
+                to_set[field] = value
+
+        update = {}
+        if to_set:
+            update['$set'] = to_set
+        if to_unset:
+            update['$unset'] = to_unset
+        for map_key, (op, value) in self._pending_ops.iteritems():
+            field = self._MAP_KEYS[map_key]
+            if op == '$inc':
+                pass
+            elif op == '$pull':
+                value = {'$in': list(value)}
+            else:
+                value = {'$each': list(value)}
+            update.setdefault(op, {})[field] = value
+        return update
+
+    def load(self, data, lazy=False, fields=None, fetch_unloaded=False, trusted=False):
+        """Loads object from a document.
+
+        Document can be a dict or a bson.BSON instance. Lazy load converts
+        and validates each field only when it is accessed for the first time.
+
+        If `fields` are given, the object is loaded partially: other fields
+        are neither dumped nor saved, reading them raises
+        codec.NotLoadedError or, if `fetch_unloaded` is set, fetches all
+        the fields not loaded with a single query.
+
+        Trusted documents, e.g. written by this class, are stored without
+        validation and conversion of field values. Lazy and partial loads
+        convert values on access and ignore the flag.
+        """
+        self._bson_cache.clear()
+        if isinstance(data, bson.BSON):
+            data = data.decode()
+        if fields is not None:
+            fetch = self.fetch_fields if fetch_unloaded else None
+            self._codec.load_lazy(self, data, fields=self._loaded_fields(fields), fetch=fetch)
+        elif lazy:
+            self._codec.load_lazy(self, data)
+        else:
+            if isinstance(self._data, codec.LazyData):
+                self._data = {}
+            if trusted:
+                self._codec.load_trusted(self, data)
+            else:
+                self._codec.load(self, data)
+        if self.VERSION_FIELD is not None:
+            self._version = self.raw(self.VERSION_FIELD)
+        self.make_clean()
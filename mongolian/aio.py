@@ -0,0 +1,241 @@
+"""Non-blocking counterparts of MongoObject persistence and queries.
+
+Operations are submitted to a driver and return Future objects. The
+default ThreadDriver runs the regular blocking code paths (condition
+rendering, codecs, sessions) in worker threads; the request context and
+active identity maps of the submitting thread are carried over to the
+worker. Drivers only need to implement `submit`, so an event loop based
+driver can be plugged in:
+
+    futures = [aio.save(obj) for obj in objs]
+    objs = aio.find(Job, Job.status == 'new').result()
+"""
+import Queue
+import logging
+import sys
+import threading
+
+import local
+from session import Session
+
+
+logger = logging.getLogger('mm.mongo')
+
+
+class Future(object):
+    """Result of an operation that may not have completed yet."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('Future is not done in {0} seconds'.format(timeout))
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('Future is not done in {0} seconds'.format(timeout))
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, callback):
+        """Calls callback with the future when it is done, immediately
+        if it is already done."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc, tb=None):
+        self._exc_info = (type(exc), exc, tb)
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            if self._done.is_set():
+                raise RuntimeError('Future is already done')
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logger.exception('Future callback {0!r} failed'.format(callback))
+
+
+def gather(futures):
+    """Returns future of the list of results of the futures."""
+    futures = list(futures)
+    res = Future()
+    if not futures:
+        res.set_result([])
+        return res
+    pending = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        for f in futures:
+            if f.exception() is not None:
+                exc_info = f._exc_info
+                res.set_exception(exc_info[1], exc_info[2])
+                return
+        res.set_result([f.result() for f in futures])
+
+    for f in futures:
+        f.add_done_callback(done)
+    return res
+
+
+class Driver(object):
+    """Executes blocking callables, returns futures of their results."""
+
+    def submit(self, f, *args, **kwargs):
+        raise NotImplementedError
+
+
+class ImmediateDriver(Driver):
+    """Runs callables in the calling thread, useful in tests."""
+
+    def submit(self, f, *args, **kwargs):
+        future = Future()
+        _run(future, f, args, kwargs)
+        return future
+
+
+def _run(future, f, args, kwargs):
+    try:
+        result = f(*args, **kwargs)
+    except Exception as e:
+        future.set_exception(e, sys.exc_info()[2])
+    else:
+        future.set_result(result)
+
+
+class ThreadDriver(Driver):
+    """Runs callables in a pool of `workers` daemon threads."""
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def _start(self):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Driver is shut down')
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                                          name='mongolian-aio-{0}'.format(len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, context, f, args, kwargs = item
+            local.run_in_context(context, _run, future, f, args, kwargs)
+
+    def submit(self, f, *args, **kwargs):
+        self._start()
+        future = Future()
+        self._queue.put((future, local.copy_context(), f, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+_driver = None
+_driver_lock = threading.Lock()
+
+
+def get_driver():
+    global _driver
+    with _driver_lock:
+        if _driver is None:
+            _driver = ThreadDriver()
+        return _driver
+
+
+def set_driver(driver):
+    """Sets driver used by default, returns the previous one."""
+    global _driver
+    with _driver_lock:
+        previous, _driver = _driver, driver
+    return previous
+
+
+def save(obj, driver=None):
+    """Saves object, the future resolves to the object."""
+    def _save():
+        obj.save()
+        return obj
+    return (driver or get_driver()).submit(_save)
+
+
+def save_many(objs, ordered=True, batch_size=Session.DEFAULT_BATCH_SIZE, driver=None):
+    """Saves objects with bulk writes, the future resolves to the list
+    of session.SaveResult."""
+    objs = list(objs)
+
+    def _save_many():
+        session = Session(ordered=ordered, batch_size=batch_size)
+        session.add_all(objs)
+        return session.flush()
+    return (driver or get_driver()).submit(_save_many)
+
+
+def find(cls, condition=None, driver=None, **kwargs):
+    """Finds objects, the future resolves to the list of objects.
+    Keyword arguments are passed to MongoObject.find."""
+    return (driver or get_driver()).submit(lambda: list(cls.find(condition, **kwargs)))
+
+
+def find_one(cls, condition=None, driver=None, **kwargs):
+    return (driver or get_driver()).submit(cls.find_one, condition, **kwargs)
+
+
+def stream(cls, condition=None, callback=None, driver=None, **kwargs):
+    """Calls callback with every object found as soon as it is loaded,
+    the future resolves to the number of objects. Callback is called
+    by the driver, in a worker thread for ThreadDriver."""
+    def _stream():
+        count = 0
+        for obj in cls.find(condition, **kwargs):
+            callback(obj)
+            count += 1
+        return count
+    return (driver or get_driver()).submit(_stream)
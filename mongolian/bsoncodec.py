@@ -0,0 +1,184 @@
+"""BSON encoding of objects without building intermediate documents.
+
+Encoder functions are generated per class like CompiledCodec's: values
+of plain Int, Float, String and Bool fields are packed straight from
+instance._data, other fields are encoded by the bson package. Encoded
+elements of arrays of scalars, which can only be changed through
+accessors marking the field dirty, are cached on the instance until
+the field is changed.
+
+Encoding is not generally faster than dump() with bson.BSON.encode:
+scalar fields take about as long (slower with many strings, which are
+validated in Python), the gain comes from cached arrays of objects
+saved or loaded unchanged. Encoded documents are not used by save or
+inserts, pymongo 2.x can only write documents it encodes itself.
+"""
+import codecs
+import struct
+
+import bson
+
+import codec
+import datatypes
+
+
+_int = struct.Struct('<i')
+_long = struct.Struct('<q')
+_double = struct.Struct('<d')
+
+
+def pack_long(value):
+    try:
+        return _long.pack(value)
+    except struct.error:
+        # same error as the bson package raises
+        raise OverflowError('MongoDB can only handle up to 8-byte ints')
+
+
+def encode_element(name, value):
+    """Returns BSON element of the value encoded by the bson package."""
+    return bson.BSON.encode({name: value})[4:-1]
+
+
+def check_strings(strings):
+    """Raises InvalidStringData, as the bson package does, unless all
+    the strings are valid utf-8."""
+    # NUL ends any incomplete sequence, so the joined string is valid
+    # only if each of the strings is
+    try:
+        codecs.utf_8_decode('\x00'.join(strings), None, True)
+    except UnicodeDecodeError:
+        for value in strings:
+            try:
+                codecs.utf_8_decode(value, None, True)
+            except UnicodeDecodeError:
+                raise bson.errors.InvalidStringData(
+                    'strings in documents must be valid UTF-8: {0!r}'.format(value))
+
+
+def _cacheable(t):
+    # values reachable without an accessor (dicts, numpy views of typed
+    # arrays) can be changed without marking the field dirty
+    while isinstance(t, datatypes.Array) and not isinstance(t, datatypes.TypedArray):
+        t = t.item_field
+    return type(t) in (datatypes.Int, datatypes.Float, datatypes.String, datatypes.Bool)
+
+
+def _kind(t):
+    if isinstance(t, datatypes.Array):
+        return 'cached' if _cacheable(t) else 'other'
+    if not codec._is_plain(t):
+        return 'other'
+    for kind, cls in (('int', datatypes.Int), ('float', datatypes.Float),
+                      ('bool', datatypes.Bool)):
+        if type(t) is cls:
+            return kind
+    if type(t) is datatypes.String and t.encoding.lower().replace('-', '') == 'utf8':
+        return 'string'
+    return 'plain'
+
+
+class BSONCodec(object):
+    """Encodes objects to BSON bytes."""
+
+    def __init__(self, cls):
+        self.name = cls.__name__
+        self.fields = [(field, cls._DESCRIPTORS[field]) for field in cls._FIELDS]
+        self.source, namespace = self._compile()
+        code = compile(self.source, '<bson codec {0}>'.format(self.name), 'exec')
+        exec code in namespace
+        self._encode = namespace['encode']
+
+    def _compile(self):
+        namespace = {
+            'pack_int': _int.pack,
+            'pack_long': pack_long,
+            'pack_double': _double.pack,
+            'encode_element': encode_element,
+            'check_strings': check_strings,
+        }
+        lines = []
+        for i, (field, t) in enumerate(self.fields):
+            key = t._map_key
+            kind = _kind(t)
+            namespace['null_{0}'.format(i)] = '\x0a' + field + '\x00'
+            namespace['dump_{0}'.format(i)] = t.dump
+            fallback = 'append(encode_element({0!r}, value))'.format(field)
+            if kind in ('plain', 'other'):
+                lines.append(
+                    'append(encode_element({0!r}, dump_{1}(instance)))'.format(field, i))
+                continue
+            if kind == 'cached':
+                lines.extend([
+                    'element = cache.get({0!r})'.format(key),
+                    'if element is None:',
+                    '    element = encode_element({0!r}, dump_{1}(instance))'.format(field, i),
+                    '    if clean and {0!r} not in dirty and {0!r} not in pending:'.format(key),
+                    '        cache[{0!r}] = element'.format(key),
+                    'append(element)',
+                ])
+                continue
+
+            lines.extend([
+                'value = data.get({0!r})'.format(key),
+                'if value is None:',
+                '    append(null_{0})'.format(i),
+            ])
+            if kind == 'int':
+                namespace['int_{0}'.format(i)] = '\x10' + field + '\x00'
+                namespace['long_{0}'.format(i)] = '\x12' + field + '\x00'
+                lines.extend([
+                    'elif type(value) is int:',
+                    '    try:',
+                    '        append(int_{0} + pack_int(value))'.format(i),
+                    '    except struct_error:',
+                    '        append(long_{0} + pack_long(value))'.format(i),
+                ])
+            elif kind == 'float':
+                namespace['double_{0}'.format(i)] = '\x01' + field + '\x00'
+                lines.extend([
+                    'elif type(value) is float:',
+                    '    append(double_{0} + pack_double(value))'.format(i),
+                ])
+            elif kind == 'bool':
+                namespace['true_{0}'.format(i)] = '\x08' + field + '\x00\x01'
+                namespace['false_{0}'.format(i)] = '\x08' + field + '\x00\x00'
+                lines.extend([
+                    'elif value is True:',
+                    '    append(true_{0})'.format(i),
+                    'elif value is False:',
+                    '    append(false_{0})'.format(i),
+                ])
+            elif kind == 'string':
+                namespace['string_{0}'.format(i)] = '\x02' + field + '\x00'
+                lines.extend([
+                    'elif type(value) is str:',
+                    '    strings.append(value)',
+                    '    append(string_{0} + pack_int(len(value) + 1) + value + NUL)'.format(i),
+                ])
+            lines.extend(['else:', '    ' + fallback])
+
+        namespace.update(struct_error=struct.error, NUL='\x00')
+        source = '\n'.join(
+            ['def encode(instance, cache):',
+             '    data = instance._data',
+             '    clean = not instance._full_dump',
+             '    dirty = instance._dirty_fields',
+             '    pending = instance._pending_ops',
+             '    parts = []',
+             '    append = parts.append',
+             '    strings = []'] +
+            ['    ' + line for line in lines] +
+            ['    if strings:',
+             '        check_strings(strings)',
+             '    body = "".join(parts)',
+             '    return pack_int(len(body) + 5) + body + NUL']) + '\n'
+        return source, namespace
+
+    def encode(self, instance):
+        """Returns bson.BSON document of the object."""
+        data = instance._data
+        if isinstance(data, codec.LazyData) and data.pending:
+            # fields not accessed yet are encoded as they were loaded
+            return bson.BSON.encode(instance.dump())
+        return bson.BSON(self._encode(instance, instance._bson_cache))
@@ -0,0 +1,129 @@
+import collections
+import copy
+import threading
+import time
+
+import local
+
+
+_local = local.Local()
+
+
+def current_identity_map():
+    """Returns innermost identity map active in the current thread."""
+    stack = getattr(_local, 'identity_maps', None)
+    if not stack:
+        return None
+    return stack[-1]
+
+
+class IdentityMap(object):
+    """Map of loaded objects by class and id scoped to a thread.
+
+    While active (used as a context manager), loading an object
+    that was already loaded in the scope returns the same instance.
+    The map is carried to worker threads with the rest of the context
+    (see local.copy_context), so it is guarded by a lock.
+    """
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def get(self, cls, id_):
+        with self._lock:
+            return self._objects.get((cls, id_))
+
+    def add(self, obj):
+        """Registers object, returns the instance registered before if any."""
+        key = (type(obj), obj.spec()['id'])
+        with self._lock:
+            return self._objects.setdefault(key, obj)
+
+    def remove(self, obj):
+        key = (type(obj), obj.spec()['id'])
+        with self._lock:
+            self._objects.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._objects)
+
+    def __enter__(self):
+        _local.identity_maps = getattr(_local, 'identity_maps', ()) + (self,)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.identity_maps = tuple(m for m in _local.identity_maps if m is not self)
+        with self._lock:
+            self._objects.clear()
+
+
+class ObjectCache(object):
+    """Process-wide LRU cache of object documents keyed by class and id.
+
+    Entries expire `ttl` seconds after they were stored (never if ttl
+    is None). Documents are copied on the way in and out, so cached
+    state can't be changed through loaded objects.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._docs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, cls, id_):
+        key = (cls, id_)
+        with self._lock:
+            entry = self._docs.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, doc = entry
+            if expires is not None and expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._docs[key] = entry
+        return copy.deepcopy(doc)
+
+    def put(self, cls, id_, doc):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        entry = (expires, copy.deepcopy(doc))
+        with self._lock:
+            self._docs.pop((cls, id_), None)
+            self._docs[(cls, id_)] = entry
+            while len(self._docs) > self.maxsize:
+                self._docs.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, cls, id_):
+        with self._lock:
+            self._docs.pop((cls, id_), None)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._docs),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = self.expirations = 0
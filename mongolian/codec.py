@@ -0,0 +1,242 @@
+import datatypes
+
+
+class NotLoadedError(RuntimeError):
+    pass
+
+
+# marker for fields excluded from the loaded document by projection
+UNLOADED = object()
+
+
+class GenericCodec(object):
+    """Dumps and loads objects field by field through descriptors."""
+
+    def __init__(self, cls):
+        self.name = cls.__name__
+        self.fields = [(field, cls._DESCRIPTORS[field])
+                       for field in cls._FIELDS]
+
+    def dump(self, instance):
+        res = {}
+        for field, t in self.fields:
+            res[field] = t.dump(instance)
+        return res
+
+    def load(self, instance, data):
+        for field, _ in self.fields:
+            try:
+                setattr(instance, field, data.get(field, None))
+            except TypeError as e:
+                raise TypeError('Failed to load field {0}: {1}'.format(field, e))
+
+    def load_trusted(self, instance, data):
+        for field, t in self.fields:
+            t.set_trusted(instance, data.get(field, None))
+
+    def validate(self, docs):
+        """Returns list of (document index, field, error message) for
+        document values that can't be loaded, checked field by field."""
+        docs = list(docs)
+        errors = []
+        for field, t in self.fields:
+            # plain fields keep values of exactly BASETYPE type as is
+            basetype = t.BASETYPE if _is_plain(t) else None
+            convert = t.convert
+            for idx, doc in enumerate(docs):
+                value = doc.get(field, None)
+                if value is None or type(value) is basetype:
+                    continue
+                try:
+                    convert(value)
+                except TypeError as e:
+                    errors.append((idx, field, str(e)))
+        errors.sort()
+        return errors
+
+    def load_lazy(self, instance, data, fields=None, fetch=None):
+        """Loads object deferring conversion of each field to its first access.
+
+        Fields missing from the document are set right away. If `fields`
+        are given, other fields are considered not loaded: accessing
+        them raises NotLoadedError or, if `fetch` is set, calls it
+        once with the list of all the fields not loaded.
+        """
+        pending = {}
+        values = {}
+        for field, t in self.fields:
+            if fields is not None and field not in fields:
+                pending[t._map_key] = (field, t, UNLOADED)
+            elif field in data:
+                pending[t._map_key] = (field, t, data[field])
+            else:
+                values[t._map_key] = t.convert(None)
+        instance._data = LazyData(pending, values, fetch=fetch)
+
+    def dump_lazy(self, instance):
+        """Dumps lazily loaded object, fields that were not accessed
+        are dumped as they were loaded."""
+        pending = instance._data.pending
+        res = {}
+        for field, t in self.fields:
+            if t._map_key in pending:
+                value = pending[t._map_key][2]
+                if value is not UNLOADED:
+                    res[field] = value
+            else:
+                res[field] = t.dump(instance)
+        return res
+
+
+def _is_plain(t):
+    # plain fields store converted value under their map key as is
+    return (type(t).set.__func__ is datatypes.DataType.set.__func__ and
+            type(t).dump.__func__ is datatypes.DataType.dump.__func__)
+
+
+class CompiledCodec(GenericCodec):
+    """Codec with dump and load functions generated for a particular class.
+
+    Plain fields are copied between the document and instance._data
+    directly, conversion is called only for values which are not
+    of exactly BASETYPE type. Other fields fall back to their
+    descriptor's set and dump methods.
+    """
+
+    def __init__(self, cls):
+        super(CompiledCodec, self).__init__(cls)
+        self.source, namespace = self._compile()
+        code = compile(self.source, '<codec {0}>'.format(self.name), 'exec')
+        exec code in namespace
+        self.dump = namespace['dump']
+        self._load = namespace['load']
+        self.load_trusted = namespace['load_trusted']
+
+    def _compile(self):
+        namespace = {}
+        dump_items = []
+        load_lines = []
+        trusted_lines = []
+        for i, (field, t) in enumerate(self.fields):
+            if _is_plain(t):
+                namespace['basetype_{0}'.format(i)] = t.BASETYPE
+                namespace['convert_{0}'.format(i)] = t.convert
+                dump_items.append('{0!r}: data.get({1!r})'.format(field, t._map_key))
+                load_lines.append('value = doc.get({0!r})'.format(field))
+                if type(t).convert.__func__ is datatypes.String.convert.__func__:
+                    # documents read from the database hold unicode strings
+                    namespace['encoding_{0}'.format(i)] = t.encoding
+                    load_lines.extend([
+                        'if type(value) is unicode:',
+                        '    value = value.encode(encoding_{0})'.format(i),
+                        'elif value is not None and type(value) is not basetype_{0}:'.format(i),
+                    ])
+                else:
+                    load_lines.append(
+                        'if value is not None and type(value) is not basetype_{0}:'.format(i))
+                load_lines.extend([
+                    '    value = convert_{0}(value)'.format(i),
+                    'data[{0!r}] = value'.format(t._map_key),
+                ])
+                set_trusted = type(t).set_trusted.__func__
+                if set_trusted is datatypes.DataType.set_trusted.__func__:
+                    trusted_lines.append('data[{0!r}] = doc.get({1!r})'.format(t._map_key, field))
+                elif set_trusted is datatypes.String.set_trusted.__func__:
+                    namespace['encoding_{0}'.format(i)] = t.encoding
+                    trusted_lines.extend([
+                        'value = doc.get({0!r})'.format(field),
+                        'if type(value) is unicode:',
+                        '    value = value.encode(encoding_{0})'.format(i),
+                        'data[{0!r}] = value'.format(t._map_key),
+                    ])
+                else:
+                    namespace['set_trusted_{0}'.format(i)] = t.set_trusted
+                    trusted_lines.append('set_trusted_{0}(instance, doc.get({1!r}))'.format(i, field))
+            else:
+                namespace['dump_{0}'.format(i)] = t.dump
+                namespace['set_{0}'.format(i)] = t.set
+                dump_items.append('{0!r}: dump_{1}(instance)'.format(field, i))
+                namespace['set_trusted_{0}'.format(i)] = t.set_trusted
+                load_lines.append('set_{0}(instance, doc.get({1!r}))'.format(i, field))
+                trusted_lines.append('set_trusted_{0}(instance, doc.get({1!r}))'.format(i, field))
+
+        source = '\n'.join(
+            ['def dump(instance):',
+             '    data = instance._data',
+             '    return {' + ', '.join(dump_items) + '}',
+             '',
+             'def load(instance, doc):',
+             '    data = instance._data'] +
+            ['    ' + line for line in load_lines] +
+            ['',
+             'def load_trusted(instance, doc):',
+             '    data = instance._data'] +
+            ['    ' + line for line in trusted_lines]) + '\n'
+        return source, namespace
+
+    def load(self, instance, data):
+        try:
+            self._load(instance, data)
+        except TypeError:
+            # generic codec reports the field that failed to load, it sets
+            # fields through descriptors marking them dirty, so a scratch
+            # instance is used
+            super(CompiledCodec, self).load(type(instance)(), data)
+            raise
+
+
+class LazyData(dict):
+    """Object data converting loaded document fields on first access.
+
+    Only get, item access and assignment and membership tests
+    are aware of pending fields.
+    """
+
+    def __init__(self, pending, *args, **kwargs):
+        self.fetch = kwargs.pop('fetch', None)
+        super(LazyData, self).__init__(*args, **kwargs)
+        self.pending = pending
+
+    @property
+    def unloaded(self):
+        return [field for field, _, value in self.pending.itervalues()
+                if value is UNLOADED]
+
+    def _fetch(self, field):
+        if self.fetch is None:
+            raise NotLoadedError('Field {0} was not loaded'.format(field))
+        unloaded = self.unloaded
+        doc = self.fetch(unloaded) or {}
+        for key, (field, t, value) in self.pending.items():
+            if value is UNLOADED:
+                self.pending[key] = (field, t, doc.get(field, None))
+
+    def _convert(self, key):
+        field, t, value = self.pending[key]
+        if value is UNLOADED:
+            self._fetch(field)
+            field, t, value = self.pending[key]
+        try:
+            value = t.convert(value)
+        except TypeError as e:
+            raise TypeError('Failed to load field {0}: {1}'.format(field, e))
+        del self.pending[key]
+        dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self.pending:
+            return self._convert(key)
+        return dict.get(self, key, default)
+
+    def __getitem__(self, key):
+        if key in self.pending:
+            return self._convert(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self.pending.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.pending or dict.__contains__(self, key)
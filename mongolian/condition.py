@@ -1,4 +1,6 @@
+import collections
 import operator
+import threading
 
 from bson import SON
 
@@ -37,7 +39,9 @@ class SimpleCondition(Condition):
         self.value = value
 
     def __nonzero__(self):
-        return self.field._value == self.value
+        # evaluates condition against the value of the bound field
+        from evaluator import match_value
+        return match_value(self.mongo_op(), self.field._value, self.value)
 
 
 class ComplexCondition(Condition):
@@ -117,11 +121,11 @@ class Renderer(object):
                 ordered_fields = []
                 by_fields_rendered = {}
                 for c in cond.conditions:
-                    if not c.field._map_key in by_fields_rendered:
-                        by_fields_rendered[c.field._map_key] = []
-                        ordered_fields.append(c.field._map_key)
-                    by_fields_rendered[c.field._map_key].append(Renderer.render(c))
-                print by_fields_rendered
+                    key = c.field._map_key if c.field is not None else None
+                    if not key in by_fields_rendered:
+                        by_fields_rendered[key] = []
+                        ordered_fields.append(key)
+                    by_fields_rendered[key].append(Renderer.render(c))
                 for field, crs in by_fields_rendered.items():
                     if field is None:
                         continue
@@ -138,7 +142,6 @@ class Renderer(object):
                         (field,
                         SON(reduce(operator.add, [s.items() for s in sons])))
                     ])]
-                print by_fields_rendered
                 if len(by_fields_rendered) == 1 and by_fields_rendered.keys()[0] is not None:
                     field, crs = by_fields_rendered.items()[0]
                     return crs[0]
@@ -158,6 +161,165 @@ class Renderer(object):
             raise TypeError('Cannot render object of type "{0}"'.format(
                 type(cond).__name__))
 
+    @staticmethod
+    def template(cond):
+        """Returns cached template for the shape of the condition.
+
+        Returns None for conditions that can not be rendered by a template.
+        """
+        values = []
+        signature = _shape(cond, values)
+        if signature is None:
+            return None
+        return Renderer.templates.get(signature, cond)
+
+    @staticmethod
+    def render_cached(cond):
+        """Renders condition using template cached for its shape.
+
+        Result is the same as the one of Renderer.render.
+        """
+        values = []
+        signature = _shape(cond, values)
+        if signature is None:
+            return Renderer.render(cond)
+        return Renderer.templates.get(signature, cond).render(values)
+
+
+class Placeholder(object):
+
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __repr__(self):
+        return 'values[{0}]'.format(self.index)
+
+
+def _shape(cond, values):
+    """Returns structural signature of the condition and collects its
+    values in rendering order.
+
+    Signature is None if condition contains values affecting the shape
+    of the rendered query (SON values).
+    """
+    if isinstance(cond, datatypes.DataAccessor):
+        values.append(True)
+        return (SimpleCondition, cond.field, operator.truth)
+    elif isinstance(cond, SimpleCondition):
+        if isinstance(cond.value, SON):
+            return None
+        values.append(cond.value)
+        return (SimpleCondition, _field(cond.field), cond.op)
+    elif isinstance(cond, NAryCondition):
+        # rendering of complex conditions depends on whether children
+        # have a single common field, which is found by field identity
+        signature = [type(cond), cond.op, _field(cond.field)]
+        for c in cond.conditions:
+            child = _shape(c, values)
+            if child is None:
+                return None
+            signature.append(child)
+        return tuple(signature)
+    raise TypeError('Cannot render object of type "{0}"'.format(
+        type(cond).__name__))
+
+
+def _field(field):
+    # conditions refer to fields both by accessors and by datatypes
+    if isinstance(field, datatypes.DataAccessor):
+        return field.field
+    return field
+
+
+def _parametrize(cond, values):
+    # copy of the condition with values replaced by placeholders
+    if isinstance(cond, datatypes.DataAccessor):
+        cond = SimpleCondition(cond.field, operator.truth, True)
+    if isinstance(cond, SimpleCondition):
+        placeholder = Placeholder(len(values))
+        values.append(cond.value)
+        return SimpleCondition(cond.field, cond.op, placeholder)
+    conditions = [_parametrize(c, values) for c in cond.conditions]
+    return type(cond)(cond.op, *conditions)
+
+
+def _son(items):
+    # SON.__init__ goes through the generic update(), keys of
+    # the rendered templates are known to be unique
+    son = SON.__new__(SON)
+    dict.update(son, items)
+    son._SON__keys = [key for key, _ in items]
+    return son
+
+
+def _source(rendered):
+    if isinstance(rendered, SON):
+        return '_son([{0}])'.format(', '.join(
+            '({0!r}, {1})'.format(key, _source(value))
+            for key, value in rendered.iteritems()))
+    elif isinstance(rendered, list):
+        return '[{0}]'.format(', '.join(_source(value) for value in rendered))
+    elif isinstance(rendered, Placeholder):
+        return repr(rendered)
+    raise TypeError('Unexpected rendered value {0!r}'.format(rendered))
+
+
+class Template(object):
+    """Rendered condition shape with values to be bound on rendering."""
+
+    def __init__(self, cond):
+        values = []
+        rendered = Renderer.render(_parametrize(cond, values))
+        self.size = len(values)
+        self.source = 'lambda values: ' + _source(rendered)
+        self._render = eval(self.source, {'_son': _son})
+
+    def render(self, values):
+        if len(values) != self.size:
+            raise ValueError('Template requires {0} values, got {1}'.format(
+                self.size, len(values)))
+        return self._render(values)
+
+
+class TemplateCache(object):
+    """LRU cache of condition templates keyed by condition signature."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._templates = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, signature, cond):
+        with self._lock:
+            template = self._templates.pop(signature, None)
+            if template is not None:
+                self.hits += 1
+                self._templates[signature] = template
+                return template
+            self.misses += 1
+
+        template = Template(cond)
+        with self._lock:
+            self._templates[signature] = template
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def __len__(self):
+        return len(self._templates)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = self.misses = 0
+
+
+Renderer.templates = TemplateCache()
+
 
 
 
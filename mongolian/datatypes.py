@@ -1,7 +1,14 @@
+import array
+import copy
 import functools
 import logging
+import numbers
 import operator
-import uuid
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from .condition import Condition, SimpleCondition, NAryCondition
 
@@ -15,27 +22,66 @@ class DataType(object):
 
     def __init__(self, map_key=None):
         self._map_key = map_key
+        self._parent = None
 
     def set_default_map_key(self, map_key):
         if self._map_key is None:
             self._map_key = map_key
 
-    def set(self, instance, value):
+    @property
+    def root_map_key(self):
+        # map key of the top-level document field this value belongs to,
+        # array items are stored under generated keys of their own
+        field = self
+        while field._parent is not None:
+            field = field._parent
+        return field._map_key
+
+    def convert(self, value):
+        """Returns value to be stored, raises TypeError for invalid values.
+
+        Values of exactly BASETYPE type and None should be returned as is,
+        compiled codecs rely on this to skip conversion.
+        """
         if not isinstance(value, self.BASETYPE) and value is not None:
             raise TypeError("Value has type '{0}' instead of '{1}'".format(
                 type(value).__name__, self.BASETYPE.__name__))
+        return value
+
+    def set(self, instance, value):
+        instance._data[self._map_key] = self.convert(value)
+
+    def set_trusted(self, instance, value):
+        """Stores value loaded from a trusted document as is."""
         instance._data[self._map_key] = value
 
+    def convert_trusted(self, value):
+        """Returns value of a trusted document to be stored, see set_trusted."""
+        return value
+
     def __set__(self, instance, value):
         self.set(instance, value)
-        logger.debug('Setting value {0} of {1} to instance {2}'.format(value, self, instance))
-        instance.make_dirty()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Setting value {0} of {1} to instance {2}'.format(value, self, instance))
+        instance.make_dirty(self.root_map_key)
 
     def __get__(self, instance, owner):
+        accessors = getattr(instance, '_accessors', None)
+        if accessors is None:
+            # class level access and instances without accessor cache
+            # get a new accessor every time
+            return self.accessor(instance)
+        try:
+            return accessors[self]
+        except KeyError:
+            accessor = accessors[self] = self.accessor(instance)
+            return accessor
+
+    def accessor(self, instance):
         return DataAccessor(instance, self)
 
-    # def dump(self, instance):
-    #     return self._data
+    def dump(self, instance):
+        return instance._data.get(self._map_key, None)
 
     def __repr__(self):
         return '<{0} field, _map_key: {1}>'.format(
@@ -53,37 +99,32 @@ def type_checking(f):
 
 
 class DataAccessor(object):
+
+    __slots__ = ('field', 'instance')
+
     def __init__(self, instance, field):
         self.field = field
         self.instance = instance
 
     @property
     def _value(self):
-        return self.instance._data.get(self._map_key, None)
+        return self.instance._data.get(self.field._map_key, None)
 
     @property
     def _map_key(self):
         return self.field._map_key
 
     def __getitem__(self, key):
-        value = self._value.__getitem__(key)
-        if isinstance(value, DataType):
-            return value.__get__(self.instance, None)
-        else:
-            return value
+        return self._value.__getitem__(key)
 
     def __setitem__(self, key, value):
         # support for indexed datatypes (e.g. dict)
-        self.instance.make_dirty()
-        if isinstance(self._value[key], DataType):
-            return self._value[key].__set__(self.instance, value)
-        else:
-            return self._value.__setitem__(key, value)
+        self.instance.make_dirty(self.field.root_map_key)
+        return self._value.__setitem__(key, value)
 
     def __delitem__(self, key):
-        assert self.owner
-        self.owner.make_dirty()
-        del self.value[key]
+        self.instance.make_dirty(self.field.root_map_key)
+        del self._value[key]
 
     def __eq__(self, other):
         if isinstance(other, DataAccessor):
@@ -147,22 +188,49 @@ class DataAccessor(object):
         return '<{0}, {1}>'.format(type(self).__name__, self._value)
 
 
+class NumberAccessor(DataAccessor):
+
+    __slots__ = ()
+
+    def inc(self, amount=1):
+        """Atomically increments the field by amount on the next save."""
+        if not isinstance(amount, numbers.Real) or isinstance(amount, bool):
+            raise TypeError("Increment has type '{0}' instead of a number".format(
+                type(amount).__name__))
+        if isinstance(self.field, Int) and not isinstance(amount, (int, long)):
+            raise TypeError('Integer field can only be incremented by an integer')
+        amount = self.field.convert(amount)
+        value = self.field.convert((self._value or 0) + amount)
+        self.instance._data[self.field._map_key] = value
+        if self.field._parent is None:
+            self.instance.queue_op(self.field._map_key, '$inc', amount)
+        else:
+            self.instance.make_dirty(self.field.root_map_key)
+        return value
+
+
 class Int(DataType):
     BASETYPE = int
 
-    def set(self, instance, value):
+    def accessor(self, instance):
+        return NumberAccessor(instance, self)
+
+    def convert(self, value):
         if isinstance(value, float):
             value = int(value)
-        super(Int, self).set(instance, value)
+        return super(Int, self).convert(value)
 
 
 class Float(DataType):
     BASETYPE = float
 
-    def set(self, instance, value):
+    def accessor(self, instance):
+        return NumberAccessor(instance, self)
+
+    def convert(self, value):
         if isinstance(value, (int, long)):
             value = float(value)
-        super(Float, self).set(instance, value)
+        return super(Float, self).convert(value)
 
 
 class String(DataType):
@@ -172,17 +240,30 @@ class String(DataType):
         super(String, self).__init__(**kwargs)
         self.encoding = encoding
 
-    def set(self, instance, value):
+    def convert(self, value):
         if isinstance(value, unicode):
             value = value.encode(self.encoding)
-        super(String, self).set(instance, value)
+        return super(String, self).convert(value)
+
+    def set_trusted(self, instance, value):
+        # documents read from the database hold unicode strings
+        if type(value) is unicode:
+            value = value.encode(self.encoding)
+        instance._data[self._map_key] = value
+
+    def convert_trusted(self, value):
+        if type(value) is unicode:
+            value = value.encode(self.encoding)
+        return value
 
 
 class Bool(DataType):
     BASETYPE = bool
 
-    def set(self, instance, value):
-        super(String, self).set(instance, bool(value))
+    def convert(self, value):
+        if value is not None:
+            value = bool(value)
+        return super(Bool, self).convert(value)
 
 
 class Dict(DataType):
@@ -196,57 +277,138 @@ class Dict(DataType):
 
 
 class ArrayAccessor(DataAccessor):
-    def __init__(self, instance, field, itemtype):
+    """Accessor for array fields.
+
+    Array values are stored as a single list of item values, enclosed
+    arrays as lists of lists. Accessors of enclosed arrays are views
+    over the corresponding item list.
+    """
+
+    __slots__ = ('itemtype', 'items')
+
+    def __init__(self, instance, field, itemtype, items=None):
         self.field = field
         self.instance = instance
         self.itemtype = itemtype
+        self.items = items
 
     @property
     def _value(self):
-        value = self.instance._data.get(self._map_key, None)
+        if self.items is not None:
+            return self.items
+        value = self.instance._data.get(self.field._map_key, None)
         if value is None:
             value = []
-            self.instance._data[self._map_key] = value
+            self.instance._data[self.field._map_key] = value
         return value
 
+    def make_dirty(self):
+        self.instance.make_dirty(self.field.root_map_key)
+
     def item(self, value):
-        new_item = self.itemtype(map_key='{0}_{1}'.format(
-            self._map_key, uuid.uuid4().hex))
-        new_item.set(self.instance, value)
-        return new_item
+        return self.field.item_field.convert(value)
 
-    def append(self, value):
-        self.instance.make_dirty()
-        return self._append(value)
+    def wrap(self, value):
+        item_field = self.field.item_field
+        if isinstance(item_field, Array):
+            return ArrayAccessor(self.instance, item_field,
+                                 item_field.itemtype, items=value)
+        return value
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.field.copy(self._value[key])
+        return self.wrap(self._value[key])
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            value = [self.item(val) for val in value]
+        else:
+            value = self.item(value)
+        self.make_dirty()
+        self._value[key] = value
+
+    def __delitem__(self, key):
+        self.make_dirty()
+        del self._value[key]
+
+    def __iter__(self):
+        for value in self._value:
+            yield self.wrap(value)
 
-    def _append(self, value):
-        return self._value.append(self.item(value))
+    def append(self, value):
+        value = self.item(value)
+        self.make_dirty()
+        self._value.append(value)
 
     def insert(self, idx, obj):
-        self.instance.make_dirty()
-        return self._value.insert(idx, self.item(obj))
+        value = self.item(obj)
+        self.make_dirty()
+        self._value.insert(idx, value)
 
     # def index
 
-    def pop(self):
-        self.instance.make_dirty()
-        return self._value.pop()
+    def pop(self, idx=-1):
+        self.make_dirty()
+        return self._value.pop(idx)
 
     # def remove
 
-    def reverse():
-        self.instance.make_dirty()
-        return self._value.reverse()
+    def reverse(self):
+        self.make_dirty()
+        self._value.reverse()
 
     def __len__(self):
         return len(self._value)
 
     def extend(self, ext):
-        self.instance.make_dirty()
-        for el in ext:
-            self._append(el)
+        values = [self.item(val) for val in ext]
+        self.make_dirty()
+        self._value.extend(values)
+
+    def clear(self):
+        self.make_dirty()
+        del self._value[:]
+
+    def _queue(self, op, values):
+        if self.items is None and self.field._parent is None:
+            self.instance.queue_op(self.field._map_key, op, values)
+        else:
+            # enclosed arrays are sent as a part of the top-level field
+            self.make_dirty()
+
+    def push(self, *values):
+        """Appends values, atomically on the next save."""
+        values = [self.item(val) for val in values]
+        self._value.extend(values)
+        self._queue('$push', values)
+
+    def add_to_set(self, *values):
+        """Appends values not in the array yet, atomically on the next save."""
+        values = [self.item(val) for val in values]
+        items = self._value
+        for value in values:
+            if value not in items:
+                items.append(value)
+        self._queue('$addToSet', values)
+
+    def pull(self, *values):
+        """Removes all occurrences of values, atomically on the next save."""
+        values = [self.item(val) for val in values]
+        items = self._value
+        for idx in reversed(xrange(len(items))):
+            if items[idx] in values:
+                del items[idx]
+        self._queue('$pull', values)
+
+
+def _fresh_field(field):
+    field = copy.copy(field)
+    if isinstance(field, Array):
+        field.item_field = _fresh_field(field.item_field)
+        field.item_field._parent = field
+    return field
 
-    # def clean()
 
 class Array(DataType):
     BASETYPE = list
@@ -254,19 +416,187 @@ class Array(DataType):
     def __init__(self, itemtype, map_key=None):
         super(Array, self).__init__(map_key=map_key)
         self.itemtype = itemtype
+        if isinstance(itemtype, type):
+            self.item_field = itemtype()
+        else:
+            # item field instances can be shared by several arrays,
+            # each array needs its own to point _parent at
+            self.item_field = _fresh_field(itemtype)
+        self.item_field._parent = self
+
+    def convert(self, vals):
+        if vals is None:
+            return []
+        convert = self.item_field.convert
+        return [convert(val) for val in vals]
+
+    def copy(self, vals):
+        if isinstance(self.item_field, Array):
+            copy = self.item_field.copy
+            return [copy(val) for val in vals]
+        return list(vals)
 
     def set(self, instance, vals):
-        acc = ArrayAccessor(instance, self, self.itemtype)
-        while len(acc):
-            acc.pop()
-        for val in vals:
-            acc.append(val)
-
-    def __get__(self, instance, owner):
-        return ArrayAccessor(instance, self, self.itemtype)
+        vals = self.convert(vals)
+        # plain dict lookup, lazily loaded value is replaced anyway
+        items = dict.get(instance._data, self._map_key, None)
+        if items is None:
+            instance._data[self._map_key] = vals
+        else:
+            # enclosed array accessors keep references to the list
+            items[:] = vals
+
+    def convert_trusted(self, vals):
+        if vals is None:
+            return []
+        convert = self.item_field.convert_trusted
+        if convert.__func__ is DataType.convert_trusted.__func__:
+            return list(vals)
+        return [convert(val) for val in vals]
+
+    def set_trusted(self, instance, vals):
+        # the document's lists are not shared with the object
+        vals = self.convert_trusted(vals)
+        items = dict.get(instance._data, self._map_key, None)
+        if items is None:
+            instance._data[self._map_key] = vals
+        else:
+            items[:] = vals
 
     def __set__(self, instance, vals):
         self.set(instance, vals)
+        instance.make_dirty(self.root_map_key)
+
+    def dump(self, instance):
+        return self.copy(instance._data.get(self._map_key, None) or [])
+
+    def accessor(self, instance):
+        return ArrayAccessor(instance, self, self.itemtype)
 
     def __call__(self, **kwargs):
         return Array(self.itemtype, **kwargs)
+
+
+class TypedArrayAccessor(ArrayAccessor):
+
+    __slots__ = ()
+
+    @property
+    def _value(self):
+        value = self.instance._data.get(self.field._map_key, None)
+        if value is None:
+            value = array.array(self.field.typecode)
+            self.instance._data[self.field._map_key] = value
+        return value
+
+    def __getitem__(self, key):
+        return self._value[key]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            value = self.field.convert(value)
+        else:
+            value = self.item(value)
+        self.make_dirty()
+        self._value[key] = value
+
+    def __iter__(self):
+        return iter(self._value)
+
+    def extend(self, ext):
+        values = self.field.convert(ext)
+        self.make_dirty()
+        self._value.extend(values)
+
+    def item(self, value):
+        return self.field.convert_item(value)
+
+    def numpy(self):
+        """Returns numpy array with a copy of the field's values.
+        """
+        if numpy is None:
+            raise RuntimeError('numpy is not available')
+        values = self._value
+        return numpy.array(values, dtype=values.typecode)
+
+
+class TypedArray(Array):
+    """Array of Int or Float values stored in a compact array.array.
+
+    Values are validated in bulk on set and extend, numpy arrays are
+    accepted as values and the accessor's numpy() method returns stored
+    values as a numpy array.
+    """
+
+    TYPECODES = {
+        Int: 'l',
+        Float: 'd',
+    }
+
+    def __init__(self, itemtype, map_key=None):
+        super(TypedArray, self).__init__(itemtype, map_key=map_key)
+        try:
+            self.typecode = self.TYPECODES[type(self.item_field)]
+        except KeyError:
+            raise TypeError('Typed array does not support items of type '
+                            '"{0}"'.format(type(self.item_field).__name__))
+
+    def convert(self, vals):
+        if vals is None:
+            return array.array(self.typecode)
+        if isinstance(vals, basestring):
+            # array.array treats strings as raw machine values
+            raise TypeError("Value has type '{0}' instead of '{1}'".format(
+                type(vals).__name__, self.BASETYPE.__name__))
+        if numpy is not None and isinstance(vals, numpy.ndarray):
+            if vals.dtype.kind not in 'iuf' or (self.typecode == 'l' and vals.dtype.kind == 'f'):
+                raise TypeError("Array has dtype '{0}' which can not be "
+                    "stored as '{1}'".format(vals.dtype, self.typecode))
+            res = array.array(self.typecode)
+            res.fromstring(vals.astype(self.typecode).tostring())
+            return res
+        if not isinstance(vals, array.array):
+            if not isinstance(vals, (list, tuple)):
+                vals = list(vals)
+            if bool in set(map(type, vals)):
+                # array.array silently stores bools as numbers
+                raise TypeError("Value has type 'bool' instead of '{0}'".format(
+                    self.item_field.BASETYPE.__name__))
+        try:
+            return array.array(self.typecode, vals)
+        except OverflowError as e:
+            raise TypeError('Value can not be stored as '
+                            '\'{0}\': {1}'.format(self.typecode, e))
+        except TypeError:
+            # fallback to per-item conversion (e.g. floats to ints),
+            # item field reports unsupported values
+            convert = self.convert_item
+            return array.array(self.typecode, [convert(val) for val in vals])
+
+    def convert_item(self, value):
+        if type(value) is bool:
+            raise TypeError("Value has type 'bool' instead of '{0}'".format(
+                self.item_field.BASETYPE.__name__))
+        return self.item_field.convert(value)
+
+    def copy(self, vals):
+        return array.array(self.typecode, vals)
+
+    def convert_trusted(self, vals):
+        # values are stored in arrays, conversion can't be skipped
+        return self.convert(vals)
+
+    def set_trusted(self, instance, vals):
+        self.set(instance, vals)
+
+    def dump(self, instance):
+        values = instance._data.get(self._map_key, None)
+        if values is None:
+            return []
+        return values.tolist()
+
+    def accessor(self, instance):
+        return TypedArrayAccessor(instance, self, self.itemtype)
+
+    def __call__(self, **kwargs):
+        return TypedArray(self.itemtype, **kwargs)
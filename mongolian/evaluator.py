@@ -0,0 +1,217 @@
+import numbers
+import operator
+
+import datatypes
+from condition import SimpleCondition, NAryCondition, UnaryCondition
+
+
+# value of a field missing from the document
+MISSING = object()
+
+
+def _bracket(value):
+    # values of different brackets are never equal and never compared,
+    # as in mongodb
+    if value is None or value is MISSING:
+        return None
+    if isinstance(value, bool):
+        return bool
+    if isinstance(value, numbers.Real):
+        return numbers.Real
+    if isinstance(value, basestring):
+        return basestring
+    if isinstance(value, dict):
+        return dict
+    if isinstance(value, (list, tuple)):
+        return list
+    return type(value)
+
+
+def _equal(value, other):
+    if value is MISSING:
+        return other is None
+    if _bracket(value) is not _bracket(other):
+        return False
+    return value == other
+
+
+def _is_array(value):
+    return isinstance(value, (list, tuple)) or hasattr(value, 'typecode')
+
+
+def _eq(value, other):
+    if _is_array(value):
+        # arrays match by equality of the whole array or any of its elements
+        if _equal(list(value), other):
+            return True
+        return any(_equal(item, other) for item in value)
+    return _equal(value, other)
+
+
+def _compare(cmp):
+    def compare(value, other):
+        if other is None:
+            # only $gte and $lte match null values
+            return cmp(0, 0) and _eq(value, None)
+        if _is_array(value):
+            return any(compare(item, other) for item in value)
+        if _bracket(value) is not _bracket(other):
+            return False
+        return cmp(value, other)
+    return compare
+
+
+def _ne(value, other):
+    return not _eq(value, other)
+
+
+def _in(value, others):
+    return any(_eq(value, other) for other in others)
+
+
+def _exists(value, other):
+    return (value is not MISSING) == bool(other)
+
+
+MATCHERS = {
+    '$eq': _eq,
+    '$ne': _ne,
+    '$gt': _compare(operator.gt),
+    '$gte': _compare(operator.ge),
+    '$lt': _compare(operator.lt),
+    '$lte': _compare(operator.le),
+    '$in': _in,
+    '$exists': _exists,
+}
+
+
+def match_value(mongo_op, value, other):
+    """Returns whether field value matches the operator and its operand."""
+    try:
+        matcher = MATCHERS[mongo_op]
+    except KeyError:
+        raise TypeError('Operator {0} is not supported'.format(mongo_op))
+    return matcher(value, other)
+
+
+def _get(doc, key):
+    data = getattr(doc, '_data', None)
+    if data is None:
+        data = doc
+    return data.get(key, MISSING)
+
+
+def _normalize(cond):
+    if isinstance(cond, datatypes.DataAccessor):
+        return SimpleCondition(cond.field, operator.truth, True)
+    return cond
+
+
+def matches(cond, doc):
+    """Returns whether a MongoObject or a raw document matches the condition.
+
+    Raw documents are looked up by field map keys, the same way as
+    rendered queries are.
+    """
+    cond = _normalize(cond)
+    if isinstance(cond, SimpleCondition):
+        return match_value(cond.mongo_op(), _get(doc, cond.field._map_key), cond.value)
+    elif isinstance(cond, UnaryCondition):
+        return not matches(cond.conditions[0], doc)
+    elif isinstance(cond, NAryCondition):
+        if cond.mongo_op() == '$and':
+            return all(matches(c, doc) for c in cond.conditions)
+        return any(matches(c, doc) for c in cond.conditions)
+    raise TypeError('Cannot evaluate object of type "{0}"'.format(
+        type(cond).__name__))
+
+
+def _match_rows(cond, columns, rows):
+    """Returns set of rows matching the condition among given rows.
+
+    Field values are read column by column, $and conditions are evaluated
+    only for rows matched so far, $or conditions only for rows not yet
+    matched.
+    """
+    cond = _normalize(cond)
+    if isinstance(cond, SimpleCondition):
+        matcher = MATCHERS.get(cond.mongo_op())
+        if matcher is None:
+            raise TypeError('Operator {0} is not supported'.format(cond.mongo_op()))
+        column = columns(cond.field._map_key)
+        other = cond.value
+        return set(row for row in rows if matcher(column[row], other))
+    elif isinstance(cond, UnaryCondition):
+        return rows - _match_rows(cond.conditions[0], columns, rows)
+    elif isinstance(cond, NAryCondition):
+        if cond.mongo_op() == '$and':
+            for c in cond.conditions:
+                if not rows:
+                    break
+                rows = _match_rows(c, columns, rows)
+            return rows
+        matched = set()
+        for c in cond.conditions:
+            rest = rows - matched
+            if not rest:
+                break
+            matched |= _match_rows(c, columns, rest)
+        return matched
+    raise TypeError('Cannot evaluate object of type "{0}"'.format(
+        type(cond).__name__))
+
+
+def match_many(cond, docs):
+    """Returns list of flags telling whether documents match the condition.
+
+    Batched counterpart of `matches` evaluating simple conditions
+    over columns of field values.
+    """
+    docs = list(docs)
+    cache = {}
+
+    def columns(key):
+        if key not in cache:
+            cache[key] = [_get(doc, key) for doc in docs]
+        return cache[key]
+
+    rows = _match_rows(cond, columns, set(xrange(len(docs))))
+    return [row in rows for row in xrange(len(docs))]
+
+
+def filter_many(cond, docs):
+    """Returns documents matching the condition, see `match_many`."""
+    docs = list(docs)
+    return [doc for doc, match in zip(docs, match_many(cond, docs)) if match]
+
+
+def _match_operators(value, operators):
+    for op, other in operators.iteritems():
+        if op == '$not':
+            if _match_operators(value, other):
+                return False
+        elif not match_value(op, value, other):
+            return False
+    return True
+
+
+def _is_operators(value):
+    return isinstance(value, dict) and value and \
+        all(key.startswith('$') for key in value)
+
+
+def match_query(spec, doc):
+    """Returns whether a raw document matches a rendered query document."""
+    for key, value in spec.iteritems():
+        if key == '$and':
+            if not all(match_query(s, doc) for s in value):
+                return False
+        elif key == '$or':
+            if not any(match_query(s, doc) for s in value):
+                return False
+        elif _is_operators(value):
+            if not _match_operators(_get(doc, key), value):
+                return False
+        elif not _eq(_get(doc, key), value):
+            return False
+    return True
@@ -0,0 +1,149 @@
+import collections
+import json
+import logging
+import threading
+
+import datatypes
+
+
+logger = logging.getLogger('mm.mongo')
+
+
+ASCENDING = 1
+DESCENDING = -1
+
+# operators that can be served by scanning an index range
+INDEXABLE_OPS = frozenset(['$eq', '$in', '$gt', '$gte', '$lt', '$lte', '$exists'])
+
+
+class Index(object):
+    """Index declaration for MongoObject classes.
+
+    Keys are a field or a list of (field, direction) pairs, fields can be
+    given as descriptors, accessors or document keys. Other keyword
+    arguments are passed to create_index (e.g. unique, sparse, name).
+
+        class Job(MongoObject):
+            id = String()
+            status = String()
+            INDEXES = [Index(id, unique=True), Index([(status, ASCENDING)])]
+    """
+
+    def __init__(self, keys, **options):
+        if not isinstance(keys, (list, tuple)):
+            keys = [(keys, ASCENDING)]
+        self._keys = list(keys)
+        self.options = options
+
+    @staticmethod
+    def _key(field):
+        if isinstance(field, datatypes.DataAccessor):
+            field = field.field
+        if isinstance(field, datatypes.DataType):
+            return field._map_key
+        return field
+
+    @property
+    def keys(self):
+        # resolved lazily, descriptors get their map keys after class creation
+        return [(self._key(field), direction) for field, direction in self._keys]
+
+    @property
+    def fields(self):
+        return [key for key, _ in self.keys]
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(type(self).__name__, self.keys)
+
+
+def ensure_indexes(classes):
+    """Creates declared indexes of the classes, returns list of index names."""
+    names = []
+    for cls in classes:
+        names.extend(cls.ensure_indexes())
+    return names
+
+
+def _query_fields(spec):
+    """Returns fields of the top-level conjunction of the query that
+    can be served by an index and the list of its $or branches."""
+    fields = set()
+    branches = []
+    for key, value in spec.iteritems():
+        if key == '$and':
+            for sub in value:
+                sub_fields, sub_branches = _query_fields(sub)
+                fields |= sub_fields
+                branches.extend(sub_branches)
+        elif key == '$or':
+            branches.append(value)
+        elif key.startswith('$'):
+            continue
+        elif isinstance(value, dict) and value and all(op.startswith('$') for op in value):
+            if any(op in INDEXABLE_OPS for op in value):
+                fields.add(key)
+        else:
+            fields.add(key)
+    return fields, branches
+
+
+def can_use_index(spec, indexes):
+    """Returns whether one of the indexes (lists of key fields) can serve
+    the rendered query.
+
+    Index is considered usable if its first field is constrained by
+    an indexable operator. Query with $or is served if all the branches
+    of one of its $or clauses are.
+    """
+    fields, branches = _query_fields(spec)
+    if any(index and index[0] in fields for index in indexes):
+        return True
+    return any(all(can_use_index(branch, indexes) for branch in clause)
+               for clause in branches)
+
+
+def query_shape(spec):
+    """Returns query with values replaced by 1."""
+    if not isinstance(spec, dict):
+        return 1
+    res = {}
+    for key, value in spec.iteritems():
+        if key in ('$and', '$or'):
+            res[key] = [query_shape(sub) for sub in value]
+        else:
+            res[key] = query_shape(value)
+    return res
+
+
+class IndexChecker(object):
+    """Detects queries that none of the declared indexes can serve.
+
+    Unindexed queries are counted by collection and query shape and,
+    if `warn` is set, logged as warnings. Set as MongoObject.INDEX_CHECKER
+    to check queries issued by find and find_one.
+    """
+
+    def __init__(self, warn=True):
+        self.warn = warn
+        self.checked = 0
+        self.unindexed = collections.Counter()
+        self._lock = threading.Lock()
+
+    def check(self, cls, spec):
+        indexes = [['_id']] + [index.fields for index in cls._INDEXES]
+        ok = not spec or can_use_index(spec, indexes)
+        collection_name = getattr(cls.collection, 'name', cls.__name__)
+        with self._lock:
+            self.checked += 1
+            if not ok:
+                key = (collection_name, json.dumps(query_shape(spec), sort_keys=True))
+                self.unindexed[key] += 1
+        if not ok and self.warn:
+            logger.warning('Query {0} on {1} can not use any of indexes {2}'.format(
+                spec, collection_name, indexes))
+        return ok
+
+    def reset(self):
+        with self._lock:
+            self.checked = 0
+            self.unindexed.clear()
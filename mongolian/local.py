@@ -0,0 +1,40 @@
+import threading
+import weakref
+
+
+_locals = weakref.WeakSet()
+
+
+class Local(threading.local):
+    """Thread-local storage whose state can be carried to other threads.
+
+    State of all Local instances of the current thread is captured by
+    `copy_context` and applied with `run_in_context`, so work handed
+    to worker threads sees the request context and identity maps
+    of the thread that issued it. Stored values are replaced, never
+    mutated in place, so threads sharing a context don't affect
+    each other. Objects referenced by the values (e.g. an identity map)
+    are shared and have to be thread-safe.
+    """
+
+    def __init__(self):
+        _locals.add(self)
+
+
+def copy_context():
+    return [(local, dict(local.__dict__)) for local in list(_locals)]
+
+
+def run_in_context(context, f, *args, **kwargs):
+    saved = copy_context()
+    _apply(context)
+    try:
+        return f(*args, **kwargs)
+    finally:
+        _apply(saved)
+
+
+def _apply(context):
+    for local, state in context:
+        local.__dict__.clear()
+        local.__dict__.update(state)
@@ -0,0 +1,138 @@
+import bisect
+import threading
+
+import pool
+
+
+# upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Histogram with fixed buckets, values above the last bound
+    are counted in the overflow bucket."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Returns upper bound of the bucket holding the q-quantile,
+        None for empty histogram or quantile in the overflow bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Series(object):
+    """Counters and histograms of requests on a database, collection and op."""
+
+    HISTOGRAMS = ('latency', 'socket_time', 'server_time')
+
+    def __init__(self, buckets):
+        self.messages = 0
+        self.errors = 0
+        self.documents = 0
+        self.bytes = 0
+        for name in self.HISTOGRAMS:
+            setattr(self, name, Histogram(buckets))
+
+    def snapshot(self):
+        res = {
+            'messages': self.messages,
+            'errors': self.errors,
+            'documents': self.documents,
+            'bytes': self.bytes,
+        }
+        for name in self.HISTOGRAMS:
+            res[name] = getattr(self, name).snapshot()
+        return res
+
+
+class MetricsRegistry(object):
+    """Request metrics keyed by database, collection and operation.
+
+    Registry is a pool request listener, use `enable` to start collecting
+    metrics of requests issued through pool.Collection:
+
+        registry = MetricsRegistry()
+        registry.enable()
+        ...
+        registry.snapshot()
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, context):
+        key = (context.database, context.collection, context.op)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = Series(self.buckets)
+            series.messages += 1
+            if context.error is not None:
+                series.errors += 1
+            if context.duration is not None:
+                series.latency.observe(context.duration)
+            series.socket_time.observe(context.socket_wait)
+            if context.server_time is not None:
+                series.server_time.observe(context.server_time)
+            if context.number_returned is not None:
+                series.documents += context.number_returned
+            if context.size is not None:
+                series.bytes += context.size
+
+    record = __call__
+
+    def enable(self):
+        pool.add_listener(self)
+
+    def disable(self):
+        pool.remove_listener(self)
+
+    def snapshot(self, reset=False):
+        """Returns list of series as dicts with database, collection
+        and op keys, resets the registry if `reset` is set."""
+        with self._lock:
+            res = []
+            for (database, collection, op), series in sorted(self._series.iteritems()):
+                entry = series.snapshot()
+                entry.update(database=database, collection=collection, op=op)
+                res.append(entry)
+            if reset:
+                self._series = {}
+        return res
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+
+registry = MetricsRegistry()
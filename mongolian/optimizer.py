@@ -0,0 +1,284 @@
+import numbers
+import operator
+
+import datatypes
+from condition import SimpleCondition, NAryCondition, UnaryCondition
+
+
+class ContradictionError(ValueError):
+    """Raised for conditions that can not match any document."""
+
+
+# range and contradiction checks are only valid for fields that can't hold
+# arrays, array elements can satisfy each bound independently
+SCALAR_TYPES = (datatypes.Int, datatypes.Float, datatypes.String, datatypes.Bool)
+
+LOWER_BOUNDS = ('$gt', '$gte')
+UPPER_BOUNDS = ('$lt', '$lte')
+
+
+def optimize(cond):
+    """Returns simplified condition equivalent to the given one.
+
+    Nested $and and $or conditions are flattened, duplicates are dropped,
+    $or of equalities on one field is turned into $in, range bounds
+    on scalar fields are merged. Raises ContradictionError if condition
+    can not match any document.
+    """
+    if isinstance(cond, datatypes.DataAccessor):
+        return SimpleCondition(cond.field, operator.truth, True)
+    if isinstance(cond, SimpleCondition):
+        return cond
+    if isinstance(cond, UnaryCondition):
+        child = cond.conditions[0]
+        try:
+            optimized = optimize(child)
+        except ContradictionError:
+            # negation of a contradiction can not be expressed
+            optimized = child
+        if optimized.field is None:
+            # $not requires single field condition
+            optimized = child
+        return UnaryCondition(cond.op, optimized)
+    if isinstance(cond, NAryCondition):
+        return _optimize_nary(cond)
+    raise TypeError('Cannot optimize object of type "{0}"'.format(
+        type(cond).__name__))
+
+
+def _optimize_nary(cond):
+    mongo_op = cond.mongo_op()
+    children = []
+    for c in cond.conditions:
+        try:
+            c = optimize(c)
+        except ContradictionError:
+            if mongo_op == '$or':
+                continue
+            raise
+        if type(c) is NAryCondition and c.mongo_op() == mongo_op:
+            children.extend(c.conditions)
+        else:
+            children.append(c)
+
+    if not children:
+        raise ContradictionError('None of $or conditions can match')
+
+    children = _unique(children)
+    if mongo_op == '$and':
+        children = _merge_and(children)
+    elif mongo_op == '$or':
+        children = _merge_or(children)
+
+    if len(children) == 1:
+        return children[0]
+    return NAryCondition(cond.op, *children)
+
+
+def _same(c1, c2):
+    if not isinstance(c1, SimpleCondition) or not isinstance(c2, SimpleCondition):
+        return c1 is c2
+    return (c1.field._map_key == c2.field._map_key and
+            c1.mongo_op() == c2.mongo_op() and
+            type(c1.value) is type(c2.value) and
+            c1.value == c2.value)
+
+
+def _unique(conditions):
+    res = []
+    for c in conditions:
+        if not any(_same(c, u) for u in res):
+            res.append(c)
+    return res
+
+
+def _group_by_field(conditions, accept):
+    """Returns list of conditions with accepted simple conditions
+    replaced by lists grouped by field."""
+    res = []
+    groups = {}
+    for c in conditions:
+        if isinstance(c, SimpleCondition) and accept(c):
+            key = c.field._map_key
+            if key not in groups:
+                groups[key] = []
+                res.append(groups[key])
+            groups[key].append(c)
+        else:
+            res.append(c)
+    return res
+
+
+def _merge_or(conditions):
+    res = []
+    for item in _group_by_field(conditions, lambda c: c.mongo_op() in ('$eq', '$in')):
+        if not isinstance(item, list):
+            res.append(item)
+            continue
+        if len(item) == 1:
+            res.append(item[0])
+            continue
+        values = []
+        seen = []
+        for c in item:
+            for value in (c.value if c.mongo_op() == '$in' else [c.value]):
+                # True and 1 are equal in python but not in mongodb
+                key = (type(value), value)
+                if key not in seen:
+                    seen.append(key)
+                    values.append(value)
+        res.append(SimpleCondition(item[0].field, operator.contains, values))
+    return res
+
+
+def _field_type(field):
+    if isinstance(field, datatypes.DataAccessor):
+        return field.field
+    return field
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def _comparable(v1, v2):
+    if _is_number(v1) and _is_number(v2):
+        return True
+    return type(v1) is type(v2) and isinstance(v1, (basestring, bool))
+
+
+def _equal(v1, v2):
+    # mongodb compares numbers and strings by value regardless of their
+    # python type, but never equates booleans with numbers
+    if _is_number(v1) and _is_number(v2):
+        return v1 == v2
+    if isinstance(v1, basestring) and isinstance(v2, basestring):
+        return v1 == v2
+    return type(v1) is type(v2) and v1 == v2
+
+
+def _contains(values, value):
+    return any(_equal(v, value) for v in values)
+
+
+def _merge_and(conditions):
+    res = []
+    accept = lambda c: isinstance(_field_type(c.field), SCALAR_TYPES)
+    for item in _group_by_field(conditions, accept):
+        if isinstance(item, list):
+            res.extend(_merge_field(item))
+        else:
+            res.append(item)
+    return res
+
+
+def _tighter(op, value, bound, lower):
+    # whether (op, value) bound is tighter than the current one
+    if value == bound:
+        return op in ('$gt', '$lt')
+    return value > bound if lower else value < bound
+
+
+def _matches_bound(value, op, bound):
+    return {'$gt': operator.gt,
+            '$gte': operator.ge,
+            '$lt': operator.lt,
+            '$lte': operator.le}[op](value, bound)
+
+
+def _merge_field(conditions):
+    """Merges conditions on a single scalar field."""
+    field = conditions[0].field
+    key = field._map_key
+    eq = []
+    ins = []
+    nes = []
+    lower = upper = None
+    exists = set()
+    rest = []
+
+    for c in conditions:
+        op = c.mongo_op()
+        if op == '$eq':
+            eq.append(c)
+        elif op == '$in':
+            ins.append(c)
+        elif op == '$ne':
+            nes.append(c)
+        elif op == '$exists':
+            exists.add(bool(c.value))
+        elif op in LOWER_BOUNDS or op in UPPER_BOUNDS:
+            is_lower = op in LOWER_BOUNDS
+            bound = lower if is_lower else upper
+            if bound is not None and not _comparable(c.value, bound.value):
+                rest.append(c)
+            elif bound is None or _tighter(op, c.value, bound.value, is_lower):
+                if is_lower:
+                    lower = c
+                else:
+                    upper = c
+        else:
+            rest.append(c)
+
+    if len(exists) > 1:
+        raise ContradictionError('Field {0} is required to exist and to be missing'.format(key))
+
+    if any(not _equal(c.value, eq[0].value) for c in eq[1:]):
+        raise ContradictionError('Field {0} can not be equal to {1}'.format(
+            key, ' and '.join(repr(c.value) for c in eq)))
+    eq = eq[:1]
+
+    if lower is not None and upper is not None and _comparable(lower.value, upper.value):
+        if (lower.value > upper.value or lower.value == upper.value and
+                (lower.mongo_op() == '$gt' or upper.mongo_op() == '$lt')):
+            raise ContradictionError('Field {0} has empty range'.format(key))
+        if lower.value == upper.value and not eq:
+            eq.append(SimpleCondition(field, operator.eq, lower.value))
+            lower = upper = None
+
+    if eq:
+        value = eq[0].value
+        for bound in (lower, upper):
+            if bound is None:
+                continue
+            if not _comparable(value, bound.value):
+                rest.append(bound)
+            elif not _matches_bound(value, bound.mongo_op(), bound.value):
+                raise ContradictionError('Field {0} equal to {1!r} does not '
+                    'match {2} {3!r}'.format(key, value, bound.mongo_op(), bound.value))
+        lower = upper = None
+
+        for c in ins:
+            if not _contains(c.value, value):
+                raise ContradictionError('Field {0} equal to {1!r} is not in '
+                    '{2!r}'.format(key, value, c.value))
+        ins = []
+
+        for c in nes:
+            if _equal(c.value, value):
+                raise ContradictionError('Field {0} is equal and not equal '
+                    'to {1!r}'.format(key, value))
+        nes = []
+
+    if len(ins) > 1:
+        values = [v for v in ins[0].value if all(_contains(c.value, v) for c in ins[1:])]
+        if not values:
+            raise ContradictionError('Field {0} $in conditions do not '
+                'intersect'.format(key))
+        ins = [SimpleCondition(field, operator.contains, values)]
+
+    # only null equality matches documents missing the field
+    matches_missing = (lower is None and upper is None and
+                       all(c.value is None for c in eq) and
+                       all(None in c.value for c in ins))
+    if False in exists and not matches_missing:
+        raise ContradictionError('Field {0} is required to be missing'.format(key))
+    if True in exists and not matches_missing:
+        # implied by other conditions
+        exists.discard(True)
+
+    res = eq + ins + nes
+    res.extend(c for c in (lower, upper) if c is not None)
+    res.extend(SimpleCondition(field, operator.truth, value) for value in exists)
+    res.extend(rest)
+    return res
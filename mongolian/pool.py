@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import functools
 import logging
 import pymongo
 import sys
@@ -6,6 +7,7 @@ import time
 import re
 import threading
 import traceback
+import weakref
 
 from copy import deepcopy
 import pymongo
@@ -13,89 +15,180 @@ from pymongo.collection import Collection as OriginalCollection
 from pymongo.errors import ConnectionFailure, OperationFailure, AutoReconnect
 from pymongo.mongo_replica_set_client import MongoReplicaSetClient as MRSC
 
+import local
+import metrics
+
 
 logger = logging.getLogger('mm.mongo')
 
 RE_SPLIT_PATH = re.compile('/')
 
-RE_SOCKET_TIME = re.compile("^(.*socket_time: )(\d+\.\d+)(.*)$")
-RE_REQUEST_NUMBER = re.compile("^(.*\.)(\d+)(.*)$")
+
+class RequestContext(object):
+    """Description of the database request issued in the current thread.
+
+    Filled as the request goes through the driver: `number` is the sequence
+    number of the last message sent for the request, `socket_time` is the
+    total time spent waiting for sockets and `socket_wait` the time spent
+    waiting for the socket of the last message, `server_time` is the round trip
+    time of the last message with a response, `number_returned` and `size`
+    describe the last response, `target` is the collection the request was
+    issued on. Log message is only formatted when the context is converted
+    to a string.
+    """
+
+    __slots__ = ('op', 'namespace', 'args', 'kwargs', 'read', 'number',
+                 'socket_time', 'socket_wait', 'server_time', 'number_returned', 'size',
+                 'duration', 'error', 'target')
+
+    def __init__(self, op, namespace, args=(), kwargs=None, read=None, target=None):
+        self.op = op
+        self.namespace = namespace
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.read = read
+        self.number = 0
+        self.socket_time = None
+        self.socket_wait = 0.0
+        self.server_time = None
+        self.number_returned = None
+        self.size = None
+        self.duration = None
+        self.error = None
+        self.target = target
+
+    @property
+    def database(self):
+        return self.namespace.split('.', 1)[0]
+
+    @property
+    def collection(self):
+        return self.namespace.split('.', 1)[-1]
+
+    def message(self):
+        if self.read is None:
+            call = '%s.%s(%s, %s)' % (self.namespace, self.op, self.args, self.kwargs)
+        else:
+            call = '%s.%s(%s, %s, read=%s)' % (self.namespace, self.op, self.args,
+                                                self.kwargs, self.read)
+        if self.op == 'find_one' and self.target is not None:
+            # find_one messages always started with the connection name
+            call = '%s.%s' % (self.target.database.connection.name, call)
+        msg = '%s.%d' % (call, self.number)
+        if self.socket_time is not None:
+            msg += ' socket_time: %.3f' % self.socket_time
+        return msg
+
+    __str__ = message
+
+    def __repr__(self):
+        return '<{0} {1}.{2} #{3}>'.format(type(self).__name__, self.namespace,
+                                           self.op, self.number)
 
 
 class Request(object):
     def __init__(self):
-        self.local = threading.local()
+        self.local = local.Local()
 
     @property
-    def request_message(self):
-        if getattr(self.local, 'request_message', None) is None:
-            self.local.request_message = ''
-        return self.local.request_message
+    def context(self):
+        return getattr(self.local, 'context', None)
 
-    @request_message.setter
-    def request_message(self, value):
-        self.local.request_message = value
+    @context.setter
+    def context(self, value):
+        self.local.context = value
 
     @property
-    def processing_time(self):
-        if getattr(self.local, 'processing_time', None) is None:
-            self.local.processing_time = None
-        return self.local.processing_time
-
-    @processing_time.setter
-    def processing_time(self, value):
-        self.local.processing_time = value
+    def request_message(self):
+        context = self.context
+        if context is None:
+            return ''
+        return context.message()
 
 
 request = Request()
 
-original_unpack_response = deepcopy(pymongo.helpers._unpack_response)
+# callables receiving RequestContext after each message sent to the database
+_listeners = []
+
+
+def add_listener(listener):
+    """Registers callable called with RequestContext of every completed message.
+
+    Listeners are called synchronously in the thread issuing the request
+    and should copy the attributes they need.
+    """
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
 
 
-def __set_request_message__(msg):
-    request.request_message = msg + '.0'
+def instrumentation_enabled():
+    return bool(_listeners) or logger.isEnabledFor(logging.DEBUG)
 
 
-def __get_request_message__():
-    try:
-        nose, number, tail = RE_REQUEST_NUMBER.match(request.request_message).groups()
-    except (AttributeError, ValueError):
-        return request.request_message
+def start_request(op, namespace, args=(), kwargs=None, read=None, target=None):
+    """Sets context of the request issued in the current thread.
+
+    Context is only created when there is someone to report it to.
+    """
+    if instrumentation_enabled():
+        request.context = RequestContext(op, namespace, args, kwargs, read, target)
     else:
-        request.request_message = nose + str(int(number) + 1) + tail
-        return request.request_message
+        request.context = None
+    return request.context
 
 
-def __set_processing_time__(t):
-    request.processing_time = t
+def _notify(context):
+    for listener in _listeners:
+        try:
+            listener(context)
+        except Exception:
+            logger.exception('Request listener {0!r} failed'.format(listener))
+    context.socket_wait = 0.0
 
 
-def __get_processing_time__():
-    result = request.processing_time
-    request.processing_time = None
-    return result
+original_unpack_response = deepcopy(pymongo.helpers._unpack_response)
 
 
 def log_request(f):
 
     def wrapper(*args, **kwargs):
+        context = request.context
+        if context is None:
+            try:
+                return f(*args, **kwargs)
+            except Exception, e:
+                logger.error('%s: %s, %s', e.__class__.__name__, e, traceback.format_exc())
+                raise
+
+        # left from the previous message if its response wasn't unpacked
+        context.server_time = None
         start = time.time()
         try:
             result = f(*args, **kwargs)
         except Exception, e:
-            delta = time.time() - start
-            msg = '%s %.3f' % (__get_request_message__(), delta)
-            error = '%s: %s, %s' % (e.__class__.__name__, e, traceback.format_exc())
-            logger.debug(msg)
-            logger.error(error)
+            context.number += 1
+            context.duration = time.time() - start
+            context.error = e
+            context.number_returned = context.size = None
+            logger.debug('%s %.3f', context, context.duration)
+            logger.error('%s: %s, %s', e.__class__.__name__, e, traceback.format_exc())
+            _notify(context)
             raise
         else:
             delta = time.time() - start
             if f.__name__ == '_send_message_with_response':
-                __set_processing_time__(delta)
+                # reported when the response is unpacked
+                context.server_time = delta
             else:
-                msg = '%s %.3f' % (__get_request_message__(), delta)
-                logger.debug(msg)
+                context.number += 1
+                context.duration = delta
+                context.server_time = context.number_returned = context.size = None
+                logger.debug('%s %.3f', context, delta)
+                _notify(context)
             return result
     return wrapper
 
@@ -104,34 +197,263 @@ def __unpack_response(*args, **kwargs):
     """Unpack a response from the database and log it.
     """
     result = original_unpack_response(*args, **kwargs)
-    delta = __get_processing_time__()
-    if delta is not None:
-        request_message = __get_request_message__()
-        if request_message:
-            request_message += ' '
-        msg = request_message + '%s %s %.3f' % (result.get('number_returned'), sys.getsizeof(result.get('data')), delta)
-        logger.debug(msg)
+    context = request.context
+    if context is not None and context.server_time is not None:
+        context.number += 1
+        context.duration = context.server_time
+        context.number_returned = result.get('number_returned')
+        context.size = sys.getsizeof(result.get('data'))
+        logger.debug('%s %s %s %.3f', context, context.number_returned,
+                     context.size, context.server_time)
+        _notify(context)
+        context.server_time = None
     return result
 pymongo.helpers._unpack_response = __unpack_response
 
 
+class PoolStats(object):
+    """Socket checkout statistics of a pool.
+
+    `wait` is time spent waiting for a free socket, `connect` is time
+    spent opening new connections, `checkout` is time sockets were held
+    by their users.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.wait = metrics.Histogram()
+            self.connect = metrics.Histogram()
+            self.checkout = metrics.Histogram()
+            self.resizes = 0
+
+    def observe(self, name, value):
+        with self._lock:
+            getattr(self, name).observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'wait': self.wait.snapshot(),
+                'connect': self.connect.snapshot(),
+                'checkout': self.checkout.snapshot(),
+                'resizes': self.resizes,
+            }
+
+
+class AdaptiveSizing(object):
+    """Policy resizing pools between `min_size` and `max_size` sockets.
+
+    Every `window` checkouts the share of checkouts that waited longer
+    than `wait_threshold` seconds is computed; the pool grows by `step`
+    if it is above `grow_above` and shrinks by `step` if it is below
+    `shrink_below`.
+    """
+
+    def __init__(self, min_size, max_size, step=5, window=100,
+                 wait_threshold=0.005, grow_above=0.1, shrink_below=0.01):
+        if not 0 < min_size <= max_size:
+            raise ValueError('Pool size bounds must satisfy 0 < min_size <= max_size')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.step = step
+        self.window = window
+        self.wait_threshold = wait_threshold
+        self.grow_above = grow_above
+        self.shrink_below = shrink_below
+
+    def size(self, current, contention):
+        if contention > self.grow_above:
+            return min(current + self.step, self.max_size)
+        if contention < self.shrink_below:
+            return max(current - self.step, self.min_size)
+        return current
+
+
+def _resize_semaphore(semaphore, delta):
+    """Changes number of permits of pymongo's bounded semaphore, returns
+    the actual change. Only free permits can be taken away.
+
+    Relies on private attributes of pymongo 2.x thread_util semaphores
+    (checked with pymongo 2.9.5): BoundedSemaphore's _value,
+    _initial_value and _cond, possibly wrapped by
+    MaxWaitersBoundedSemaphore as `semaphore`. Semaphores without them,
+    e.g. the gevent one, are left as they are and 0 is returned.
+    """
+    semaphore = getattr(semaphore, 'semaphore', semaphore)
+    if not hasattr(semaphore, '_initial_value'):
+        return 0
+    with semaphore._cond:
+        if delta < 0:
+            delta = -min(-delta, semaphore._value)
+        semaphore._value += delta
+        semaphore._initial_value += delta
+        if delta > 0:
+            semaphore._cond.notify(delta)
+    return delta
+
+
+# pools created by clients, see pool_stats
+_pools = weakref.WeakSet()
+
+
+def pool_stats():
+    """Returns statistics of live pools."""
+    res = []
+    for p in list(_pools):
+        entry = p.stats.snapshot()
+        entry.update(host='{0}:{1}'.format(*p.pair), max_size=p.max_size,
+                     idle=len(p.sockets))
+        res.append(entry)
+    return res
+
+
+def warm_up_pools():
+    """Opens idle sockets of live pools up to their min_size, returns
+    number of sockets opened."""
+    return sum(p.warm_up() for p in list(_pools))
+
+
 class CustomPool(pymongo.pool.Pool):
+    """Pool with checkout statistics, warm-up and optional adaptive sizing.
+
+    `min_size` sockets are opened by warm_up (see also warm_up_pools),
+    `sizing` is an AdaptiveSizing policy or None to keep pool size fixed.
+    A checkout lasts until the socket is returned to the pool, for
+    sockets bound to a request (see start_request of pymongo clients)
+    until the request ends.
+
+    Statistics are only collected while instrumentation is enabled
+    (see instrumentation_enabled), with adaptive sizing or if
+    `collect_stats` is set.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.min_size = kwargs.pop('min_size', 0)
+        self.sizing = kwargs.pop('sizing', None)
+        self.collect_stats = kwargs.pop('collect_stats', False)
+        pymongo.pool.Pool.__init__(self, *args, **kwargs)
+        self.stats = PoolStats()
+        self._connect_time = threading.local()
+        self._sizing_lock = threading.Lock()
+        self._window_checkouts = 0
+        self._window_waits = 0
+        _pools.add(self)
+
+    def warm_up(self):
+        """Opens idle sockets up to min_size, returns number of sockets opened."""
+        opened = 0
+        limit = self.min_size if self.max_size is None else min(self.min_size, self.max_size)
+        while len(self.sockets) < limit:
+            try:
+                sock_info = self.connect()
+            except Exception as e:
+                logger.warning('Failed to warm up pool of {0}:{1}: {2}'.format(
+                    self.pair[0], self.pair[1], e))
+                break
+            with self.lock:
+                self.sockets.add(sock_info)
+            opened += 1
+        return opened
+
+    def _collecting(self):
+        return self.collect_stats or self.sizing is not None or instrumentation_enabled()
+
+    def connect(self):
+        if not self._collecting():
+            return pymongo.pool.Pool.connect(self)
+        start = time.time()
+        result = pymongo.pool.Pool.connect(self)
+        delta = time.time() - start
+        self._connect_time.value = getattr(self._connect_time, 'value', 0.0) + delta
+        self.stats.observe('connect', delta)
+        return result
+
     def get_socket(self, *args, **kwargs):
+        context = request.context
+        if context is None and not self._collecting():
+            return pymongo.pool.Pool.get_socket(self, *args, **kwargs)
+        self._connect_time.value = 0.0
         start = time.time()
         result = pymongo.pool.Pool.get_socket(self, *args, **kwargs)
         delta = time.time() - start
-        try:
-            nose, sock_time, tail = RE_SOCKET_TIME.match(request.request_message).groups()
-        except (AttributeError, ValueError):
-            request.request_message += " socket_time: %.3f" % delta
-        else:
-            request.request_message = nose + '%.3f' % (float(sock_time) + delta) + tail
+        if getattr(result, 'checkout_start', None) is None:
+            # sockets bound to a request are checked out once
+            result.checkout_start = start
+            wait = max(delta - self._connect_time.value, 0.0)
+            self.stats.observe('wait', wait)
+            if self.sizing is not None:
+                self._observe_wait(wait)
+
+        if context is not None:
+            context.socket_time = (context.socket_time or 0.0) + delta
+            context.socket_wait += delta
         return result
 
+    def _observe_checkout(self, sock_info):
+        start = getattr(sock_info, 'checkout_start', None)
+        if start is None:
+            return
+        sock_info.checkout_start = None
+        if self._collecting():
+            self.stats.observe('checkout', time.time() - start)
+
+    def maybe_return_socket(self, sock_info):
+        if (sock_info not in (pymongo.pool.NO_REQUEST, pymongo.pool.NO_SOCKET_YET) and
+                sock_info != self._get_request_state()):
+            self._observe_checkout(sock_info)
+        pymongo.pool.Pool.maybe_return_socket(self, sock_info)
+
+    def end_request(self):
+        sock_info = self._get_request_state()
+        pymongo.pool.Pool.end_request(self)
+        if (sock_info not in (pymongo.pool.NO_REQUEST, pymongo.pool.NO_SOCKET_YET) and
+                self._get_request_state() == pymongo.pool.NO_REQUEST):
+            self._observe_checkout(sock_info)
+
+    def _observe_wait(self, wait):
+        sizing = self.sizing
+        with self._sizing_lock:
+            self._window_checkouts += 1
+            if wait > sizing.wait_threshold:
+                self._window_waits += 1
+            if self._window_checkouts < sizing.window:
+                return
+            contention = float(self._window_waits) / self._window_checkouts
+            self._window_checkouts = self._window_waits = 0
+        if self.max_size is not None:
+            self.resize(sizing.size(self.max_size, contention))
+
+    def resize(self, size):
+        """Sets maximum number of sockets, returns the new maximum. Pool
+        can't shrink below the number of sockets in use."""
+        with self._sizing_lock:
+            delta = _resize_semaphore(self._socket_semaphore, size - self.max_size)
+            if not delta:
+                return self.max_size
+            self.max_size += delta
+            waiters = getattr(self._socket_semaphore, 'waiter_semaphore', None)
+            if waiters is not None and self.wait_queue_multiple:
+                # waiters in the queue hold permits, the queue may shrink
+                # less than the pool until they are done
+                _resize_semaphore(waiters, delta * self.wait_queue_multiple)
+            with self.stats._lock:
+                self.stats.resizes += 1
+        logger.info('Pool of {0}:{1} resized to {2}'.format(
+            self.pair[0], self.pair[1], self.max_size))
+        return self.max_size
+
 
 class MongoReplicaSetClient(MRSC):
     def __init__(self, *args, **kwargs):
-        kwargs['_pool_class'] = CustomPool
+        kwargs['_pool_class'] = functools.partial(
+            CustomPool,
+            min_size=kwargs.pop('min_pool_size', 0),
+            sizing=kwargs.pop('pool_sizing', None),
+            collect_stats=kwargs.pop('collect_pool_stats', False))
         kwargs['read_preference'] = pymongo.ReadPreference.PRIMARY_PREFERRED
         super(MongoReplicaSetClient, self).__init__(*args, **kwargs)
 
@@ -154,34 +476,37 @@ def slave_read_status(kwargs, read_pref=None):
 
 
 class Collection(OriginalCollection):
+    def _start_request(self, op, args, kwargs, read=None):
+        start_request(op, self.full_name, args, kwargs, read, target=self)
+
     def update(self, *args, **kwargs):
-        request_message = '%s.%s.%s(%s, %s)' % (self.database.name, self.name, 'update', str(args), str(kwargs))
-        __set_request_message__(request_message)
+        self._start_request('update', args, kwargs)
         return super(Collection, self).update(*args, **kwargs)
 
     def insert(self, *args, **kwargs):
-        request_message = '%s.%s.%s(%s, %s)' % (self.database.name, self.name, 'insert', str(args), str(kwargs))
-        __set_request_message__(request_message)
+        self._start_request('insert', args, kwargs)
         return super(Collection, self).insert(*args, **kwargs)
 
+    def initialize_ordered_bulk_op(self, *args, **kwargs):
+        self._start_request('ordered_bulk_op', args, kwargs)
+        return super(Collection, self).initialize_ordered_bulk_op(*args, **kwargs)
+
+    def initialize_unordered_bulk_op(self, *args, **kwargs):
+        self._start_request('unordered_bulk_op', args, kwargs)
+        return super(Collection, self).initialize_unordered_bulk_op(*args, **kwargs)
+
     def find_and_modify(self, *args, **kwargs):
-        request_message = '%s.%s.%s(%s, %s)' % (self.database.name, self.name, 'find_and_modify', str(args), str(kwargs))
-        __set_request_message__(request_message)
+        self._start_request('find_and_modify', args, kwargs)
         return super(Collection, self).find_and_modify(*args, **kwargs)
 
     def remove(self, *args, **kwargs):
-        request_message = '%s.%s.%s(%s, %s)' % (self.database.name, self.name, 'remove', str(args), str(kwargs))
-        __set_request_message__(request_message)
+        self._start_request('remove', args, kwargs)
         return super(Collection, self).remove(*args, **kwargs)
 
     def find(self, *args, **kwargs):
-        request_message = '%s.%s.%s(%s, %s, read=%s)' % \
-            (self.database.name, self.name, 'find', str(args), str(kwargs), slave_read_status(kwargs))
-        __set_request_message__(request_message)
+        self._start_request('find', args, kwargs, slave_read_status(kwargs))
         return super(Collection, self).find(*args, **kwargs)
 
     def find_one(self, *args, **kwargs):
-        request_message = '%s.%s.%s.%s(%s, %s, read=%s)' % \
-            (self.database.connection.name, self.database.name, self.name, 'find_one', str(args), str(kwargs), slave_read_status(kwargs))
-        __set_request_message__(request_message)
+        self._start_request('find_one', args, kwargs, slave_read_status(kwargs))
         return super(Collection, self).find_one(*args, **kwargs)
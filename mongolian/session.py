@@ -0,0 +1,219 @@
+import logging
+
+from pymongo.errors import BulkWriteError
+
+from versioning import ConflictError
+
+
+logger = logging.getLogger('mm.mongo')
+
+
+class SaveResult(object):
+
+    def __init__(self, obj, error=None):
+        self.obj = obj
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<{0}, id: {1}, error: {2}>'.format(
+            type(self).__name__, self.obj.spec()['id'], self.error)
+
+
+class Session(object):
+    """Unit of work collecting dirty objects and saving them in bulk.
+
+    Objects are grouped by collection and sent as bulk write batches
+    of at most `batch_size` operations. Ordered batches stop on the first
+    failed write, the rest of the objects of the collection are reported
+    as not saved. Objects are marked clean only if their write succeeded.
+
+    Detached sessions mark objects clean as soon as their changes are
+    dumped, so objects can be changed while the session is written;
+    objects that failed to save, or were not written because flush
+    raised, are marked dirty again as a whole. Objects added with an
+    update dumped by the caller are not touched by the session at all,
+    the caller handles their results.
+
+    Versioned objects are written one by one, bulk write results
+    don't tell which of the updates matched.
+    """
+
+    DEFAULT_BATCH_SIZE = 1000
+
+    def __init__(self, ordered=True, batch_size=DEFAULT_BATCH_SIZE, detach=False):
+        if batch_size < 1:
+            raise ValueError('Batch size should be positive, '
+                             'got {0}'.format(batch_size))
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.detach = detach
+        self._objects = []
+        self._added = set()
+        self._updates = {}
+
+    def add(self, obj, update=None):
+        """Adds object to be saved on flush.
+
+        Detached sessions also accept an `update` document the caller
+        already dumped from the object (and marked it clean), it is
+        written instead of the object's changes. Versioned objects are
+        changed by their writes and can't be added with updates.
+        """
+        if update is not None and not self.detach:
+            raise ValueError('Dumped updates can only be added to detached sessions')
+        if update is not None and obj.VERSION_FIELD is not None:
+            raise ValueError('Versioned objects can not be added with dumped updates')
+        if id(obj) in self._added:
+            return
+        self._added.add(id(obj))
+        self._objects.append(obj)
+        if update is not None:
+            self._updates[id(obj)] = update
+
+    def add_all(self, objs):
+        for obj in objs:
+            self.add(obj)
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.clear()
+
+    def clear(self):
+        self._objects = []
+        self._added = set()
+        self._updates = {}
+
+    def flush(self):
+        """Saves all collected dirty objects.
+
+        Returns list of SaveResult objects for the objects that had
+        changes to write, grouped by collection (in the order collections
+        were first added), in the order objects were added within each
+        collection. Clean objects are left out.
+        """
+        by_collections = []
+        ops = {}
+        dumped = set(self._updates)
+        for obj in self._objects:
+            update = self._updates.get(id(obj))
+            if update is None:
+                if not obj._dirty:
+                    continue
+                update = obj.dump_changes()
+                if not update or self.detach:
+                    obj.make_clean()
+                if not update:
+                    continue
+            collection = obj.collection
+            key = id(collection)
+            if key not in ops:
+                ops[key] = []
+                by_collections.append(collection)
+            ops[key].append((obj, update))
+        self.clear()
+
+        results = {}
+        try:
+            for collection in by_collections:
+                failed = False
+                collection_ops = ops[id(collection)]
+                for i in xrange(0, len(collection_ops), self.batch_size):
+                    batch = collection_ops[i:i + self.batch_size]
+                    if failed:
+                        for obj, _ in batch:
+                            results[id(obj)] = SaveResult(obj, 'not executed')
+                        continue
+                    for res in self._execute_batch(collection, batch):
+                        results[id(res.obj)] = res
+                        if not res.ok and self.ordered:
+                            failed = True
+        except Exception:
+            for collection in by_collections:
+                for obj, _ in ops[id(collection)]:
+                    if id(obj) not in dumped:
+                        self._finish(obj, results.get(id(obj)))
+            raise
+
+        res = []
+        for collection in by_collections:
+            for obj, _ in ops[id(collection)]:
+                result = results[id(obj)]
+                if id(obj) not in dumped:
+                    self._finish(obj, result)
+                res.append(result)
+        return res
+
+    def _finish(self, obj, result):
+        if result is not None and result.ok:
+            obj.saved(clean=not self.detach)
+        elif self.detach:
+            # detached objects are clean, their changes would be lost
+            obj.make_dirty()
+
+    def _execute_batch(self, collection, batch):
+        if any(obj.VERSION_FIELD is not None for obj, _ in batch):
+            return self._execute_versioned(batch)
+
+        if self.ordered:
+            bulk = collection.initialize_ordered_bulk_op()
+        else:
+            bulk = collection.initialize_unordered_bulk_op()
+
+        for obj, update in batch:
+            op = bulk.find(obj.spec()).upsert()
+            if not any(key.startswith('$') for key in update):
+                op.replace_one(update)
+            else:
+                op.update_one(update)
+
+        errors = {}
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            logger.error('Bulk save failed partially: {0}'.format(e.details))
+            for error in e.details.get('writeErrors', []):
+                errors[error['index']] = error.get('errmsg', error)
+            if e.details.get('writeConcernErrors'):
+                # write concern errors are not bound to operations
+                return [SaveResult(obj, e.details['writeConcernErrors'])
+                        for obj, _ in batch]
+
+        results = []
+        failed = False
+        for idx, (obj, _) in enumerate(batch):
+            if idx in errors:
+                failed = True
+                results.append(SaveResult(obj, errors[idx]))
+            elif failed and self.ordered:
+                results.append(SaveResult(obj, 'not executed'))
+            else:
+                results.append(SaveResult(obj))
+        return results
+
+    def _execute_versioned(self, batch):
+        results = []
+        failed = False
+        for obj, update in batch:
+            if failed:
+                results.append(SaveResult(obj, 'not executed'))
+                continue
+            try:
+                obj.write(update)
+            except ConflictError as e:
+                failed = self.ordered
+                results.append(SaveResult(obj, e))
+            else:
+                results.append(SaveResult(obj))
+        return results
@@ -0,0 +1,181 @@
+import Queue
+import collections
+import json
+import logging
+import random
+import threading
+import time
+
+import indexes
+import pool
+
+
+logger = logging.getLogger('mm.mongo')
+
+# operations whose first argument is a query that can be explained
+EXPLAINED_OPS = frozenset(['find', 'find_one'])
+
+
+def _query(context):
+    spec = context.kwargs.get('spec')
+    if spec is None and context.args:
+        spec = context.args[0]
+    if spec is None:
+        spec = {}
+    return spec if isinstance(spec, dict) else None
+
+
+def _cursor_options(context):
+    # sort, skip and limit affect the plan chosen for the query
+    options = dict((key, context.kwargs[key]) for key in ('sort', 'skip', 'limit')
+                   if context.kwargs.get(key))
+    if context.op == 'find_one':
+        options['limit'] = 1
+    return options
+
+
+def _find_stage(plan, stage):
+    if not isinstance(plan, dict):
+        return None
+    if plan.get('stage') == stage:
+        return plan
+    for key in ('inputStage', 'shards'):
+        found = _find_stage(plan.get(key), stage)
+        if found is not None:
+            return found
+    for sub in plan.get('inputStages', ()):
+        found = _find_stage(sub, stage)
+        if found is not None:
+            return found
+    return None
+
+
+def summarize_explain(explain):
+    """Returns index used, documents and keys examined and documents returned
+    from explain output of MongoDB 2.x or 3.x+ servers."""
+    if 'queryPlanner' in explain:
+        stats = explain.get('executionStats', {})
+        ixscan = _find_stage(explain['queryPlanner'].get('winningPlan'), 'IXSCAN')
+        return {
+            'index': ixscan.get('indexName') if ixscan is not None else None,
+            'docs_examined': stats.get('totalDocsExamined'),
+            'keys_examined': stats.get('totalKeysExamined'),
+            'returned': stats.get('nReturned'),
+        }
+    cursor = explain.get('cursor', '')
+    return {
+        'index': cursor.split(' ', 1)[1] if cursor.startswith('BtreeCursor ') else None,
+        'docs_examined': explain.get('nscannedObjects'),
+        'keys_examined': explain.get('nscanned'),
+        'returned': explain.get('n'),
+    }
+
+
+class SlowQueryLog(object):
+    """Records operations slower than `threshold` seconds.
+
+    A `sample_rate` fraction of slow operations is recorded into a ring
+    buffer of `maxlen` entries with the query shape, and for queries
+    the summary of their explain output is fetched by a background
+    thread. SlowQueryLog is a pool request listener:
+
+        slowlog = SlowQueryLog(threshold=0.1, sample_rate=0.5)
+        slowlog.enable()
+        ...
+        slowlog.dump()
+    """
+
+    def __init__(self, threshold=0.1, sample_rate=1.0, maxlen=1000,
+                 explain=True, explain_queue_size=100):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.explain = explain
+        self._entries = collections.deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue(maxsize=explain_queue_size)
+        self._worker = None
+        self.dropped_explains = 0
+
+    def __call__(self, context):
+        if context.duration is None or context.duration < self.threshold:
+            return
+        if self._worker is not None and threading.current_thread() is self._worker:
+            # requests issued by explain itself
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+
+        spec = _query(context)
+        entry = {
+            'time': time.time(),
+            'namespace': context.namespace,
+            'op': context.op,
+            'number': context.number,
+            'duration': context.duration,
+            'socket_time': context.socket_wait,
+            'server_time': context.server_time,
+            'returned': context.number_returned,
+            'error': repr(context.error) if context.error is not None else None,
+            'shape': json.dumps(indexes.query_shape(spec), sort_keys=True)
+                     if spec is not None else None,
+            'explain': None,
+        }
+        with self._lock:
+            self._entries.append(entry)
+
+        if (self.explain and context.op in EXPLAINED_OPS and
+                spec is not None and context.target is not None):
+            self._explain_later(entry, context.target, spec,
+                                _cursor_options(context))
+
+    record = __call__
+
+    def _explain_later(self, entry, collection, spec, options):
+        self._start_worker()
+        try:
+            self._queue.put_nowait((entry, collection, spec, options))
+        except Queue.Full:
+            with self._lock:
+                self.dropped_explains += 1
+
+    def _start_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                worker = threading.Thread(target=self._run, name='slowlog-explain')
+                worker.daemon = True
+                self._worker = worker
+                worker.start()
+
+    def _run(self):
+        while True:
+            entry, collection, spec, options = self._queue.get()
+            try:
+                summary = summarize_explain(collection.find(spec, **options).explain())
+            except Exception as e:
+                logger.warning('Failed to explain query on {0}: {1}'.format(
+                    entry['namespace'], e))
+                summary = {'error': repr(e)}
+            with self._lock:
+                entry['explain'] = summary
+            self._queue.task_done()
+
+    def wait(self):
+        """Waits until pending explains are fetched."""
+        self._queue.join()
+
+    def dump(self):
+        """Returns copies of recorded entries, oldest first."""
+        with self._lock:
+            return [dict(entry) for entry in self._entries]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def enable(self):
+        pool.add_listener(self)
+
+    def disable(self):
+        pool.remove_listener(self)
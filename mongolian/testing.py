@@ -0,0 +1,277 @@
+"""In-memory stand-in for pymongo collections.
+
+Supports the subset of the collection interface used by mongolian:
+find, find_one, insert, update, remove, bulk operations and indexes.
+Queries are matched with evaluator.match_query.
+"""
+import copy
+import itertools
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import evaluator
+
+
+def _project(doc, fields):
+    if fields is None:
+        return copy.deepcopy(doc)
+    include_id = fields.get('_id', True)
+    res = dict((key, copy.deepcopy(value)) for key, value in doc.iteritems()
+               if key != '_id' and fields.get(key))
+    if include_id and '_id' in doc:
+        res['_id'] = doc['_id']
+    return res
+
+
+def _sort_key(sort):
+    def key(doc):
+        return [doc.get(field) for field, _ in sort]
+    return key
+
+
+class MemoryCursor(object):
+
+    def __init__(self, collection, spec, fields=None, sort=None, limit=0, skip=0):
+        self.collection = collection
+        self.spec = spec
+        self.fields = fields
+        self._sort = list(sort or [])
+        self._limit = limit
+        self._skip = skip
+        self._batch_size = 0
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size
+        return self
+
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = list(key_or_list)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def _matched(self):
+        docs = [doc for doc in self.collection.docs
+                if evaluator.match_query(self.spec, doc)]
+        for field, direction in reversed(self._sort):
+            docs.sort(key=_sort_key([(field, direction)]), reverse=direction < 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return docs
+
+    def __iter__(self):
+        self.collection.queries.append(self.spec)
+        for doc in self._matched():
+            yield _project(doc, self.fields)
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(self._matched())
+        return sum(1 for doc in self.collection.docs
+                   if evaluator.match_query(self.spec, doc))
+
+    def explain(self):
+        matched = self._matched()
+        return {
+            'cursor': 'BasicCursor',
+            'n': len(matched),
+            'nscanned': len(self.collection.docs),
+            'nscannedObjects': len(self.collection.docs),
+        }
+
+
+class MemoryBulk(object):
+
+    def __init__(self, collection, ordered):
+        self.collection = collection
+        self.ordered = ordered
+        self.ops = []
+
+    def find(self, spec):
+        return _BulkFind(self, spec)
+
+    def insert(self, doc):
+        self.ops.append(('insert', None, doc, False))
+
+    def execute(self):
+        result = {'nInserted': 0, 'nMatched': 0, 'nUpserted': 0,
+                  'writeErrors': [], 'writeConcernErrors': []}
+        for idx, (op, spec, doc, upsert) in enumerate(self.ops):
+            try:
+                if op == 'insert':
+                    self.collection.insert(doc)
+                    result['nInserted'] += 1
+                else:
+                    res = self.collection.update(spec, doc, upsert=upsert)
+                    if res['updatedExisting']:
+                        result['nMatched'] += res['n']
+                    else:
+                        result['nUpserted'] += res['n']
+            except Exception as e:
+                result['writeErrors'].append({'index': idx, 'errmsg': str(e)})
+                if self.ordered:
+                    break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return result
+
+
+class _BulkFind(object):
+
+    def __init__(self, bulk, spec, upsert=False):
+        self.bulk = bulk
+        self.spec = spec
+        self._upsert = upsert
+
+    def upsert(self):
+        return _BulkFind(self.bulk, self.spec, upsert=True)
+
+    def update_one(self, doc):
+        self.bulk.ops.append(('update', self.spec, doc, self._upsert))
+
+    def replace_one(self, doc):
+        self.bulk.ops.append(('update', self.spec, doc, self._upsert))
+
+
+def _apply_update(doc, update):
+    if not any(key.startswith('$') for key in update):
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if _id is not None:
+            doc['_id'] = _id
+        return
+
+    for op, fields in update.iteritems():
+        for key, value in fields.iteritems():
+            value = copy.deepcopy(value)
+            if op == '$set':
+                doc[key] = value
+            elif op == '$unset':
+                doc.pop(key, None)
+            elif op == '$inc':
+                doc[key] = doc.get(key, 0) + value
+            elif op in ('$push', '$addToSet'):
+                values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                items = doc.setdefault(key, [])
+                for value in values:
+                    if op == '$push' or value not in items:
+                        items.append(value)
+            elif op == '$pull':
+                if key in doc:
+                    doc[key] = [item for item in doc[key]
+                                if not evaluator.match_query({'v': value}, {'v': item})]
+            else:
+                raise ValueError('Unsupported update operator {0}'.format(op))
+
+
+class MemoryCollection(object):
+    """In-memory collection with pymongo 2.x style write results."""
+
+    def __init__(self, name='collection', database='test'):
+        self.name = name
+        self.database_name = database
+        self.docs = []
+        self.indexes = {}
+        self.queries = []
+        self._ids = itertools.count(1)
+
+    @property
+    def full_name(self):
+        return '{0}.{1}'.format(self.database_name, self.name)
+
+    def _check_unique(self, doc, exclude=None):
+        for name, (keys, options) in self.indexes.iteritems():
+            if not options.get('unique'):
+                continue
+            fields = [field for field, _ in keys]
+            values = [doc.get(field) for field in fields]
+            for other in self.docs:
+                if other is exclude:
+                    continue
+                if [other.get(field) for field in fields] == values:
+                    raise DuplicateKeyError('E11000 duplicate key error index: '
+                                            '{0}.${1}'.format(self.full_name, name))
+
+    def insert(self, doc_or_docs, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        ids = []
+        for doc in docs:
+            doc.setdefault('_id', next(self._ids))
+            self._check_unique(doc)
+            self.docs.append(copy.deepcopy(doc))
+            ids.append(doc['_id'])
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        n = 0
+        for doc in self.docs:
+            if not evaluator.match_query(spec, doc):
+                continue
+            updated = copy.deepcopy(doc)
+            _apply_update(updated, document)
+            self._check_unique(updated, exclude=doc)
+            doc.clear()
+            doc.update(updated)
+            n += 1
+            if not multi:
+                break
+        if n:
+            return {'ok': 1, 'n': n, 'updatedExisting': True}
+        if not upsert:
+            return {'ok': 1, 'n': 0, 'updatedExisting': False}
+
+        doc = dict((key, copy.deepcopy(value)) for key, value in spec.iteritems()
+                   if not key.startswith('$') and not evaluator._is_operators(value))
+        _apply_update(doc, document)
+        self.insert(doc)
+        return {'ok': 1, 'n': 1, 'updatedExisting': False, 'upserted': doc['_id']}
+
+    def remove(self, spec=None, multi=True, **kwargs):
+        spec = spec or {}
+        removed = [doc for doc in self.docs if evaluator.match_query(spec, doc)]
+        if not multi:
+            removed = removed[:1]
+        for doc in removed:
+            self.docs.remove(doc)
+        return {'ok': 1, 'n': len(removed)}
+
+    def find(self, spec=None, fields=None, sort=None, limit=0, skip=0, **kwargs):
+        return MemoryCursor(self, spec or {}, fields=fields, sort=sort,
+                            limit=limit, skip=skip)
+
+    def find_one(self, spec=None, fields=None, **kwargs):
+        for doc in self.find(spec, fields=fields, limit=1, **kwargs):
+            return doc
+        return None
+
+    def initialize_ordered_bulk_op(self):
+        return MemoryBulk(self, ordered=True)
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulk(self, ordered=False)
+
+    def create_index(self, keys, **options):
+        if isinstance(keys, basestring):
+            keys = [(keys, 1)]
+        name = options.pop('name', None) or '_'.join(
+            '{0}_{1}'.format(field, direction) for field, direction in keys)
+        self.indexes[name] = (list(keys), options)
+        return name
+
+    ensure_index = create_index
+
+    def index_information(self):
+        info = {'_id_': {'key': [('_id', 1)]}}
+        for name, (keys, options) in self.indexes.iteritems():
+            info[name] = dict(options, key=keys)
+        return info
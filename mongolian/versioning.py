@@ -0,0 +1,71 @@
+class ConflictError(RuntimeError):
+    """Raised when a versioned object was changed or removed since it was loaded.
+
+    `current` is the document stored in the database at the time of the
+    conflict or None if there is no such document.
+    """
+
+    def __init__(self, obj, expected, current):
+        self.obj = obj
+        self.expected = expected
+        self.current = current
+        super(ConflictError, self).__init__(
+            'Object {0} with id {1} was changed: expected version {2}, '
+            'found {3}'.format(type(obj).__name__, obj.spec()['id'], expected,
+                               current.get(obj.VERSION_FIELD) if current is not None else None))
+
+
+def rebase(obj, doc):
+    """Loads the document into the object and applies its local changes again.
+
+    Changed fields keep their local values, queued atomic operators are
+    queued again over the loaded values.
+    """
+    if obj._full_dump:
+        raise ValueError('Changes of object with id {0} can not be rebased, '
+                         'it is saved as a whole'.format(obj.spec()['id']))
+    changed = []
+    for map_key in obj._dirty_fields:
+        field = obj._MAP_KEYS[map_key]
+        changed.append((field, obj._DESCRIPTORS[field].dump(obj)))
+    ops = [(obj._MAP_KEYS[map_key], op, value)
+           for map_key, (op, value) in obj._pending_ops.iteritems()]
+
+    obj.load(doc)
+    for field, value in changed:
+        setattr(obj, field, value)
+    for field, op, value in ops:
+        accessor = getattr(obj, field)
+        if op == '$inc':
+            accessor.inc(value)
+        elif op == '$push':
+            accessor.push(*value)
+        elif op == '$addToSet':
+            accessor.add_to_set(*value)
+        elif op == '$pull':
+            accessor.pull(*value)
+    return obj
+
+
+def retry_merge(obj, change=None, retries=3):
+    """Saves versioned object, merging its changes on conflicts.
+
+    If `change` is given, it is called with the object before every
+    attempt, and on conflict the object is reloaded from the current
+    document. Otherwise local changes of the object are rebased onto
+    the current document. Raises ConflictError if the object could not
+    be saved in `retries` retries or was removed.
+    """
+    for attempt in xrange(retries + 1):
+        if change is not None:
+            change(obj)
+        try:
+            obj.save()
+            return obj
+        except ConflictError as e:
+            if attempt == retries or e.current is None:
+                raise
+            if change is not None:
+                obj.load(e.current)
+            else:
+                rebase(obj, e.current)
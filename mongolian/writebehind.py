@@ -0,0 +1,325 @@
+import collections
+import copy
+import logging
+import threading
+import time
+
+import cache
+from session import SaveResult, Session
+
+
+logger = logging.getLogger('mm.mongo')
+
+
+class QueueFull(RuntimeError):
+    """Raised when an object can't be queued within the timeout."""
+
+
+def _is_operators(update):
+    return any(key.startswith('$') for key in update)
+
+
+def _merge_updates(first, second):
+    """Returns update document with the effect of applying both updates
+    in order, or None if they can't be combined."""
+    if not _is_operators(second):
+        return second
+    if not _is_operators(first):
+        doc = dict(first)
+        for op, fields in second.iteritems():
+            for field, value in fields.iteritems():
+                if op == '$set':
+                    doc[field] = value
+                elif op == '$unset':
+                    doc.pop(field, None)
+                elif op == '$inc':
+                    doc[field] = (doc.get(field) or 0) + value
+                else:
+                    return None
+        return doc
+
+    res = dict((op, dict(fields)) for op, fields in first.iteritems())
+    for op, fields in second.iteritems():
+        for field, value in fields.iteritems():
+            ops = [o for o, o_fields in res.iteritems() if field in o_fields]
+            if op in ('$set', '$unset'):
+                for o in ops:
+                    del res[o][field]
+            elif ops == ['$inc'] and op == '$inc':
+                value += res[op][field]
+            elif ops:
+                return None
+            res.setdefault(op, {})[field] = value
+    return dict((op, fields) for op, fields in res.iteritems() if fields)
+
+
+class _Entry(object):
+
+    __slots__ = ('obj', 'update', 'doc', 'attempts', 'retry_at')
+
+    def __init__(self, obj, update, doc):
+        self.obj = obj
+        self.update = update
+        # document put to the object cache once the update is written
+        self.doc = doc
+        self.attempts = 0
+        self.retry_at = None
+
+
+class WriteBehindQueue(object):
+    """Queue writing saved objects in the background.
+
+    Set as MongoObject.WRITE_BEHIND to make `save` queue objects instead
+    of writing them. Changes are dumped by `add` in the saving thread
+    and the object is marked clean, the background thread never touches
+    queued objects. Pending objects are coalesced by class and id: saving
+    an already queued object again merges its new changes into the queued
+    update (or queues the whole document). A background thread writes
+    pending objects with a single detached Session every `interval`
+    seconds or as soon as `flush_count` objects are pending.
+
+    At most `max_pending` objects are pending or being written, `add`
+    blocks until there is room or raises QueueFull after `timeout`
+    seconds. Failed writes are queued again and retried up to
+    `max_retries` times, waiting `retry_delay` seconds before the first
+    retry and twice as long before every next one. Objects that still
+    failed are passed to `on_error` with their SaveResult; they stay
+    clean, save them as a whole (see make_dirty) to write them again.
+    Changes are only durable after `flush` or `shutdown` returns.
+    Versioned objects can't be written behind, their conflicts have
+    to be handled by the saving code.
+    """
+
+    def __init__(self, interval=1.0, flush_count=100, max_pending=10000,
+                 timeout=None, ordered=True, batch_size=Session.DEFAULT_BATCH_SIZE,
+                 on_error=None, max_retries=3, retry_delay=1.0):
+        if not 0 < flush_count <= max_pending:
+            raise ValueError('Queue sizes must satisfy 0 < flush_count <= max_pending')
+        self.interval = interval
+        self.flush_count = flush_count
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.on_error = on_error
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._pending = collections.OrderedDict()
+        self._count = 0
+        self._retrying = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+        self.queued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.retried = 0
+        self.failed = 0
+
+    def add(self, obj, update=None):
+        """Queues changes of the object, `update` is the update document
+        if the caller already dumped it."""
+        if obj.VERSION_FIELD is not None:
+            raise ValueError('Versioned objects can not be written behind')
+        if update is None:
+            update = obj.dump_changes()
+        if not update:
+            obj.make_clean()
+            return
+        # values are shared with the object, which can change them
+        update = copy.deepcopy(update)
+        doc = obj.dump() if obj.CACHE is not None and not obj.partial else None
+        key = (type(obj), obj.spec()['id'])
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Write-behind queue is shut down')
+            entries = self._pending.get(key, ())
+            entry = next((entry for entry in reversed(entries) if entry.obj is obj), None)
+            if entry is not None:
+                merged = _merge_updates(entry.update, update)
+                if merged is None:
+                    obj.make_dirty()
+                    merged = copy.deepcopy(obj.dump_changes())
+                entry.update = merged
+                entry.doc = doc
+                obj.make_clean()
+                self.coalesced += 1
+                return
+            self._wait_for_room()
+            # other instances with the same id are written in save order
+            self._pending.setdefault(key, []).append(_Entry(obj, update, doc))
+            obj.make_clean()
+            self._count += 1
+            self.queued += 1
+            if self._count - self._retrying >= self.flush_count:
+                self._cond.notify_all()
+        identity_map = cache.current_identity_map()
+        if identity_map is not None:
+            identity_map.add(obj)
+        self._start()
+
+    def _wait_for_room(self):
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        while self._count >= self.max_pending:
+            self._cond.notify_all()
+            if deadline is None:
+                self._cond.wait()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise QueueFull('{0} objects are pending'.format(self._count))
+            self._cond.wait(remaining)
+
+    def __len__(self):
+        return self._count
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._cond:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name='mongolian-write-behind')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.time() + self.interval
+                while (not self._closed and
+                       self._count - self._retrying < self.flush_count):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    break
+            try:
+                self._flush(time.time())
+            except Exception:
+                logger.exception('Write-behind flush failed')
+        self._drain()
+
+    def _drain(self):
+        # writes pending objects until all of them are written or failed
+        while True:
+            with self._cond:
+                if not self._count:
+                    return
+                retry_at = min([entry.retry_at or 0
+                                for entries in self._pending.itervalues()
+                                for entry in entries] or [0])
+            delay = retry_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._flush(time.time())
+            except Exception:
+                logger.exception('Write-behind flush failed')
+
+    def _take(self, now):
+        # entries of a key are written in order, an entry waiting for
+        # retry holds back the following ones
+        taken = []
+        taken_objs = set()
+        for key, entries in self._pending.items():
+            idx = 0
+            for entry in entries:
+                if id(entry.obj) in taken_objs:
+                    break
+                if now is not None and entry.retry_at is not None and entry.retry_at > now:
+                    break
+                if entry.retry_at is not None:
+                    entry.retry_at = None
+                    self._retrying -= 1
+                taken.append((key, entry))
+                taken_objs.add(id(entry.obj))
+                idx += 1
+            if idx == len(entries):
+                del self._pending[key]
+            else:
+                del entries[:idx]
+        return taken
+
+    def _retry(self, failed):
+        # failed entries are put back in front of newer entries of their keys
+        give_up = []
+        with self._cond:
+            for key, entry, res in reversed(failed):
+                entry.attempts += 1
+                if entry.attempts > self.max_retries:
+                    give_up.append((key, res))
+                    continue
+                entry.retry_at = time.time() + self.retry_delay * 2 ** (entry.attempts - 1)
+                entries = self._pending.pop(key, [])
+                entries.insert(0, entry)
+                self._pending[key] = entries
+                self._retrying += 1
+                self.retried += 1
+            self._count -= len(give_up)
+            self.failed += len(give_up)
+            self._cond.notify_all()
+        for key, res in reversed(give_up):
+            if key[0].CACHE is not None:
+                key[0].CACHE.invalidate(*key)
+            if self.on_error is not None:
+                self.on_error(res)
+            else:
+                logger.error('Write-behind save failed: {0}'.format(res))
+
+    def flush(self):
+        """Writes all pending objects, including the ones waiting for
+        retry, returns list of SaveResult."""
+        return self._flush(None)
+
+    def _flush(self, now):
+        with self._flush_lock:
+            with self._cond:
+                taken = self._take(now)
+            if not taken:
+                return []
+            try:
+                session = Session(ordered=self.ordered, batch_size=self.batch_size,
+                                  detach=True)
+                for _, entry in taken:
+                    session.add(entry.obj, entry.update)
+                results = session.flush()
+            except Exception as e:
+                self._retry([(key, entry, SaveResult(entry.obj, e)) for key, entry in taken])
+                raise
+
+            by_objs = dict((id(res.obj), res) for res in results)
+            failed = []
+            for key, entry in taken:
+                res = by_objs[id(entry.obj)]
+                if not res.ok:
+                    failed.append((key, entry, res))
+                elif entry.doc is not None:
+                    entry.obj.CACHE.put(key[0], key[1], entry.doc)
+            with self._cond:
+                self._count -= len(taken) - len(failed)
+                self.written += len(taken) - len(failed)
+                self._cond.notify_all()
+            self._retry(failed)
+        return results
+
+    def shutdown(self, wait=True):
+        """Stops accepting objects and writes the pending ones, retrying
+        failed writes."""
+        with self._cond:
+            self._closed = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is None:
+            self._drain()
+        elif wait:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown()
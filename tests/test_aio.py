@@ -0,0 +1,128 @@
+import threading
+
+import pytest
+
+from mongolian import MongoObject, aio, pool
+from mongolian.cache import IdentityMap, current_identity_map
+from mongolian.datatypes import Int, String
+from mongolian.testing import MemoryCollection
+
+
+@pytest.fixture
+def mongo_object_type():
+
+    class MongoObjectType(MongoObject):
+        id = String()
+        status = String()
+        n = Int()
+
+        collection = MemoryCollection('jobs')
+
+    return MongoObjectType
+
+
+@pytest.fixture(params=['immediate', 'threads'])
+def driver(request):
+    if request.param == 'immediate':
+        yield aio.ImmediateDriver()
+    else:
+        driver = aio.ThreadDriver(workers=2)
+        yield driver
+        driver.shutdown()
+
+
+class TestFuture(object):
+
+    def test_result(self):
+        f = aio.Future()
+        called = []
+        f.add_done_callback(called.append)
+        assert not f.done()
+        with pytest.raises(RuntimeError):
+            f.result(timeout=0)
+        f.set_result(1)
+        assert f.result() == 1
+        assert called == [f]
+        f.add_done_callback(called.append)
+        assert called == [f, f]
+
+    def test_gather(self):
+        futures = [aio.Future() for _ in xrange(3)]
+        res = aio.gather(futures)
+        for i, f in enumerate(reversed(futures)):
+            f.set_result(i)
+        assert res.result() == [2, 1, 0]
+
+        futures = [aio.Future(), aio.Future()]
+        res = aio.gather(futures)
+        futures[0].set_exception(ValueError('failed'))
+        futures[1].set_result(1)
+        with pytest.raises(ValueError):
+            res.result()
+        assert aio.gather([]).result() == []
+
+
+class TestOperations(object):
+
+    def test_save_and_find(self, mongo_object_type, driver):
+        t = mongo_object_type
+        objs = [t.new(id=str(i), status='new', n=i) for i in xrange(3)]
+        assert aio.gather(aio.save(obj, driver=driver) for obj in objs[:2]).result() == objs[:2]
+        results = aio.save_many(objs[2:], driver=driver).result()
+        assert [r.ok for r in results] == [True]
+
+        found = aio.find(t, t.n > 0, sort=[(t.n, 1)], driver=driver).result()
+        assert [o.raw('n') for o in found] == [1, 2]
+        assert aio.find_one(t, t.id == '1', driver=driver).result().raw('n') == 1
+        assert aio.find_one(t, t.id == '5', driver=driver).result() is None
+
+        streamed = []
+        assert aio.stream(t, t.status == 'new', streamed.append, driver=driver).result() == 3
+        assert sorted(o.raw('n') for o in streamed) == [0, 1, 2]
+
+    def test_errors(self, mongo_object_type, driver):
+        t = mongo_object_type
+        t.collection.create_index([('n', 1)], unique=True)
+        t.new(id='a', n=1).save()
+        f = aio.save(t.new(id='b', n=1), driver=driver)
+        assert f.exception() is not None
+        with pytest.raises(Exception):
+            f.result()
+
+
+class TestContext(object):
+
+    def test_propagation(self, mongo_object_type):
+        t = mongo_object_type
+        t.new(id='a', n=1).save()
+        driver = aio.ThreadDriver(workers=1)
+        try:
+            with IdentityMap() as identity_map:
+                def check():
+                    assert threading.current_thread().name.startswith('mongolian-aio')
+                    return current_identity_map()
+                assert driver.submit(check).result() is identity_map
+
+                obj = aio.find_one(t, t.id == 'a', driver=driver).result()
+                assert t.find_one(t.id == 'a') is obj
+
+            # worker state is restored after the call
+            assert driver.submit(current_identity_map).result() is None
+            assert driver.submit(lambda: pool.request.context).result() is None
+        finally:
+            driver.shutdown()
+
+    def test_shared_identity_map(self, mongo_object_type):
+        t = mongo_object_type
+        for i in xrange(10):
+            t.new(id=str(i), n=i).save()
+        driver = aio.ThreadDriver(workers=4)
+        try:
+            with IdentityMap() as identity_map:
+                futures = [aio.find(t, driver=driver) for _ in xrange(8)]
+                results = [f.result() for f in futures]
+                assert len(identity_map) == 10
+                for objs in results[1:]:
+                    assert all(a is b for a, b in zip(objs, results[0]))
+        finally:
+            driver.shutdown()
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from benchmarks import harness, suite
+
+
+def results(**per_op):
+    return {'results': dict((name, {'per_op': value}) for name, value in per_op.iteritems())}
+
+
+class TestHarness(object):
+
+    def test_run(self):
+        res = harness.run(['descriptor.get', 'renderer.render'], repeat=1, min_time=0.001)
+        assert sorted(res['results']) == ['descriptor.get', 'renderer.render',
+                                          'renderer.render_cached']
+        assert all(r['per_op'] > 0 for r in res['results'].values())
+        json.dumps(res)
+
+    def test_setups(self):
+        for name, setup in harness.BENCHMARKS:
+            setup()()
+
+    def test_compare(self):
+        baseline = results(a=1.0, b=1.0, c=1.0)
+        current = results(a=1.1, b=1.5, d=5.0)
+        assert harness.compare(current, baseline, tolerance=0.2) == [('b', 1.0, 1.5, 1.5)]
+        assert harness.compare(current, baseline, tolerance=0.6) == []
+
+    def test_merge(self):
+        merged = harness.merge(results(a=1.0, b=1.0), results(b=2.0, c=3.0))
+        assert merged == results(a=1.0, b=2.0, c=3.0)
+
+    def test_main(self, tmpdir):
+        output = str(tmpdir.join('results.json'))
+        args = ['descriptor.get', '--repeat', '1', '--min-time', '0.001']
+        assert harness.main(args + ['--output', output]) == 0
+        assert sorted(harness.load(output)['results']) == ['descriptor.get']
+
+    def test_baseline(self, tmpdir, capsys):
+        path = str(tmpdir.join('baseline.json'))
+        args = ['--repeat', '1', '--min-time', '0.001', '--baseline-file', path]
+        with pytest.raises(SystemExit):
+            harness.main(['descriptor.get', '--compare'] + args)
+
+        assert harness.main(['descriptor.get', '--save-baseline'] + args) == 0
+        assert harness.main(['descriptor.set', '--save-baseline'] + args) == 0
+        baseline = harness.load(path)
+        assert sorted(baseline['results']) == ['descriptor.get', 'descriptor.set']
+
+        baseline['results']['descriptor.get']['per_op'] /= 100
+        harness.save(baseline, path)
+        capsys.readouterr()
+        assert harness.main(['descriptor.get', '--compare'] + args) == 1
+        assert 'REGRESSION' in capsys.readouterr()[0]
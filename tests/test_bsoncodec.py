@@ -0,0 +1,170 @@
+import sys
+
+import bson
+import pytest
+
+from mongolian import MongoObject, bsoncodec
+from mongolian.datatypes import Array, Bool, Dict, Float, Int, String, TypedArray
+
+
+@pytest.fixture
+def mongo_object_type():
+
+    class MongoObjectType(MongoObject):
+        id = String()
+        n = Int()
+        f = Float()
+        flag = Bool()
+        meta = Dict()
+        tags = Array(String)
+        matrix = Array(Array(Int))
+        values = TypedArray(Float)
+        rows = Array(Dict)
+        latin = String(encoding='latin-1')
+
+    return MongoObjectType
+
+
+def loaded(t, doc):
+    obj = t()
+    obj.load(doc)
+    return obj
+
+
+class TestBSONCodec(object):
+
+    def test_encode(self, mongo_object_type):
+        doc = {
+            'id': u'caf\xe9',
+            'n': 2 ** 40,
+            'f': 1.5,
+            'flag': False,
+            'meta': {'a': [1, {'b': None}]},
+            'tags': ['x', 'y'],
+            'matrix': [[1, 2], [3]],
+            'values': [0.5, 1.0],
+        }
+        obj = loaded(mongo_object_type, doc)
+        data = obj.to_bson()
+        assert isinstance(data, bson.BSON)
+        assert data.decode() == bson.BSON.encode(obj.dump()).decode()
+        assert data.decode() == dict(doc, latin=None, rows=[])
+
+    def test_encode_empty(self, mongo_object_type):
+        obj = mongo_object_type()
+        assert obj.to_bson().decode() == bson.BSON.encode(obj.dump()).decode()
+
+    def test_encode_ints(self, mongo_object_type):
+        obj = mongo_object_type()
+        for value in (0, -1, 2 ** 31 - 1, -2 ** 31, 2 ** 31, -2 ** 31 - 1, sys.maxint):
+            obj.n = value
+            data = obj.to_bson()
+            assert data.decode()['n'] == value
+            element = '\x10n\x00' if -2 ** 31 <= value < 2 ** 31 else '\x12n\x00'
+            assert element in data
+
+    def test_round_trip(self, mongo_object_type):
+        t = mongo_object_type
+        obj = loaded(t, {'id': 'a', 'n': 1, 'tags': ['x'], 'meta': {'k': 'v'}})
+        copy = t.from_bson(obj.to_bson())
+        assert copy.dump() == obj.dump()
+        assert copy.raw('id') == 'a'
+        assert not copy._dirty
+
+    def test_from_bson_skips_unknown(self, mongo_object_type):
+        data = bson.BSON.encode({'_id': bson.ObjectId(), 'id': 'a', 'other': [1]})
+        obj = mongo_object_type.from_bson(data)
+        assert obj.raw('id') == 'a'
+        assert obj.raw('n') is None
+
+    def test_cache(self, mongo_object_type):
+        obj = loaded(mongo_object_type, {'id': 'a', 'meta': {'k': 1}, 'tags': ['x']})
+        data = obj.to_bson()
+        assert sorted(obj._bson_cache) == ['matrix', 'tags']
+        assert obj.to_bson() == data
+
+        obj.tags.append('y')
+        obj.meta['k'] = 2
+        assert 'tags' not in obj._bson_cache
+        assert 'meta' not in obj._bson_cache
+        decoded = obj.to_bson().decode()
+        assert decoded['tags'] == ['x', 'y']
+        assert decoded['meta'] == {'k': 2}
+        # changed fields are cached only once they are saved
+        assert 'tags' not in obj._bson_cache
+
+        obj.matrix.append([1])
+        obj.matrix[0].append(2)
+        assert obj.to_bson().decode()['matrix'] == [[1, 2]]
+
+    def test_nested_changes(self, mongo_object_type):
+        obj = loaded(mongo_object_type, {'meta': {'a': [1]}, 'rows': [{'k': 1}],
+                                         'values': [1.0]})
+        obj.to_bson()
+        obj.meta['a'].append(2)
+        obj.rows[0]['k'] = 5
+        obj.values[0] = 2.0
+        assert obj.to_bson().decode() == bson.BSON.encode(obj.dump()).decode()
+        assert obj.to_bson().decode()['meta'] == {'a': [1, 2]}
+
+    def test_invalid_string(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.id = '\xff\xfe'
+        with pytest.raises(bson.errors.InvalidStringData):
+            bson.BSON.encode(obj.dump())
+        with pytest.raises(bson.errors.InvalidStringData):
+            obj.to_bson()
+
+        class Pair(MongoObject):
+            first = String()
+            second = String()
+
+        # halves of a multibyte sequence are invalid on their own
+        obj = Pair()
+        obj.first, obj.second = 'a\xc3', '\xa9b'
+        with pytest.raises(bson.errors.InvalidStringData):
+            obj.to_bson()
+        obj.first, obj.second = 'a\xc3\xa9', 'b'
+        assert obj.to_bson().decode() == {'first': u'a\xe9', 'second': u'b'}
+
+    def test_cache_atomic_ops(self, mongo_object_type):
+        obj = loaded(mongo_object_type, {'id': 'a', 'tags': ['x']})
+        obj.to_bson()
+        obj.tags.push('y')
+        assert obj.to_bson().decode()['tags'] == ['x', 'y']
+        obj.tags.pull('x')
+        assert obj.to_bson().decode()['tags'] == ['y']
+
+    def test_cache_reset_on_load(self, mongo_object_type):
+        obj = loaded(mongo_object_type, {'id': 'a', 'tags': ['x']})
+        obj.to_bson()
+        obj.load({'id': 'a', 'tags': ['z']})
+        assert obj.to_bson().decode()['tags'] == ['z']
+
+        obj.make_dirty()
+        assert not obj._bson_cache
+
+    def test_lazy(self, mongo_object_type):
+        t = mongo_object_type
+        obj = t()
+        obj.load({'id': 'a', 'n': 1, 'tags': ['x']}, lazy=True)
+        assert obj.to_bson().decode()['tags'] == ['x']
+        assert obj.n == 1
+        assert obj.to_bson().decode()['n'] == 1
+
+    def test_unicode_load(self, mongo_object_type):
+        obj = mongo_object_type.from_bson(bson.BSON.encode({'id': u'caf\xe9'}))
+        assert obj.raw('id') == 'caf\xc3\xa9'
+        assert type(obj.raw('id')) is str
+        obj = mongo_object_type.from_bson(bson.BSON.encode({'latin': u'\xe9'}))
+        assert obj.raw('latin') == '\xe9'
+
+    def test_invalid_value(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj._data['n'] = 'x'
+        assert obj.to_bson().decode()['n'] == 'x'
+        obj._data['n'] = 2 ** 64
+        with pytest.raises(OverflowError):
+            obj.to_bson()
+        with pytest.raises(OverflowError):
+            bsoncodec.pack_long(2 ** 63)
@@ -96,3 +96,74 @@ class TestRender(object):
                {SC3_FIELD._map_key: {'$ne': SC31_VALUE,
                                      '$lte': SC32_VALUE}}]}
 
+
+
+class TestTemplates(object):
+
+    def conditions(self, sc1, sc2, sc31, sc32):
+        return [
+            sc1,
+            UnaryCondition(operator.not_, sc1),
+            UnaryCondition(operator.not_, NAryCondition(operator.and_, sc31, sc32)),
+            NAryCondition(operator.and_, sc31, sc32),
+            NAryCondition(operator.and_, sc1, sc31, sc32),
+            NAryCondition(operator.or_, sc1, NAryCondition(operator.and_, sc2, sc31)),
+            NAryCondition(operator.and_, NAryCondition(operator.and_, sc1, sc2), sc31),
+            NAryCondition(operator.and_, SimpleCondition(SC3_FIELD, operator.eq, 1), sc32),
+        ]
+
+    def test_render_cached(self, simple_conditions):
+        Renderer.templates.clear()
+        for cond in self.conditions(*simple_conditions):
+            assert Renderer.render_cached(cond) == Renderer.render(cond)
+            assert Renderer.render_cached(cond) == Renderer.render(cond)
+        assert Renderer.templates.hits == Renderer.templates.misses
+
+    def test_bind_values(self, simple_conditions):
+        sc1, sc2, sc31, sc32 = simple_conditions
+        template = Renderer.template(NAryCondition(operator.and_, sc1, sc31, sc32))
+        assert template.render(['other', 1, 2]).to_dict() == {'$and': [
+            {SC1_FIELD._map_key: 'other'},
+            {SC3_FIELD._map_key: {'$ne': 1, '$lte': 2}}]}
+
+        with pytest.raises(ValueError):
+            template.render(['other'])
+
+    def test_same_shape(self, simple_conditions):
+        Renderer.templates.clear()
+        Renderer.render_cached(SimpleCondition(SC3_FIELD, operator.gt, 1))
+        Renderer.render_cached(SimpleCondition(SC3_FIELD, operator.gt, 2))
+        Renderer.render_cached(SimpleCondition(SC3_FIELD, operator.lt, 2))
+        assert len(Renderer.templates) == 2
+        assert Renderer.templates.hits == 1
+
+    def test_field_identity(self):
+        other = Int()
+        other.set_default_map_key(SC3_FIELD._map_key)
+        Renderer.templates.clear()
+        for field in (SC3_FIELD, other):
+            cond = NAryCondition(operator.and_,
+                NAryCondition(operator.and_,
+                              SimpleCondition(SC3_FIELD, operator.gt, 1),
+                              SimpleCondition(field, operator.lt, 5)),
+                SimpleCondition(SC3_FIELD, operator.ne, 3))
+            assert Renderer.render_cached(cond) == Renderer.render(cond)
+        assert len(Renderer.templates) == 2
+
+    def test_son_values_not_templated(self):
+        cond = SimpleCondition(SC1_FIELD, operator.eq, SON([('a', 1)]))
+        assert Renderer.template(cond) is None
+        assert Renderer.render_cached(cond) == Renderer.render(cond)
+
+    def test_lru(self):
+        cache = TemplateCache(maxsize=2)
+        cond = SimpleCondition(SC3_FIELD, operator.gt, 1)
+        for signature in ('a', 'b', 'a', 'c'):
+            cache.get(signature, cond)
+        assert len(cache) == 2
+        assert (cache.hits, cache.misses) == (1, 3)
+
+        # 'b' was evicted as least recently used
+        cache.get('a', cond)
+        cache.get('b', cond)
+        assert (cache.hits, cache.misses) == (2, 4)
@@ -1,7 +1,9 @@
+import array
+
 import pytest
 
 from mongolian import MongoObject
-from mongolian.datatypes import Int, Float, String, Dict, Array
+from mongolian.datatypes import Int, Float, String, Dict, Array, TypedArray
 
 
 @pytest.fixture
@@ -105,3 +107,177 @@ class TestDatatypes(object):
         assert (obj1.a[0], obj1.a[1]) == ('a', 'b')
         assert (obj2.a[0], obj2.a[1]) == ('c', 'd')
 
+
+    def test_cached_accessors(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.i = 5
+        assert obj.i is obj.i
+        assert obj.a is obj.a
+        assert obj.raw('i') == 5
+        assert mongo_object_type().i is not obj.i
+
+        obj.i = 6
+        assert obj.i._value == 6
+
+    def test_uncached_accessors(self, mongo_object_type):
+
+        class UncachedType(mongo_object_type):
+            CACHE_ACCESSORS = False
+
+        obj = UncachedType()
+        obj.i = 5
+        assert obj.i is not obj.i
+        assert obj.i == 5
+        assert obj.raw('i') == 5
+
+    def test_array_storage(self, mongo_object_type):
+        obj = mongo_object_type()
+
+        obj.a = ['a', 'b']
+        obj.a = ['c']
+        obj.aa = [['a'], ['b', 'c']]
+        obj.aa[0] = ['d']
+        assert obj._data == {'a': ['c'], 'aa': [['d'], ['b', 'c']]}
+
+    def test_array_operations(self, mongo_object_type):
+        obj = mongo_object_type()
+
+        obj.a.append(u'a')
+        obj.a.extend(['b', 'c'])
+        obj.a.insert(0, 'd')
+        assert list(obj.a) == ['d', 'a', 'b', 'c']
+        assert obj.a[1:3] == ['a', 'b']
+        assert obj.a.pop() == 'c'
+        assert obj.a.pop(0) == 'd'
+        assert len(obj.a) == 2
+
+        with pytest.raises(TypeError):
+            obj.a.extend(['e', 5])
+        assert len(obj.a) == 2
+
+        obj.a.clear()
+        assert len(obj.a) == 0
+
+    def test_enclosed_array_operations(self, mongo_object_type):
+        obj = mongo_object_type()
+
+        obj.aa = [['a']]
+        inner = obj.aa[0]
+        inner.append('b')
+        obj.aa.append(['c'])
+        obj.aa[1].extend(['d'])
+        assert obj.raw('aa') == [['a', 'b'], ['c', 'd']]
+        assert [list(a) for a in obj.aa] == [['a', 'b'], ['c', 'd']]
+
+        with pytest.raises(TypeError):
+            obj.aa.append(['e', 5])
+
+    def test_shared_item_field(self):
+        item = Array(String)
+
+        class MongoObjectType(MongoObject):
+            first = Array(item)
+            second = Array(item)
+
+        first = MongoObjectType.first.field.item_field
+        second = MongoObjectType.second.field.item_field
+        assert first.root_map_key == 'first'
+        assert second.root_map_key == 'second'
+        assert first.item_field.root_map_key == 'first'
+        assert second.item_field.root_map_key == 'second'
+
+        obj = MongoObjectType()
+        obj.load({'first': [['a']], 'second': [['b']]})
+        obj.second[0].append('c')
+        assert obj.dump_changes() == {'$set': {'second': [['b', 'c']]}}
+
+
+@pytest.fixture
+def typed_array_object_type():
+
+    class TypedArrayObjectType(MongoObject):
+        ia = TypedArray(Int)
+        fa = TypedArray(Float)
+
+    return TypedArrayObjectType
+
+
+class TestTypedArray(object):
+    def test_unsupported_itemtype(self):
+        with pytest.raises(TypeError):
+            TypedArray(String)
+
+    def test_set(self, typed_array_object_type):
+        obj = typed_array_object_type()
+
+        obj.ia = [1, 2.0, 3]
+        obj.fa = [1, 2.5]
+        assert obj._data['ia'] == array.array('l', [1, 2, 3])
+        assert obj._data['fa'] == array.array('d', [1.0, 2.5])
+
+        with pytest.raises(TypeError):
+            obj.ia = [1, 'a']
+        with pytest.raises(TypeError):
+            obj.fa = [1.0, None]
+        with pytest.raises(TypeError):
+            obj.ia = '12345678'
+        assert list(obj.ia) == [1, 2, 3]
+
+    def test_operations(self, typed_array_object_type):
+        obj = typed_array_object_type()
+
+        obj.ia.append(1)
+        obj.ia.extend([2, 3, 4.0])
+        assert obj.ia[3] == 4
+        assert obj.ia.pop() == 4
+        obj.ia[0:2] = [5, 6]
+        assert list(obj.ia) == [5, 6, 3]
+
+        with pytest.raises(TypeError):
+            obj.ia.extend([5, 'a'])
+        with pytest.raises(TypeError):
+            obj.fa.append('a')
+        assert len(obj.ia) == 3
+
+        obj.ia.clear()
+        assert len(obj.ia) == 0
+
+    def test_invalid_values(self, typed_array_object_type):
+        obj = typed_array_object_type()
+        with pytest.raises(TypeError):
+            obj.ia = [1, 2 ** 70]
+        with pytest.raises(TypeError):
+            obj.ia = [1, True]
+        with pytest.raises(TypeError):
+            obj.fa = (v for v in [0.5, False])
+        with pytest.raises(TypeError):
+            obj.ia.append(True)
+        with pytest.raises(TypeError):
+            obj.ia.extend([2 ** 70])
+        obj.ia = (v for v in [1, 2])
+        assert list(obj.ia) == [1, 2]
+
+    def test_dump_load(self, typed_array_object_type):
+        obj = typed_array_object_type()
+        obj.load({'ia': [1, 2], 'fa': [0.5]})
+        assert not obj._dirty
+        assert obj.dump() == {'ia': [1, 2], 'fa': [0.5]}
+        assert type(obj.dump()['ia']) == list
+
+        obj.fa.append(1.5)
+        assert obj.dump_changes() == {'$set': {'fa': [0.5, 1.5]}}
+
+    def test_numpy(self, typed_array_object_type):
+        numpy = pytest.importorskip('numpy')
+        obj = typed_array_object_type()
+
+        obj.fa = numpy.array([1.0, 2.0])
+        values = obj.fa.numpy()
+        values *= 2
+        assert list(obj.fa) == [1.0, 2.0]
+        assert list(values) == [2.0, 4.0]
+        obj.fa.extend([3.0] * 1000)
+        assert list(values) == [2.0, 4.0]
+
+        with pytest.raises(TypeError):
+            obj.ia = numpy.array([1.5])
@@ -0,0 +1,90 @@
+import operator
+
+import pytest
+
+from mongolian import MongoObject
+from mongolian.condition import SimpleCondition
+from mongolian.datatypes import Int, Float, String, Bool, Dict, Array
+from mongolian.evaluator import matches, match_many, filter_many
+
+
+@pytest.fixture
+def mongo_object_type():
+
+    class MongoObjectType(MongoObject):
+        i = Int()
+        f = Float()
+        s = String()
+        b = Bool()
+        d = Dict()
+        a = Array(Int)
+
+    return MongoObjectType
+
+
+DOCS = [
+    {'i': 1, 's': 'a', 'a': [1, 2]},
+    {'i': 5, 's': 'b', 'b': True, 'a': [3]},
+    {'i': None, 'f': 2.5},
+    {'s': 'c', 'b': False, 'a': []},
+    {'i': 10, 'f': 10.0, 'b': 1},
+]
+
+
+class TestEvaluator(object):
+
+    def check(self, cond, expected):
+        assert [matches(cond, doc) for doc in DOCS] == expected
+        assert match_many(cond, DOCS) == expected
+        assert filter_many(cond, DOCS) == [
+            doc for doc, match in zip(DOCS, expected) if match]
+
+    def test_comparisons(self, mongo_object_type):
+        t = mongo_object_type
+        self.check(t.i == 5, [False, True, False, False, False])
+        self.check(t.i != 5, [True, False, True, True, True])
+        self.check(t.i > 1, [False, True, False, False, True])
+        self.check(t.i <= 5, [True, True, False, False, False])
+        self.check(t.f >= 2.5, [False, False, True, False, True])
+
+    def test_types_do_not_mix(self, mongo_object_type):
+        t = mongo_object_type
+        # bool is not a number and 1 is not true
+        self.check(t.b == True, [False, True, False, False, False])
+        self.check(t.s > 'a', [False, True, False, True, False])
+
+    def test_null_and_missing(self, mongo_object_type):
+        t = mongo_object_type
+        self.check(t.i, [True, True, True, False, True])
+        self.check(~t.i, [False, False, False, True, False])
+        self.check(SimpleCondition(t.f, operator.eq, None), [True, True, False, True, False])
+
+    def test_arrays(self, mongo_object_type):
+        t = mongo_object_type
+        self.check(SimpleCondition(t.a, operator.eq, 2), [True, False, False, False, False])
+        self.check(t.a == [3], [False, True, False, False, False])
+        self.check(SimpleCondition(t.a, operator.gt, 1), [True, True, False, False, False])
+
+    def test_complex(self, mongo_object_type):
+        t = mongo_object_type
+        self.check(((t.i > 1) & t.b) | (t.s == 'a'),
+                   [True, True, False, False, True])
+        self.check(((t.i > 1) & (t.i < 10)).not_(),
+                   [True, False, True, True, True])
+
+    def test_objects(self, mongo_object_type):
+        t = mongo_object_type
+        objs = []
+        for doc in DOCS:
+            obj = t()
+            obj.load(doc, lazy=True)
+            objs.append(obj)
+        assert filter_many(t.i > 1, objs) == objs[1:2] + objs[4:]
+        assert [matches(SimpleCondition(t.a, operator.eq, 3), obj) for obj in objs] == [False, True, False, False, False]
+
+    def test_bound_condition(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.i = 5
+        assert obj.i > 3
+        assert not (obj.i < 3)
+        assert obj.i != 4
@@ -1,7 +1,7 @@
 import pytest
 
 from mongolian import MongoObject
-from mongolian.condition import Renderer
+from mongolian.condition import Renderer, SimpleCondition
 from mongolian.datatypes import Int, Float, String, Bool, Dict, Array
 
 
@@ -110,3 +110,12 @@ class TestFieldConditions(object):
             (obj.i == 5) & ~obj.f
         ).to_dict() == {'$and': [{'i': 5},
                                  {'f': {'$exists': False}}]}
+
+    def test_cached_accessor_conditions(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.i = 5
+        assert obj.i is obj.i
+        assert isinstance(obj.i == 5, SimpleCondition)
+        assert Renderer.render(obj.i == 5).to_dict() == {'i': 5}
+        assert Renderer.render(
+            mongo_object_type.i == 5).to_dict() == {'i': 5}
@@ -0,0 +1,79 @@
+import pytest
+
+from mongolian import MongoObject
+from mongolian.datatypes import Int, String
+from mongolian.indexes import Index, IndexChecker, ensure_indexes, DESCENDING
+from mongolian.testing import MemoryCollection
+
+
+@pytest.fixture
+def mongo_object_type():
+
+    class MongoObjectType(MongoObject):
+        id = String()
+        status = String()
+        created = Int()
+        group = String()
+
+        collection = MemoryCollection('jobs')
+
+        INDEXES = [
+            Index(id, unique=True),
+            Index([(status, 1), (created, DESCENDING)]),
+        ]
+        INDEX_CHECKER = IndexChecker(warn=False)
+
+    return MongoObjectType
+
+
+class TestIndexes(object):
+
+    def test_declarations(self, mongo_object_type):
+
+        class Derived(mongo_object_type):
+            INDEXES = [Index('group', sparse=True)]
+
+        assert [i.keys for i in Derived._INDEXES] == [
+            [('id', 1)], [('status', 1), ('created', -1)], [('group', 1)]]
+
+        names = ensure_indexes([Derived])
+        assert names == ['id_1', 'status_1_created_-1', 'group_1']
+        info = Derived.collection.index_information()
+        assert info['id_1'] == {'key': [('id', 1)], 'unique': True}
+        assert info['group_1'] == {'key': [('group', 1)], 'sparse': True}
+
+    def test_checker(self, mongo_object_type):
+        t = mongo_object_type
+        checker = t.INDEX_CHECKER
+
+        list(t.find(t.id == 'a'))
+        list(t.find((t.status == 'a') & (t.created > 5)))
+        list(t.find((t.status == 'a') | (t.id == 'b')))
+        list(t.find())
+        assert checker.checked == 4
+        assert not checker.unindexed
+
+        list(t.find(t.created > 5))
+        t.find_one(t.created > 6)
+        list(t.find((t.status == 'a') | (t.group == 'b')))
+        list(t.find(t.status != 'a'))
+        assert checker.checked == 8
+        assert checker.unindexed == {
+            ('jobs', '{"created": {"$gt": 1}}'): 2,
+            ('jobs', '{"$or": [{"status": 1}, {"group": 1}]}'): 1,
+            ('jobs', '{"status": {"$ne": 1}}'): 1,
+        }
+
+    def test_memory_collection(self, mongo_object_type):
+        t = mongo_object_type
+        t.ensure_indexes()
+        t.new(id='a', status='new', created=1).save()
+        t.new(id='b', status='done', created=2).save()
+
+        assert [o.raw('id') for o in t.find(t.created > 0, sort=[(t.created, -1)])] == ['b', 'a']
+
+        obj = t.find_one(t.id == 'a')
+        obj.status = 'done'
+        obj.save()
+        assert [o.raw('id') for o in t.find(t.status == 'done', sort=[('id', 1)])] == ['a', 'b']
+        assert len(t.collection.docs) == 2
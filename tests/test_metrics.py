@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+from mongolian import pool
+from mongolian.metrics import Histogram, MetricsRegistry
+
+
+def context(op='find', duration=0.003, **kwargs):
+    context = pool.RequestContext(op, 'db.items')
+    context.number = 1
+    context.duration = duration
+    for key, value in kwargs.iteritems():
+        setattr(context, key, value)
+    return context
+
+
+class TestHistogram(object):
+
+    def test_observe(self):
+        h = Histogram(buckets=(1, 2, 5))
+        for value in (0.5, 1, 1.5, 3, 10):
+            h.observe(value)
+        assert h.counts == [2, 1, 1, 1]
+        assert h.count == 5
+        assert h.sum == 16
+        assert h.quantile(0.5) == 2
+        assert h.quantile(0.8) == 5
+        assert h.quantile(0.99) is None
+        assert Histogram().quantile(0.5) is None
+
+
+class TestRegistry(object):
+
+    def test_record(self):
+        registry = MetricsRegistry(buckets=(0.001, 0.01))
+        registry(context(socket_wait=0.002))
+        registry(context(server_time=0.003, number_returned=2, size=100))
+        registry(context(op='update', error=ValueError()))
+
+        find, update = registry.snapshot()
+        assert (find['database'], find['collection'], find['op']) == ('db', 'items', 'find')
+        assert find['messages'] == 2
+        assert find['errors'] == 0
+        assert find['documents'] == 2
+        assert find['bytes'] == 100
+        assert find['latency']['counts'] == [0, 2, 0]
+        assert find['socket_time']['counts'] == [1, 1, 0]
+        assert find['server_time']['count'] == 1
+        assert update['errors'] == 1
+
+        assert len(registry.snapshot(reset=True)) == 2
+        assert registry.snapshot() == []
+
+    def test_listener(self):
+        registry = MetricsRegistry()
+        registry.enable()
+        try:
+            pool.start_request('insert', 'db.items')
+
+            @pool.log_request
+            def _send_message():
+                pass
+
+            _send_message()
+        finally:
+            registry.disable()
+            pool.request.context = None
+        [series] = registry.snapshot()
+        assert series['op'] == 'insert'
+        assert series['messages'] == 1
+
+    def test_threads(self):
+        registry = MetricsRegistry()
+
+        def record():
+            for _ in xrange(1000):
+                registry(context())
+
+        threads = [threading.Thread(target=record) for _ in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        [series] = registry.snapshot()
+        assert series['messages'] == 4000
+        assert series['latency']['count'] == 4000
@@ -0,0 +1,604 @@
+import bson
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from mongolian import MongoObject
+from mongolian.cache import IdentityMap, ObjectCache
+from mongolian.codec import GenericCodec, CompiledCodec, NotLoadedError
+from mongolian.session import Session
+from mongolian.datatypes import Int, Float, String, Dict, Array
+from mongolian.testing import MemoryCollection
+
+
+class FakeBulk(object):
+    def __init__(self, collection, ordered):
+        self.collection = collection
+        self.ordered = ordered
+        self.ops = []
+
+    def find(self, spec):
+        bulk = self
+
+        class Upsert(object):
+            def update_one(self, document):
+                bulk.ops.append(('update_one', spec, document))
+
+            def replace_one(self, document):
+                bulk.ops.append(('replace_one', spec, document))
+
+        class Find(object):
+            def upsert(self):
+                return Upsert()
+
+        return Find()
+
+    def execute(self):
+        self.collection.bulks.append(self)
+        errors = [{'index': idx, 'errmsg': 'failed'}
+                  for idx, (_, spec, _) in enumerate(self.ops)
+                  if spec['id'] in self.collection.failing_ids]
+        if errors:
+            raise BulkWriteError({'writeErrors': errors,
+                                  'writeConcernErrors': []})
+        return {'nMatched': len(self.ops)}
+
+
+class FakeCursor(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.batch = None
+
+    def batch_size(self, batch_size):
+        self.batch = batch_size
+        return self
+
+    def __iter__(self):
+        for doc in self.docs:
+            self.docs = self.docs[1:]
+            yield doc
+
+
+class FakeCollection(object):
+    def __init__(self):
+        self.updates = []
+        self.bulks = []
+        self.failing_ids = set()
+        self.docs = []
+        self.queries = []
+
+    def find(self, spec=None, fields=None, sort=None, limit=0):
+        self.queries.append((spec, fields, sort, limit))
+        self.cursor = FakeCursor(list(self.docs))
+        return self.cursor
+
+    def find_one(self, spec=None, fields=None):
+        self.queries.append((spec, fields, None, 0))
+        return self.docs[0] if self.docs else None
+
+    def update(self, spec, document, upsert=False):
+        self.updates.append((spec, document, upsert))
+        return {'ok': 1}
+
+    def initialize_ordered_bulk_op(self):
+        return FakeBulk(self, True)
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self, False)
+
+
+@pytest.fixture
+def mongo_object_type():
+
+    class MongoObjectType(MongoObject):
+        id = String()
+        i = Int()
+        f = Float()
+        d = Dict()
+        a = Array(String)
+        aa = Array(Array(String))
+
+        collection = FakeCollection()
+
+    return MongoObjectType
+
+
+@pytest.fixture
+def loaded_object(mongo_object_type):
+    obj = mongo_object_type()
+    obj.load({'id': 'job1',
+              'i': 1,
+              'f': 2.0,
+              'd': {'k': 'v'},
+              'a': ['x', 'y'],
+              'aa': [['x'], ['y', 'z']]})
+    return obj
+
+
+class TestDirtyTracking(object):
+
+    def test_new_object_full_dump(self, mongo_object_type):
+        obj = mongo_object_type.new(id='job1', i=5)
+        obj.save()
+        spec, doc, upsert = obj.collection.updates[-1]
+        assert spec == {'id': 'job1'}
+        assert doc == {'id': 'job1', 'i': 5, 'f': None, 'd': None,
+                       'a': [], 'aa': []}
+        assert upsert
+        assert not obj._dirty
+
+    def test_loaded_object_is_clean(self, loaded_object):
+        loaded_object.save()
+        assert loaded_object.collection.updates == []
+
+    def test_set_field(self, loaded_object):
+        loaded_object.i = 10
+        assert loaded_object.dump_changes() == {'$set': {'i': 10}}
+
+        loaded_object.save()
+        assert loaded_object.collection.updates[-1] == (
+            {'id': 'job1'}, {'$set': {'i': 10}}, True)
+        assert loaded_object.dump_changes() == {}
+
+    def test_unset_field(self, loaded_object):
+        loaded_object.f = None
+        loaded_object.i = 3
+        assert loaded_object.dump_changes() == {'$set': {'i': 3},
+                                                '$unset': {'f': ''}}
+
+    def test_dict_item(self, loaded_object):
+        loaded_object.d['k'] = 'w'
+        assert loaded_object.dump_changes() == {'$set': {'d': {'k': 'w'}}}
+
+    def test_array_changes(self, loaded_object):
+        loaded_object.a.append('z')
+        assert loaded_object.dump_changes() == {'$set': {'a': ['x', 'y', 'z']}}
+
+    def test_enclosed_array_item(self, loaded_object):
+        loaded_object.aa[1][0] = 'w'
+        assert loaded_object.dump_changes() == {
+            '$set': {'aa': [['x'], ['w', 'z']]}}
+
+    def test_make_dirty_dumps_whole_document(self, loaded_object):
+        loaded_object.i = 10
+        loaded_object.make_dirty()
+        assert loaded_object.dump_changes() == loaded_object.dump()
+
+
+class TestAtomicOperators(object):
+
+    def test_inc(self, loaded_object):
+        assert loaded_object.i.inc() == 2
+        loaded_object.i.inc(3)
+        loaded_object.f.inc(0.5)
+        assert loaded_object.raw('i') == 5
+        assert loaded_object.raw('f') == 2.5
+        assert loaded_object.dump_changes() == {'$inc': {'i': 4, 'f': 0.5}}
+        with pytest.raises(TypeError):
+            loaded_object.i.inc(0.5)
+        with pytest.raises(TypeError):
+            loaded_object.f.inc('1')
+
+    def test_arrays(self, loaded_object):
+        loaded_object.a.push('z', 'x')
+        assert list(loaded_object.a) == ['x', 'y', 'z', 'x']
+        assert loaded_object.dump_changes() == {'$push': {'a': {'$each': ['z', 'x']}}}
+
+        loaded_object.make_clean()
+        loaded_object.a.pull('x')
+        loaded_object.a.pull('w')
+        assert list(loaded_object.a) == ['y', 'z']
+        assert loaded_object.dump_changes() == {'$pull': {'a': {'$in': ['x', 'w']}}}
+
+        loaded_object.make_clean()
+        loaded_object.a.add_to_set('y', 'w')
+        assert list(loaded_object.a) == ['y', 'z', 'w']
+        assert loaded_object.dump_changes() == {'$addToSet': {'a': {'$each': ['y', 'w']}}}
+
+    def test_fallback_to_set(self, loaded_object):
+        loaded_object.a.push('z')
+        loaded_object.a.pull('x')
+        loaded_object.i.inc()
+        loaded_object.aa[0].push('w')
+        assert loaded_object.dump_changes() == {
+            '$set': {'a': ['y', 'z'], 'aa': [['x', 'w'], ['y', 'z']]},
+            '$inc': {'i': 1}}
+
+        loaded_object.i = 7
+        loaded_object.i.inc()
+        assert loaded_object.dump_changes()['$set']['i'] == 8
+        assert '$inc' not in loaded_object.dump_changes()
+
+        loaded_object.f.inc()
+        loaded_object.make_dirty()
+        assert loaded_object.dump_changes() == loaded_object.dump()
+
+    def test_save(self, mongo_object_type):
+        mongo_object_type.collection = MemoryCollection()
+        obj = mongo_object_type.new(id='job1', i=1, a=['x'])
+        obj.save()
+        other = mongo_object_type.find_one({'id': 'job1'})
+
+        obj.i.inc(2)
+        obj.a.push('y')
+        obj.save()
+        other.i.inc(3)
+        other.a.add_to_set('x', 'z')
+        assert other.update_fields()
+
+        doc = mongo_object_type.collection.find_one({'id': 'job1'})
+        assert doc['i'] == 6
+        assert doc['a'] == ['x', 'y', 'z']
+        assert other.raw('i') == 4
+        assert not other._dirty
+
+        with pytest.raises(ValueError):
+            mongo_object_type.new(id='job2').update_fields()
+        missing = mongo_object_type()
+        missing.load({'id': 'job3'})
+        missing.i.inc()
+        assert not missing.update_fields()
+
+
+class TestSaveMany(object):
+
+    def objects(self, mongo_object_type, count):
+        objs = []
+        for i in xrange(count):
+            obj = mongo_object_type()
+            obj.load({'id': 'job{0}'.format(i), 'i': i})
+            objs.append(obj)
+        return objs
+
+    def test_batches(self, mongo_object_type):
+        objs = self.objects(mongo_object_type, 5)
+        for obj in objs[1:]:
+            obj.i = 100
+        new_obj = mongo_object_type.new(id='job5')
+
+        res = MongoObject.save_many(objs + [new_obj], batch_size=2)
+        assert [r.obj for r in res] == objs[1:] + [new_obj]
+        assert all(r.ok for r in res)
+        assert not any(obj._dirty for obj in objs + [new_obj])
+
+        bulks = mongo_object_type.collection.bulks
+        assert [len(b.ops) for b in bulks] == [2, 2, 1]
+        assert bulks[0].ops[0] == (
+            'update_one', {'id': 'job1'}, {'$set': {'i': 100}})
+        assert bulks[-1].ops[0][0] == 'replace_one'
+
+    def test_ordered_failure(self, mongo_object_type):
+        objs = self.objects(mongo_object_type, 4)
+        for obj in objs:
+            obj.i = 100
+        mongo_object_type.collection.failing_ids.add('job1')
+
+        res = MongoObject.save_many(objs, batch_size=3)
+        assert [r.ok for r in res] == [True, False, False, False]
+        assert [obj._dirty for obj in objs] == [False, True, True, True]
+        assert len(mongo_object_type.collection.bulks) == 1
+
+    def test_unordered_failure(self, mongo_object_type):
+        objs = self.objects(mongo_object_type, 4)
+        for obj in objs:
+            obj.i = 100
+        mongo_object_type.collection.failing_ids.add('job1')
+
+        res = MongoObject.save_many(objs, ordered=False, batch_size=3)
+        assert [r.ok for r in res] == [True, False, True, True]
+        assert [obj._dirty for obj in objs] == [False, True, False, False]
+
+    def test_session_context(self, mongo_object_type):
+        obj = self.objects(mongo_object_type, 1)[0]
+        with Session() as session:
+            obj.i = 10
+            session.add(obj)
+            session.add(obj)
+        assert not obj._dirty
+        assert len(mongo_object_type.collection.bulks[0].ops) == 1
+
+    def test_detached_connection_error(self, mongo_object_type):
+        objs = self.objects(mongo_object_type, 4)
+        for obj in objs:
+            obj.i = 100
+        collection = mongo_object_type.collection
+        original = collection.initialize_ordered_bulk_op
+        calls = []
+
+        def bulk_op():
+            calls.append(1)
+            if len(calls) > 1:
+                raise AutoReconnect('connection lost')
+            return original()
+
+        collection.initialize_ordered_bulk_op = bulk_op
+        session = Session(batch_size=2, detach=True)
+        session.add_all(objs)
+        with pytest.raises(AutoReconnect):
+            session.flush()
+        # written objects stay clean, the rest is sent as a whole next time
+        assert [obj._dirty for obj in objs] == [False, False, True, True]
+        assert objs[2]._full_dump
+
+        with pytest.raises(ValueError):
+            Session().add(objs[0], {'$set': {'i': 1}})
+
+
+class TestCodecs(object):
+
+    DOC = {'id': 'job1',
+           'i': 1,
+           'f': 2,
+           'd': {'k': 'v'},
+           'a': [u'x', 'y'],
+           'aa': [['x'], ['y', 'z']]}
+
+    @pytest.mark.parametrize('codec_type', [GenericCodec, CompiledCodec])
+    def test_load_dump(self, mongo_object_type, codec_type):
+        mongo_object_type.set_codec(codec_type)
+        obj = mongo_object_type()
+        obj.load(self.DOC)
+        assert type(obj.f._value) == float
+        assert obj.dump() == {'id': 'job1',
+                              'i': 1,
+                              'f': 2.0,
+                              'd': {'k': 'v'},
+                              'a': ['x', 'y'],
+                              'aa': [['x'], ['y', 'z']]}
+        assert not obj._dirty
+
+    def test_codecs_match(self, mongo_object_type):
+        generic = GenericCodec(mongo_object_type)
+        compiled = CompiledCodec(mongo_object_type)
+
+        obj1, obj2 = mongo_object_type(), mongo_object_type()
+        generic.load(obj1, self.DOC)
+        compiled.load(obj2, self.DOC)
+        assert generic.dump(obj1) == compiled.dump(obj2)
+        assert generic.dump(obj2) == compiled.dump(obj1)
+
+    def test_missing_fields(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.load({'id': 'job1'})
+        assert obj.dump() == {'id': 'job1', 'i': None, 'f': None,
+                              'd': None, 'a': [], 'aa': []}
+
+    @pytest.mark.parametrize('codec_type', [GenericCodec, CompiledCodec])
+    def test_load_error(self, mongo_object_type, codec_type):
+        mongo_object_type.set_codec(codec_type)
+        obj = mongo_object_type()
+        with pytest.raises(TypeError) as e:
+            obj.load({'id': 'job1', 'i': 'string'})
+        assert 'Failed to load field i' in str(e.value)
+
+    def test_compiled_load_error_keeps_object_clean(self, mongo_object_type):
+        mongo_object_type.set_codec(CompiledCodec)
+        obj = mongo_object_type()
+        obj.load({'id': 'job1', 'i': 1})
+        with pytest.raises(TypeError) as e:
+            obj.load({'id': 'job1', 'i': 'string'})
+        assert 'Failed to load field i' in str(e.value)
+        assert not obj._dirty
+        assert obj.dump_changes() == {}
+
+    @pytest.mark.parametrize('codec_type', [GenericCodec, CompiledCodec])
+    def test_trusted_load(self, mongo_object_type, codec_type):
+        mongo_object_type.set_codec(codec_type)
+        obj = mongo_object_type()
+        obj.load({'id': u'job1', 'i': 1, 'f': 2.0, 'a': ['x'], 'aa': [['y']]},
+                 trusted=True)
+        assert type(obj.raw('id')) is str
+        assert obj.dump() == {'id': 'job1', 'i': 1, 'f': 2.0, 'd': None,
+                              'a': ['x'], 'aa': [['y']]}
+        assert not obj._dirty
+
+        # arrays are copied, strings in them are encoded
+        doc = {'a': [u'caf\xe9'], 'aa': [[u'x']]}
+        obj.load(doc, trusted=True)
+        assert obj.raw('a') == ['caf\xc3\xa9']
+        assert type(obj.raw('aa')[0][0]) is str
+        obj.a.append('y')
+        obj.aa[0].append('z')
+        assert doc == {'a': [u'caf\xe9'], 'aa': [[u'x']]}
+
+        # values are not validated
+        obj.load({'id': 'job1', 'i': 'string'}, trusted=True)
+        assert obj.raw('i') == 'string'
+        assert obj.raw('a') == []
+
+    def test_validate(self, mongo_object_type):
+        docs = [self.DOC,
+                {'id': 'job2', 'i': 'string', 'a': ['x', 1]},
+                {'id': 3, 'f': 1.5}]
+        errors = mongo_object_type.validate(docs)
+        assert [(idx, field) for idx, field, _ in errors] == [(1, 'a'), (1, 'i'), (2, 'id')]
+        assert "instead of 'int'" in errors[1][2]
+        assert mongo_object_type.validate([self.DOC]) == []
+
+
+class TestLazyLoad(object):
+
+    def test_lazy_load(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.load({'id': 'job1', 'i': 1.0, 'f': 2, 'a': [u'x']}, lazy=True)
+        assert set(obj._data.pending) == set(['id', 'i', 'f', 'a'])
+
+        assert obj.i._value == 1
+        assert type(obj.i._value) == int
+        assert list(obj.a) == ['x']
+        assert set(obj._data.pending) == set(['id', 'f'])
+        assert not obj._dirty
+
+    def test_dump_pass_through(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.load(bson.BSON.encode({'id': 'job1', 'i': 1, 'f': 2}), lazy=True)
+        obj.i = 5
+        assert obj.dump() == {'id': u'job1', 'i': 5, 'f': 2, 'd': None,
+                              'a': [], 'aa': []}
+        assert type(obj.dump()['f']) == int
+        assert obj.dump_changes() == {'$set': {'i': 5}}
+
+    def test_lazy_load_error(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.load({'id': 'job1', 'i': 'string'}, lazy=True)
+        assert obj.raw('id') == 'job1'
+        with pytest.raises(TypeError) as e:
+            obj.raw('i')
+        assert 'Failed to load field i' in str(e.value)
+
+    def test_eager_load_after_lazy(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.load({'id': 'job1', 'i': 'string'}, lazy=True)
+        obj.load({'id': 'job1', 'i': 1})
+        assert obj.dump()['i'] == 1
+
+
+class TestFind(object):
+
+    def test_find(self, mongo_object_type):
+        collection = mongo_object_type.collection
+        collection.docs = [{'id': 'job1', 'i': 1}, {'id': 'job2', 'i': 2}]
+
+        objs = mongo_object_type.find((mongo_object_type.i > 0) & mongo_object_type.f,
+                                      sort=[(mongo_object_type.i, -1), ('id', 1)],
+                                      limit=10, batch_size=5)
+        obj = next(objs)
+        assert obj.raw('id') == 'job1'
+        assert not obj._dirty
+        # documents are fetched as objects are consumed
+        assert len(collection.cursor.docs) == 1
+        assert collection.cursor.batch == 5
+
+        assert [o.raw('i') for o in objs] == [2]
+
+        spec, fields, sort, limit = collection.queries[-1]
+        assert spec.to_dict() == {'$and': [{'i': {'$gt': 0}},
+                                           {'f': {'$exists': True}}]}
+        assert fields == dict(dict.fromkeys(['id', 'i', 'f', 'd', 'a', 'aa'], True), _id=False)
+        assert sort == [('i', -1), ('id', 1)]
+        assert limit == 10
+
+    def test_find_trusted(self, mongo_object_type):
+        collection = mongo_object_type.collection
+        collection.docs = [{'id': u'job1', 'i': 1.5}]
+        [obj] = mongo_object_type.find(trusted=True)
+        assert obj.raw('id') == 'job1'
+        assert obj.raw('i') == 1.5
+        assert mongo_object_type.find_one(trusted=False).raw('i') == 1
+
+    def test_find_one(self, mongo_object_type):
+        assert mongo_object_type.find_one({'id': 'job1'}) is None
+
+        mongo_object_type.collection.docs = [{'id': 'job1', 'i': 1}]
+        obj = mongo_object_type.find_one(mongo_object_type.id == 'job1', lazy=True)
+        assert obj.raw('i') == 1
+        assert mongo_object_type.collection.queries[-1][0].to_dict() == {'id': 'job1'}
+
+
+    def test_projection(self, mongo_object_type):
+        assert mongo_object_type.projection(['id', 'i']) == {'id': True, 'i': True, '_id': False}
+        assert mongo_object_type.projection(['i']) == {'i': True, '_id': False}
+        assert mongo_object_type.projection(['i', '_id']) == {'i': True, '_id': True}
+
+
+class TestPartialLoad(object):
+
+    def test_partial_find(self, mongo_object_type):
+        collection = mongo_object_type.collection
+        collection.docs = [{'id': 'job1', 'i': 1}]
+
+        obj = next(mongo_object_type.find(fields=[mongo_object_type.i]))
+        assert collection.queries[-1][1] == {'id': True, 'i': True, '_id': False}
+        assert obj.partial
+        assert obj.raw('i') == 1
+        with pytest.raises(NotLoadedError):
+            obj.raw('f')
+        assert obj.dump() == {'id': 'job1', 'i': 1}
+
+    def test_unknown_field(self, mongo_object_type):
+        with pytest.raises(ValueError):
+            mongo_object_type.find_one(fields=['unknown'])
+
+    def test_fetch_unloaded(self, mongo_object_type):
+        collection = mongo_object_type.collection
+        collection.docs = [{'id': 'job1', 'i': 1, 'f': 2.0}]
+
+        obj = mongo_object_type.find_one(fields=['i'], fetch_unloaded=True)
+        assert obj.raw('f') == 2.0
+        assert len(collection.queries) == 2
+        assert collection.queries[-1][0] == {'id': 'job1'}
+        assert collection.queries[-1][1] == {'f': True, 'd': True, 'a': True,
+                                             'aa': True, '_id': False}
+        assert obj.raw('a') == []
+        assert not obj.partial
+        assert len(collection.queries) == 2
+
+    def test_partial_save(self, mongo_object_type):
+        obj = mongo_object_type()
+        obj.load({'id': 'job1', 'i': 1}, fields=['id', 'i'])
+        obj.i = 2
+        obj.a = ['x']
+        assert obj.dump_changes() == {'$set': {'i': 2, 'a': ['x']}}
+
+        obj.make_dirty()
+        assert obj.dump_changes() == {'$set': {'id': 'job1', 'i': 2, 'a': ['x']}}
+
+
+class TestCache(object):
+
+    def test_identity_map(self, mongo_object_type):
+        collection = mongo_object_type.collection
+        collection.docs = [{'id': 'job1', 'i': 1}]
+
+        with IdentityMap() as identity_map:
+            obj = mongo_object_type.get('job1')
+            assert mongo_object_type.get('job1') is obj
+            assert mongo_object_type.find_one({'id': 'job1'}) is obj
+            assert len(collection.queries) == 2
+            assert len(identity_map) == 1
+
+        assert mongo_object_type.get('job1') is not obj
+
+    def test_read_through(self, mongo_object_type):
+        collection = mongo_object_type.collection
+        collection.docs = [{'id': 'job1', 'i': 1, 'd': {'k': 'v'}}]
+        mongo_object_type.CACHE = ObjectCache()
+
+        obj1 = mongo_object_type.get('job1')
+        obj2 = mongo_object_type.get('job1')
+        assert obj1 is not obj2
+        assert obj2.dump() == obj1.dump()
+        assert len(collection.queries) == 1
+
+        obj2.d['k'] = 'w'
+        assert mongo_object_type.get('job1').raw('d') == {'k': 'v'}
+        assert mongo_object_type.CACHE.stats() == {
+            'size': 1, 'hits': 2, 'misses': 1, 'evictions': 0, 'expirations': 0}
+
+    def test_save_updates_cache(self, mongo_object_type):
+        mongo_object_type.CACHE = ObjectCache()
+        obj = mongo_object_type.new(id='job1', i=1)
+        obj.save()
+        assert mongo_object_type.get('job1').raw('i') == 1
+
+        MongoObject.save_many([mongo_object_type.new(id='job2', i=2)])
+        assert mongo_object_type.get('job2').raw('i') == 2
+
+        partial = mongo_object_type()
+        partial.load({'id': 'job1', 'i': 5}, fields=['i'])
+        partial.i = 6
+        partial.save()
+        assert len(mongo_object_type.CACHE) == 1
+        assert mongo_object_type.collection.queries == []
+
+    def test_lru_ttl(self, mongo_object_type):
+        cache = ObjectCache(maxsize=2, ttl=60)
+        for i in xrange(3):
+            cache.put(mongo_object_type, i, {'i': i})
+        assert cache.get(mongo_object_type, 0) is None
+        assert cache.get(mongo_object_type, 2) == {'i': 2}
+        assert cache.evictions == 1
+
+        cache.ttl = -1
+        cache.put(mongo_object_type, 3, {'i': 3})
+        assert cache.get(mongo_object_type, 3) is None
+        assert cache.expirations == 1
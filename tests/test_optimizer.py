@@ -0,0 +1,101 @@
+import pytest
+
+from mongolian import MongoObject
+from mongolian.condition import Renderer
+from mongolian.datatypes import Int, Float, String, Bool, Array
+from mongolian.optimizer import optimize, ContradictionError
+
+
+@pytest.fixture
+def mongo_object_type():
+
+    class MongoObjectType(MongoObject):
+        i = Int()
+        f = Float()
+        s = String()
+        b = Bool()
+        a = Array(Int)
+
+    return MongoObjectType
+
+
+def render(cond):
+    return Renderer.render(optimize(cond)).to_dict()
+
+
+class TestOptimizer(object):
+
+    def test_flatten(self, mongo_object_type):
+        t = mongo_object_type
+        assert render(
+            ((t.i == 1) & (t.s == 'a')) & ((t.b == True) & (t.f > 1.0))
+        ) == {'$and': [{'i': 1}, {'s': 'a'}, {'b': True}, {'f': {'$gt': 1.0}}]}
+        assert render(
+            ((t.i == 1) | (t.s == 'a')) | (t.b == True)
+        ) == {'$or': [{'i': 1}, {'s': 'a'}, {'b': True}]}
+
+    def test_duplicates(self, mongo_object_type):
+        t = mongo_object_type
+        assert render((t.s == 'a') & (t.s == 'a')) == {'s': 'a'}
+        assert render((t.s != 'a') | (t.s != 'a')) == {'s': {'$ne': 'a'}}
+
+    def test_or_to_in(self, mongo_object_type):
+        t = mongo_object_type
+        assert render(
+            (t.i == 1) | (t.s == 'a') | (t.i == 2) | (t.i == 1)
+        ) == {'$or': [{'i': {'$in': [1, 2]}}, {'s': 'a'}]}
+
+    def test_bool_and_number_values(self, mongo_object_type):
+        t = mongo_object_type
+        # mongodb does not consider true equal to 1
+        assert render((t.i == 1) | (t.i == True)) == {'i': {'$in': [1, True]}}
+        assert render((t.i == 1) | (t.i == 1)) == {'i': 1}
+        with pytest.raises(ContradictionError):
+            optimize((t.i == 1) & (t.i == True))
+        with pytest.raises(ContradictionError):
+            optimize((t.i == True) & ((t.i == 1) | (t.i == 2)))
+        assert render((t.f == 1.0) & ((t.f == 1.0) | (t.f == 2.0))) == {'f': 1.0}
+
+    def test_range_merge(self, mongo_object_type):
+        t = mongo_object_type
+        assert render(
+            (t.i > 1) & (t.i >= 3) & (t.i < 10) & (t.i <= 10)
+        ) == {'i': {'$gte': 3, '$lt': 10}}
+        assert render((t.i >= 3) & (t.i > 3)) == {'i': {'$gt': 3}}
+        assert render((t.i >= 3) & (t.i <= 3)) == {'i': 3}
+        assert render((t.i == 5) & (t.i > 3) & (t.i != 4)) == {'i': 5}
+        assert render(t.i & (t.i > 3)) == {'i': {'$gt': 3}}
+
+    def test_arrays_not_merged(self, mongo_object_type):
+        t = mongo_object_type
+        assert render(
+            (t.a > [5]) & (t.a < [3])
+        ) == {'a': {'$gt': [5], '$lt': [3]}}
+
+    def test_contradictions(self, mongo_object_type):
+        t = mongo_object_type
+        for cond in [(t.i > 5) & (t.i < 3),
+                     (t.i > 5) & (t.i <= 5),
+                     (t.i == 1) & (t.i == 2),
+                     (t.i == 1) & (t.i != 1),
+                     (t.i == 1) & (t.i > 1),
+                     t.i & ~t.i,
+                     ~t.i & (t.i >= 0),
+                     (t.s == 'a') & (t.i > 1) & ((t.f < 1.0) & (t.f > 2.0))]:
+            with pytest.raises(ContradictionError):
+                optimize(cond)
+
+        assert render(
+            ((t.i > 5) & (t.i < 3)) | (t.s == 'a')
+        ) == {'s': 'a'}
+
+    def test_not(self, mongo_object_type):
+        t = mongo_object_type
+        assert render(
+            ((t.i > 5) & (t.i > 7)).not_()
+        ) == {'i': {'$not': {'$gt': 7}}}
+
+    def test_find_skips_contradiction(self, mongo_object_type):
+        t = mongo_object_type
+        assert list(t.find((t.i > 5) & (t.i < 3), optimized=True)) == []
+        assert t.find_one((t.i > 5) & (t.i < 3), optimized=True) is None
@@ -0,0 +1,219 @@
+import logging
+import socket
+
+import pymongo
+import pytest
+
+from mongolian import pool
+
+
+@pytest.fixture
+def collection():
+    client = pymongo.MongoClient(_connect=False)
+    return pool.Collection(client.db, 'items')
+
+
+@pytest.fixture
+def events():
+    events = []
+
+    def listener(context):
+        events.append((context.op, context.number, context.duration, context.error))
+
+    pool.add_listener(listener)
+    yield events
+    pool.remove_listener(listener)
+    pool.request.context = None
+
+
+class TestRequestContext(object):
+
+    def test_disabled(self, collection, monkeypatch):
+        monkeypatch.setattr(pool.logger, 'level', logging.INFO)
+        assert not pool.instrumentation_enabled()
+        collection._start_request('update', ({'id': 1},), {})
+        assert pool.request.context is None
+        assert pool.request.request_message == ''
+
+    def test_message(self, collection, events):
+        collection._start_request('find', ({'id': 1},), {}, read='PRIMARY')
+        context = pool.request.context
+        assert context.namespace == 'db.items'
+        assert (context.database, context.collection) == ('db', 'items')
+        assert str(context) == "db.items.find(({'id': 1},), {}, read=PRIMARY).0"
+
+        context.socket_time = 0.0021
+        context.number = 2
+        assert pool.request.request_message == \
+            "db.items.find(({'id': 1},), {}, read=PRIMARY).2 socket_time: 0.002"
+
+    def test_find_one_message(self, collection, events):
+        collection._start_request('find_one', ({'id': 1},), {}, read='PRIMARY')
+        assert str(pool.request.context) == "%s.db.items.find_one(({'id': 1},), {}, read=PRIMARY).0" % (
+            collection.database.connection.name,)
+
+    def test_messages(self, collection, events):
+        @pool.log_request
+        def _send_message():
+            pass
+
+        @pool.log_request
+        def _send_message_with_response():
+            raise ValueError('failed')
+
+        collection._start_request('insert', ({'id': 1},), {})
+        _send_message()
+        _send_message()
+        with pytest.raises(ValueError):
+            _send_message_with_response()
+
+        assert [e[:2] for e in events] == [('insert', 1), ('insert', 2), ('insert', 3)]
+        assert all(e[2] is not None for e in events)
+        assert isinstance(events[-1][3], ValueError)
+
+    def test_response(self, collection, events, monkeypatch):
+        monkeypatch.setattr(pool, 'original_unpack_response',
+                            lambda *args, **kwargs: {'number_returned': 2, 'data': [{}, {}]})
+
+        @pool.log_request
+        def _send_message_with_response():
+            pass
+
+        collection._start_request('find', ({},), {})
+        _send_message_with_response()
+        assert events == []
+
+        pool.pymongo.helpers._unpack_response(None)
+        context = pool.request.context
+        assert len(events) == 1
+        assert context.number == 1
+        assert context.number_returned == 2
+        assert context.size > 0
+        assert context.server_time is None
+
+    def test_error_after_unread_response(self, collection, events):
+        @pool.log_request
+        def _send_message_with_response(fail):
+            if fail:
+                raise ValueError('failed')
+
+        collection._start_request('find', ({},), {})
+        # response of the first message is never unpacked
+        _send_message_with_response(False)
+        with pytest.raises(ValueError):
+            _send_message_with_response(True)
+        assert len(events) == 1
+        assert pool.request.context.server_time is None
+
+
+class SocketPool(pool.CustomPool):
+
+    def __init__(self, *args, **kwargs):
+        self.peers = []
+        pool.CustomPool.__init__(self, ('localhost', 27017), *args, **kwargs)
+        self._check_interval_seconds = None
+
+    def create_connection(self):
+        sock, peer = socket.socketpair()
+        self.peers.append(peer)
+        return sock
+
+
+def make_pool(max_size=2, **kwargs):
+    return SocketPool(max_size, None, None, False, False, **kwargs)
+
+
+class TestCustomPool(object):
+
+    def test_warm_up(self):
+        p = make_pool(max_size=5, min_size=3, collect_stats=True)
+        assert len(p.sockets) == 0
+        assert p.warm_up() == 3
+        assert len(p.sockets) == 3
+        sock_info = p.get_socket()
+        assert len(p.sockets) == 2
+        p.maybe_return_socket(sock_info)
+        assert len(p.sockets) == 3
+
+        stats = p.stats.snapshot()
+        assert stats['connect']['count'] == 3
+        assert stats['wait']['count'] == 1
+        assert stats['checkout']['count'] == 1
+        assert any(s['max_size'] == 5 and s['idle'] == 3 for s in pool.pool_stats())
+
+    def test_warm_up_pools(self):
+        p = make_pool(max_size=5, min_size=2)
+        assert pool.warm_up_pools() >= 2
+        assert len(p.sockets) == 2
+        assert p.warm_up() == 0
+
+    def test_request_socket_stats(self):
+        p = make_pool(collect_stats=True)
+        p.start_request()
+        for _ in xrange(3):
+            p.maybe_return_socket(p.get_socket())
+        assert p.stats.snapshot()['checkout']['count'] == 0
+        p.end_request()
+        p.maybe_return_socket(p.get_socket())
+
+        stats = p.stats.snapshot()
+        assert stats['wait']['count'] == 2
+        assert stats['checkout']['count'] == 2
+
+    def test_stats_disabled(self):
+        p = make_pool(max_size=5, min_size=1)
+        p.warm_up()
+        p.maybe_return_socket(p.get_socket())
+        stats = p.stats.snapshot()
+        assert stats['connect']['count'] == 0
+        assert stats['wait']['count'] == 0
+        assert stats['checkout']['count'] == 0
+
+    def test_stats_with_listener(self, events):
+        p = make_pool()
+        p.maybe_return_socket(p.get_socket())
+        assert p.stats.snapshot()['wait']['count'] == 1
+
+    def test_context(self, events):
+        p = make_pool()
+        pool.start_request('find', 'db.items')
+        p.maybe_return_socket(p.get_socket())
+        assert pool.request.context.socket_wait > 0
+        assert pool.request.context.socket_time == pool.request.context.socket_wait
+
+    def test_resize(self):
+        p = make_pool(max_size=2)
+        sockets = [p.get_socket(), p.get_socket()]
+        assert p.resize(4) == 4
+        sockets.extend([p.get_socket(), p.get_socket()])
+        assert not p._socket_semaphore.acquire(False)
+
+        # sockets in use can't be taken away
+        assert p.resize(1) == 4
+        for sock_info in sockets[:3]:
+            p.maybe_return_socket(sock_info)
+        assert p.resize(1) == 1
+        assert p.stats.snapshot()['resizes'] == 2
+
+    def test_resize_wait_queue(self):
+        p = SocketPool(2, None, None, False, False, wait_queue_multiple=2)
+        waiters = p._socket_semaphore.waiter_semaphore
+        assert p.resize(4) == 4
+        assert waiters._initial_value == 8
+        assert p.resize(3) == 3
+        assert waiters._initial_value == 6
+
+    def test_adaptive(self):
+        sizing = pool.AdaptiveSizing(2, 6, step=2, window=2, wait_threshold=-1)
+        p = make_pool(max_size=2, sizing=sizing)
+        for _ in xrange(4):
+            p.maybe_return_socket(p.get_socket())
+        assert p.max_size == 6
+
+        sizing.wait_threshold = 10
+        for _ in xrange(2):
+            p.maybe_return_socket(p.get_socket())
+        assert p.max_size == 4
+
+        with pytest.raises(ValueError):
+            pool.AdaptiveSizing(3, 2)
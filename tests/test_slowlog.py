@@ -0,0 +1,84 @@
+from mongolian import pool
+from mongolian.slowlog import SlowQueryLog, summarize_explain
+from mongolian.testing import MemoryCollection
+
+
+def context(op='find', duration=1.0, args=({'status': 'new'},), target=None, kwargs=None):
+    context = pool.RequestContext(op, 'db.items', args, kwargs, target=target)
+    context.number = 1
+    context.duration = duration
+    return context
+
+
+class TestSlowQueryLog(object):
+
+    def test_threshold(self):
+        slowlog = SlowQueryLog(threshold=0.5, explain=False)
+        slowlog(context(duration=0.1))
+        slowlog(context(duration=0.6))
+        slowlog(context(op='update', args=({'id': 1}, {'$set': {'a': 1}})))
+        entries = slowlog.dump()
+        assert [e['op'] for e in entries] == ['find', 'update']
+        assert entries[0]['shape'] == '{"status": 1}'
+        assert entries[0]['duration'] == 0.6
+        assert entries[1]['shape'] == '{"id": 1}'
+
+    def test_sampling(self):
+        slowlog = SlowQueryLog(threshold=0, sample_rate=0.0)
+        for _ in xrange(10):
+            slowlog(context())
+        assert slowlog.dump() == []
+
+    def test_ring_buffer(self):
+        slowlog = SlowQueryLog(threshold=0, maxlen=3, explain=False)
+        for i in xrange(5):
+            slowlog(context(duration=i))
+        assert [e['duration'] for e in slowlog.dump()] == [2, 3, 4]
+        slowlog.clear()
+        assert slowlog.dump() == []
+
+    def test_explain(self):
+        collection = MemoryCollection('items')
+        collection.insert([{'status': 'new'}, {'status': 'done'}])
+        slowlog = SlowQueryLog(threshold=0)
+        slowlog(context(target=collection))
+        slowlog.wait()
+        [entry] = slowlog.dump()
+        assert entry['explain'] == {'index': None, 'docs_examined': 2,
+                                    'keys_examined': 2, 'returned': 1}
+
+    def test_explain_cursor_options(self):
+        collection = MemoryCollection('items')
+        collection.insert([{'status': 'new', 'i': i} for i in xrange(5)])
+        slowlog = SlowQueryLog(threshold=0)
+        slowlog(context(target=collection, kwargs={'sort': [('i', -1)], 'limit': 2}))
+        slowlog(context(op='find_one', target=collection))
+        slowlog.wait()
+        assert [e['explain']['returned'] for e in slowlog.dump()] == [2, 1]
+
+    def test_dropped_explains(self, monkeypatch):
+        slowlog = SlowQueryLog(threshold=0, explain_queue_size=1)
+        monkeypatch.setattr(slowlog, '_start_worker', lambda: None)
+        for _ in xrange(3):
+            slowlog(context(target=MemoryCollection('items')))
+        assert slowlog.dropped_explains == 2
+
+
+class TestSummarizeExplain(object):
+
+    def test_legacy(self):
+        summary = summarize_explain({'cursor': 'BtreeCursor status_1', 'n': 3,
+                                     'nscanned': 4, 'nscannedObjects': 3})
+        assert summary == {'index': 'status_1', 'docs_examined': 3,
+                           'keys_examined': 4, 'returned': 3}
+
+    def test_query_planner(self):
+        summary = summarize_explain({
+            'queryPlanner': {'winningPlan': {
+                'stage': 'FETCH',
+                'inputStage': {'stage': 'IXSCAN', 'indexName': 'status_1'}}},
+            'executionStats': {'nReturned': 3, 'totalDocsExamined': 3,
+                               'totalKeysExamined': 5},
+        })
+        assert summary == {'index': 'status_1', 'docs_examined': 3,
+                           'keys_examined': 5, 'returned': 3}
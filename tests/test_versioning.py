@@ -0,0 +1,174 @@
+import pytest
+
+from mongolian import MongoObject
+from mongolian.datatypes import Array, Int, String
+from mongolian.session import Session
+from mongolian.testing import MemoryCollection
+from mongolian.versioning import ConflictError, rebase, retry_merge
+
+
+@pytest.fixture
+def mongo_object_type():
+
+    class MongoObjectType(MongoObject):
+        id = String()
+        status = String()
+        n = Int()
+        tags = Array(String)
+        version = Int()
+
+        VERSION_FIELD = 'version'
+        collection = MemoryCollection('jobs')
+
+    MongoObjectType.collection.create_index('id', unique=True)
+    return MongoObjectType
+
+
+def stored(t, id_='a'):
+    return t.collection.find_one({'id': id_}, fields=t.projection())
+
+
+class TestVersioning(object):
+
+    def test_versions(self, mongo_object_type):
+        t = mongo_object_type
+        obj = t.new(id='a', status='new', n=0)
+        obj.save()
+        assert stored(t)['version'] == 1
+        assert obj.raw('version') == 1
+
+        obj.status = 'done'
+        obj.n.inc()
+        assert obj.dump_changes() == {'$set': {'status': 'done'}, '$inc': {'n': 1}}
+        obj.save()
+        assert stored(t)['version'] == 2
+        assert obj.raw('version') == 2
+
+        obj.version = 10
+        obj.n.inc()
+        obj.save()
+        assert stored(t)['version'] == 3
+        assert stored(t)['n'] == 2
+
+    def test_conflict(self, mongo_object_type):
+        t = mongo_object_type
+        t.new(id='a', status='new', n=0).save()
+        first, second = t.find_one(t.id == 'a'), t.find_one(t.id == 'a')
+
+        first.status = 'running'
+        first.save()
+        second.status = 'failed'
+        with pytest.raises(ConflictError) as e:
+            second.save()
+        assert e.value.obj is second
+        assert e.value.expected == 1
+        assert e.value.current['status'] == 'running'
+        assert e.value.current['version'] == 2
+        assert second.raw('version') == 1
+        assert second._dirty
+
+        with pytest.raises(ConflictError) as e:
+            t.new(id='a', status='new').save()
+        assert e.value.expected is None
+
+    def test_legacy_documents(self, mongo_object_type):
+        t = mongo_object_type
+        t.collection.insert({'id': 'a', 'status': 'new'})
+        obj = t.find_one(t.id == 'a')
+        assert obj._version is None
+        obj.status = 'done'
+        obj.save()
+        assert stored(t)['version'] == 1
+        assert len(t.collection.docs) == 1
+
+        t.collection.insert({'id': 'b', 'status': 'new'})
+        obj = t.find_one(t.id == 'b')
+        obj.make_dirty()
+        obj.save()
+        assert stored(t, 'b')['version'] == 1
+        assert len(t.collection.docs) == 2
+
+    def test_unique_id_index(self):
+
+        class Versioned(MongoObject):
+            id = String()
+            version = Int()
+
+            VERSION_FIELD = 'version'
+            collection = MemoryCollection('versioned')
+
+        assert [(i.keys, i.options) for i in Versioned._INDEXES] == [
+            ([('id', 1)], {'unique': True})]
+        Versioned.ensure_indexes()
+        Versioned.new(id='a').save()
+        with pytest.raises(ConflictError):
+            Versioned.new(id='a').save()
+        assert len(Versioned.collection.docs) == 1
+
+        class Derived(Versioned):
+            pass
+
+        assert len(Derived._INDEXES) == 1
+
+    def test_rebase(self, mongo_object_type):
+        t = mongo_object_type
+        t.new(id='a', status='new', n=0, tags=['x']).save()
+        first, second = t.find_one(t.id == 'a'), t.find_one(t.id == 'a')
+        first.n.inc(5)
+        first.tags.push('y')
+        first.save()
+
+        second.status = 'done'
+        second.n.inc()
+        second.tags.push('z')
+        assert retry_merge(second) is second
+        doc = stored(t)
+        assert (doc['status'], doc['n'], doc['tags'], doc['version']) == \
+            ('done', 6, ['x', 'y', 'z'], 3)
+        assert (second.raw('n'), second.raw('tags')) == (6, ['x', 'y', 'z'])
+
+        with pytest.raises(ValueError):
+            rebase(t.new(id='a'), doc)
+
+    def test_retry_change(self, mongo_object_type):
+        t = mongo_object_type
+        t.new(id='a', status='new', n=0).save()
+        first, second = t.find_one(t.id == 'a'), t.find_one(t.id == 'a')
+        first.n = 10
+        first.save()
+
+        def change(obj):
+            obj.n = obj.raw('n') + 1
+        retry_merge(second, change)
+        assert stored(t)['n'] == 11
+
+        third = t.find_one(t.id == 'a')
+        t.collection.remove({'id': 'a'})
+        with pytest.raises(ConflictError) as e:
+            retry_merge(third, change)
+        assert e.value.current is None
+
+    def test_session(self, mongo_object_type):
+        t = mongo_object_type
+        t.new(id='a', n=0).save()
+        t.new(id='b', n=0).save()
+        stale = t.find_one(t.id == 'a')
+        fresh = t.find_one(t.id == 'a')
+        fresh.n = 1
+        fresh.save()
+
+        stale.n = 2
+        other = t.find_one(t.id == 'b')
+        other.n = 3
+        session = Session(ordered=False)
+        session.add_all([stale, other])
+        results = session.flush()
+        assert isinstance(results[0].error, ConflictError)
+        assert results[1].ok
+        assert stored(t, 'b')['version'] == 2
+
+    def test_type_checked(self):
+        with pytest.raises(TypeError):
+            class Invalid(MongoObject):
+                version = String()
+                VERSION_FIELD = 'version'
@@ -0,0 +1,239 @@
+import threading
+import time
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+from mongolian import MongoObject
+from mongolian.cache import ObjectCache
+from mongolian.datatypes import Array, Int, String
+from mongolian.testing import MemoryCollection
+from mongolian.writebehind import QueueFull, WriteBehindQueue
+
+
+@pytest.fixture
+def mongo_object_type():
+
+    class MongoObjectType(MongoObject):
+        id = String()
+        n = Int()
+        tags = Array(String)
+
+        collection = MemoryCollection('jobs')
+
+    return MongoObjectType
+
+
+def docs(t):
+    return dict((doc['id'], doc['n']) for doc in t.collection.docs)
+
+
+class TestWriteBehind(object):
+
+    def test_coalescing(self, mongo_object_type):
+        t = mongo_object_type
+        t.WRITE_BEHIND = queue = WriteBehindQueue(interval=60)
+        obj = t.new(id='a', n=0)
+        for i in xrange(10):
+            obj.n = i
+            obj.save()
+        other = t.new(id='b', n=1)
+        other.save()
+        assert len(queue) == 2
+        assert queue.coalesced == 9
+        assert t.collection.docs == []
+
+        results = queue.flush()
+        assert [r.ok for r in results] == [True, True]
+        assert docs(t) == {'a': 9, 'b': 1}
+        assert not obj._dirty
+        assert len(queue) == 0
+
+        obj.n.inc()
+        obj.save()
+        queue.shutdown()
+        assert docs(t) == {'a': 10, 'b': 1}
+        obj.n = 11
+        with pytest.raises(RuntimeError):
+            obj.save()
+
+    def test_background_flush(self, mongo_object_type):
+        t = mongo_object_type
+        flushed = threading.Event()
+        original = t.collection.initialize_ordered_bulk_op
+
+        def bulk_op():
+            flushed.set()
+            return original()
+
+        t.collection.initialize_ordered_bulk_op = bulk_op
+        t.WRITE_BEHIND = queue = WriteBehindQueue(interval=60, flush_count=2)
+        t.new(id='a', n=1).save()
+        assert not flushed.wait(0.05)
+        t.new(id='b', n=2).save()
+        assert flushed.wait(5)
+        queue.shutdown()
+        assert docs(t) == {'a': 1, 'b': 2}
+
+    def test_backpressure(self, mongo_object_type):
+        t = mongo_object_type
+        t.WRITE_BEHIND = WriteBehindQueue(interval=60, flush_count=2, max_pending=2,
+                                          timeout=0.01)
+        written = threading.Event()
+        proceed = threading.Event()
+        original = t.collection.initialize_ordered_bulk_op
+
+        def bulk_op():
+            written.set()
+            proceed.wait(5)
+            return original()
+
+        t.collection.initialize_ordered_bulk_op = bulk_op
+        t.new(id='a', n=1).save()
+        t.new(id='b', n=1).save()
+        assert written.wait(5)
+        # both objects are being written
+        with pytest.raises(QueueFull):
+            t.new(id='c', n=1).save()
+        proceed.set()
+        t.WRITE_BEHIND.timeout = None
+        t.new(id='c', n=1).save()
+        t.WRITE_BEHIND.shutdown()
+        assert sorted(docs(t)) == ['a', 'b', 'c']
+
+    def test_errors(self, mongo_object_type):
+        t = mongo_object_type
+        t.collection.create_index([('n', 1)], unique=True)
+        errors = []
+        t.WRITE_BEHIND = queue = WriteBehindQueue(interval=60, ordered=False,
+                                                  on_error=errors.append,
+                                                  max_retries=1, retry_delay=60)
+        t.new(id='a', n=1).save()
+        failing = t.new(id='b', n=1)
+        failing.save()
+        queue.flush()
+        # failed object is queued again
+        assert errors == []
+        assert len(queue) == 1 and queue.retried == 1
+        queue.flush()
+        assert [r.obj for r in errors] == [failing]
+        # objects are left to the saving thread
+        assert not failing._dirty
+        assert len(queue) == 0
+        assert queue.written == 1 and queue.failed == 1
+
+        failing.make_dirty()
+        failing.n = 2
+        failing.save()
+        queue.shutdown()
+        assert docs(t) == {'a': 1, 'b': 2}
+
+    def test_merged_updates(self, mongo_object_type):
+        t = mongo_object_type
+        t.WRITE_BEHIND = queue = WriteBehindQueue(interval=60)
+        t.new(id='a', n=0).save()
+        queue.flush()
+
+        obj = t.find_one(t.id == 'a')
+        obj.n.inc()
+        obj.save()
+        assert not obj._dirty
+        # changes made after save are not written until saved again
+        obj.n.inc(10)
+        assert queue._pending.values()[0][0].update == {'$inc': {'n': 1}}
+        obj.n.inc(-10)
+        obj.save()
+        obj.tags.push('x')
+        obj.save()
+        assert queue._pending.values()[0][0].update == {
+            '$inc': {'n': 1}, '$push': {'tags': {'$each': ['x']}}}
+        obj.tags.pull('x')
+        obj.save()
+        # push and pull of one field can't be combined, document is replaced
+        assert queue._pending.values()[0][0].update == {'id': 'a', 'n': 1, 'tags': []}
+        assert len(queue) == 1 and queue.coalesced == 3
+        queue.shutdown()
+        assert docs(t) == {'a': 1}
+
+    def test_flush_count_counts_instances(self, mongo_object_type):
+        t = mongo_object_type
+        t.WRITE_BEHIND = queue = WriteBehindQueue(interval=60, flush_count=2)
+        first = t.new(id='a', n=1)
+        first.save()
+        second = t.new(id='a', n=2)
+        second.save()
+        deadline = time.time() + 5
+        while queue.written < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert queue.written == 2
+        assert docs(t) == {'a': 2}
+        queue.shutdown()
+
+    def test_write_exception(self, mongo_object_type):
+        t = mongo_object_type
+        original = t.collection.initialize_ordered_bulk_op
+
+        def bulk_op():
+            raise AutoReconnect('connection lost')
+
+        t.collection.initialize_ordered_bulk_op = bulk_op
+        t.WRITE_BEHIND = queue = WriteBehindQueue(interval=60, retry_delay=0.01)
+        obj = t.new(id='a', n=1)
+        obj.save()
+        with pytest.raises(AutoReconnect):
+            queue.flush()
+        assert not obj._dirty
+        assert len(queue) == 1
+
+        # changes saved meanwhile are written after the failed ones
+        obj.n.inc()
+        obj.save()
+        assert queue._pending.values()[0][0].update == {'id': 'a', 'n': 2, 'tags': []}
+        t.collection.initialize_ordered_bulk_op = original
+        queue.shutdown()
+        assert docs(t) == {'a': 2}
+        assert queue.written == 1 and queue.failed == 0
+
+    def test_background_retry(self, mongo_object_type):
+        t = mongo_object_type
+        original = t.collection.initialize_ordered_bulk_op
+        calls = []
+
+        def bulk_op():
+            calls.append(time.time())
+            if len(calls) < 3:
+                raise AutoReconnect('connection lost')
+            return original()
+
+        t.collection.initialize_ordered_bulk_op = bulk_op
+        t.WRITE_BEHIND = queue = WriteBehindQueue(interval=0.01, flush_count=1,
+                                                  retry_delay=0.05)
+        t.new(id='a', n=1).save()
+        deadline = time.time() + 5
+        while queue.written < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        assert docs(t) == {'a': 1}
+        assert queue.retried == 2
+        # backoff doubles the delay
+        assert calls[2] - calls[1] >= 0.1
+        queue.shutdown()
+
+    def test_cache(self, mongo_object_type):
+        t = mongo_object_type
+        t.CACHE = ObjectCache()
+        t.WRITE_BEHIND = queue = WriteBehindQueue(interval=60)
+        obj = t.new(id='a', n=1)
+        obj.save()
+        # changes made after save are not cached
+        obj.n = 2
+        queue.flush()
+        assert t.CACHE.get(t, 'a') == {'id': 'a', 'n': 1, 'tags': []}
+        queue.shutdown()
+
+    def test_versioned(self, mongo_object_type):
+        class Versioned(mongo_object_type):
+            VERSION_FIELD = 'version'
+            version = Int()
+
+        with pytest.raises(ValueError):
+            WriteBehindQueue().add(Versioned.new(id='a', n=1))